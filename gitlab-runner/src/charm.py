@@ -12,11 +12,13 @@ develop a new k8s charm using the Operator Framework:
     https://discourse.charmhub.io/t/4208
 """
 
+import concurrent.futures
+import hashlib
+import json
 import logging
-import os
-import subprocess
-import shutil
-import socket
+import secrets
+import time
+import typing
 
 
 from ops.charm import CharmBase
@@ -26,14 +28,24 @@ from ops.main import main
 from ops.model import (
     ActiveStatus,
     BlockedStatus,
+    MaintenanceStatus,
+    ModelError,
     WaitingStatus
 )
 
 import gitlab_runner
+import hook_timing
+import interface_peers
 import interface_prometheus
 
 logger = logging.getLogger(__name__)
 
+# Seconds a successful gitlab-runner verify is trusted for the same runner token.
+VERIFY_TTL = 1800
+
+# Status while no verified gitlab-runner package could be installed.
+NOT_INSTALLED = "gitlab-runner package not verified; attach gitlab-runner-deb"
+
 
 class GitlabRunnerCharm(CharmBase):
     """The charm"""
@@ -42,19 +54,32 @@ class GitlabRunnerCharm(CharmBase):
 
     def __init__(self, *args):
         super().__init__(*args)
-        self.prometheus_provider = interface_prometheus.PrometheusProvider(self, 'scrape', socket.getfqdn(), port=9252)
-
         # Charm persistent memory
         self._stored.set_default(executor=None,
-                                 registered=False)
+                                 registered=False,
+                                 fqdn=None,
+                                 verified_token=None,
+                                 verified_at=0,
+                                 executors=None,
+                                 identities={},
+                                 shared_cache_secret=None,
+                                 runner_missing=False)
+        if not self._stored.fqdn:
+            self._stored.fqdn = gitlab_runner.fqdn()
+
+        self.prometheus_provider = interface_prometheus.PrometheusProvider(self, 'scrape', self._stored.fqdn, port=9252)
+        self.peers = interface_peers.RunnerPeers(self, 'runners')
 
         # Events
         event_bindings = {
             self.on.install: self._on_install,
+            self.on.upgrade_charm: self._on_upgrade_charm,
             self.on.config_changed: self._on_config_changed,
             self.on.start: self._on_start,
             self.on.stop: self._on_stop,
-            self.on.update_status: self._on_update_status
+            self.on.update_status: self._on_update_status,
+            self.on.leader_elected: self._on_peers_changed,
+            self.on.runners_relation_changed: self._on_peers_changed
         }
 
         # Actions
@@ -71,55 +96,88 @@ class GitlabRunnerCharm(CharmBase):
         for action, handler in action_bindings.items():
             self.framework.observe(action, handler)
 
+    @hook_timing.timed
     def _on_install(self, event):
         """
         INSTALL PROCESS DOCUMENTED HERE
         https://gitlab.com/gitlab-org/gitlab-runner/blob/master/docs/install/linux-repository.md
         """
-        arch = self.config["gitlab-runner-architecture"]
-
-        # Stage 1 - get upstream repo
-        cmd = f'curl -LJO "https://s3.dualstack.us-east-1.amazonaws.com/gitlab-runner-downloads/latest/deb/gitlab-runner_{arch}.deb"'
-        ps = subprocess.Popen(cmd, shell=True,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.STDOUT,
-                              universal_newlines=True)
-        output = ps.communicate()[0]
-        logger.debug(output)
-
-        # Stage 2 - install gitlab-runner
-        install_cmd = f'sudo -E dpkg -i gitlab-runner_{arch}.deb'
-        gl_env = os.environ.copy()
-        gl_env['GITLAB_RUNNER_DISABLE_SKEL'] = 'true'
-        ps = subprocess.Popen(install_cmd, shell=True,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.STDOUT,
-                              universal_newlines=True,
-                              env=gl_env)
-        output = ps.communicate()[0]
-        logger.debug(output)
-
-        # Stage 3 - install modified systemd unitfiles
-        shutil.copy2('templates/etc/systemd/system/gitlab-runner.service',
-                     '/etc/systemd/system/gitlab-runner.service')
-        subprocess.run(['systemctl', 'daemon-reload'])
-        subprocess.run(['systemctl', 'restart', 'gitlab-runner.service'])
-
-        # Stage 4 - determine lxd/docker type executor
-        e = self.config["executor"]
-        if e == 'lxd':
-            gitlab_runner.install_lxd_executor()
-        elif e == 'docker':
-            gitlab_runner.install_docker_executor()
-        else:
-            logger.error(f"Unsupported executor {e} configured, bailing out.")
-            self.unit.status = BlockedStatus("Docker exec tmpfs config incorrect")
+        # Stage 1 - get the package, attached as a resource or downloaded in the
+        # background through the configured proxies while the executors are installed
+        try:
+            executors = gitlab_runner.runner_executors(self)
+        except ValueError:
+            executors = [self.config["executor"]]
+        deb = self.attached_runner_deb()
+        with concurrent.futures.ThreadPoolExecutor(1) as background:
+            download = None if deb else background.submit(gitlab_runner.download_runner_deb, self)
+
+            # Stage 2 - install the lxd/docker type executors of the runners
+            for e in executors:
+                if e == 'lxd':
+                    gitlab_runner.install_lxd_executor(self)
+                elif e == 'docker':
+                    gitlab_runner.install_docker_executor(self)
+                else:
+                    logger.error(f"Unsupported executor {e} configured, bailing out.")
+                    self.unit.status = BlockedStatus("Docker exec tmpfs config incorrect")
+
+            if download:
+                deb = download.result()
+
+        self._stored.executor = executors[0]
+        self._stored.executors = executors
+
+        # Stage 3 - install gitlab-runner, once apt is done with the dpkg lock
+        if not deb:
+            # Fail closed, the upgrade action installs an attached package later on.
+            logger.error("No verified gitlab-runner package to install.")
+            self._stored.runner_missing = True
+            self.unit.status = BlockedStatus(NOT_INSTALLED)
+            return
+        if not gitlab_runner.install_runner_deb(deb):
+            logger.error("Failed to install gitlab-runner.")
+            self._stored.runner_missing = True
+            self.unit.status = BlockedStatus("Failed to install gitlab-runner")
+            return
+
+        # Stage 4 - install modified systemd unitfiles
+        gitlab_runner.install_runner_service()
+        hook_timing.run(['systemctl', 'restart', 'gitlab-runner.service'])
+
+        # Stage 5 - services of the executors, the package cache and scrape endpoint,
+        # after the executor created its bridge
+        self._install_services(executors)
 
         v = gitlab_runner.get_gitlab_runner_version()
-        self._stored.executor = e
         self.unit.set_workload_version(v)
         logger.debug("Completed install hook.")
 
+    @hook_timing.timed
+    def _on_upgrade_charm(self, event):
+        """
+        Reinstalls the services, so they run the code and units of the new charm.
+        """
+        if gitlab_runner.install_runner_service():
+            # E.g. a moved listen address, running jobs finish before the restart.
+            self.drain()
+            hook_timing.run(['systemctl', 'restart', 'gitlab-runner.service'])
+        self._install_services(self.executors())
+        self._on_update_status(event)
+
+    def _install_services(self, executors):
+        """
+        Installs the services of the executors and the package cache. Idempotent,
+        run by the install and upgrade-charm hooks.
+        """
+        for e in executors:
+            if e == 'lxd':
+                gitlab_runner.install_lxd_executor_services(self)
+            elif e == 'docker':
+                gitlab_runner.install_docker_executor_services(self)
+        gitlab_runner.install_package_cache(self)
+
+    @hook_timing.timed
     def _on_config_changed(self, _):
         if not gitlab_runner.check_mandatory_config_values(self):
             logger.error("Missing mandatory configs. Bailing.")
@@ -129,39 +187,138 @@ class GitlabRunnerCharm(CharmBase):
             logger.error("Configuration for Docker executor tmpfs config is incorrect. Bailing out!")
             self.unit.status = BlockedStatus("Docker exec tmpfs config incorrect")
 
-        if not gitlab_runner.gitlab_runner_registered_already():
+        if not gitlab_runner.check_build_storage_config(self):
+            logger.error("Configuration for build storage is incorrect. Bailing out!")
+            self.unit.status = BlockedStatus("Build storage config incorrect")
+            return
+
+        if not gitlab_runner.check_docker_pull_policy(self):
+            logger.error("Configuration for Docker pull policy is incorrect. Bailing out!")
+            self.unit.status = BlockedStatus("Docker pull policy config incorrect")
+            return
+
+        if not gitlab_runner.check_shared_cache_config(self):
+            logger.error("Configuration for the shared cache is incorrect. Bailing out!")
+            self.unit.status = BlockedStatus("Shared cache config incorrect")
+            return
+
+        if not gitlab_runner.check_runner_specs(self):
+            logger.error("Configuration for runners is incorrect. Bailing out!")
+            self.unit.status = BlockedStatus("Runners config incorrect")
+            return
+
+        if self._stored.runner_missing:
+            logger.error("gitlab-runner is not installed, not registering.")
+            self.unit.status = BlockedStatus(NOT_INSTALLED)
+            return
+
+        if not gitlab_runner.render_package_cache_config(self):
+            logger.error("Failed to render package cache config.")
+
+        executors = gitlab_runner.runner_executors(self)
+        if 'lxd' in executors and not gitlab_runner.configure_lxd(self):
+            self.unit.status = BlockedStatus("Failed to configure LXD profile")
+
+        if 'docker' in self.executors() and not gitlab_runner.render_docker_prepull(self):
+            logger.error("Failed to render docker image pre-pull config.")
+
+        missing = [e for e in executors if e not in self.executors()]
+        if self._stored.executor and (self.config['executor'] != self._stored.executor or missing):
+            logger.error(f"Executors {', '.join(self.executors())} were installed, "
+                         f"{', '.join(executors)} are not available.")
+            self.unit.status = BlockedStatus("Executor can only be set at deploy")
+            return
+
+        if not self.registered():
             logger.info("Registering")
             self.register()
+            self._on_update_status(_)
+            return
+
+        # config.toml is patched in place, executor settings are read per job.
+        changed = gitlab_runner.render_runner_templates(self, self.shared_cache())
+        if changed is None:
+            logger.error("Failed to render the runner config.")
+            self.unit.status = BlockedStatus("Failed to render runner config")
+            return
+        if changed is gitlab_runner.REGISTER_AGAIN:
+            # A new server or executor is a new runner.
+            logger.info("Runner identity changed, registering again.")
+            gitlab_runner.unregister()
+            self._stored.verified_token = None
+            self._stored.identities = {}
+            self.register()
+        elif self.outdated_runners():
+            # Runners were removed, or got new tags or a new registration token.
+            logger.info("Runners changed, registering them again.")
+            self._stored.verified_token = None
+            self.register()
         else:
-            # The runner already registered
-            logger.info("This runner is already registered. No action taken.")
+            logger.info(f"This runner is already registered, config {'reconciled' if changed else 'unchanged'}.")
             self.unit.status = ActiveStatus("Ready (Already registered.)")
+            if changed and 'lxd' in executors:
+                # A new pool size or pool images apply without waiting for the timer.
+                gitlab_runner.refill_lxd_pool()
 
         self._on_update_status(_)
 
+    @hook_timing.timed
     def _on_start(self, event):
-        r = subprocess.run(['gitlab-runner', 'start'])
+        r = hook_timing.run(['gitlab-runner', 'start'])
         if r.returncode == 0:
             logger.info("gitlab-runner started OK")
         else:
             logger.error("Failed to start gitlab-runner. Check logs.")
         self._on_update_status(event)
 
+    @hook_timing.timed
+    def _on_peers_changed(self, event):
+        self.configure_registry_mirror()
+        self.configure_shared_cache()
+        if self._stored.registered:
+            # The runners follow the shared cache of a new leader.
+            gitlab_runner.reconcile_config(self, self.shared_cache())
+
+    @hook_timing.timed
     def _on_update_status(self, event):
-        token = gitlab_runner.get_token()
-        is_ready = gitlab_runner.gitlab_runner_registered_already()
+        # A registry mirror that was still starting is picked up here, and a former
+        # leader stops serving the shared cache.
+        self.configure_registry_mirror()
+        self.configure_shared_cache()
+        try:
+            token = gitlab_runner.get_token()
+        except OSError:
+            token = None
+        is_ready = self.registered()
         if token and is_ready:
-            self.unit.status = ActiveStatus("Ready {executor}({token})".format(executor=self._stored.executor,
-                                                                               token=token))
+            message = "Ready {executor}({token})".format(executor=','.join(self.executors()), token=token)
+            if ',' in token:
+                message += f" capacity {gitlab_runner.runner_capacity(self)}"
+            limits = gitlab_runner.job_limits(self)
+            if limits:
+                message += (f" auto: {gitlab_runner.concurrency(self)} jobs,"
+                            f" {limits['cpus']} cpus, {limits['memory']}MB each")
+            if 'lxd' in self.executors():
+                backlog = gitlab_runner.lxd_reaper_backlog()
+                if backlog:
+                    message += f" reaping {backlog}"
+            self.unit.status = ActiveStatus(message)
+        elif self._stored.runner_missing:
+            self.unit.status = BlockedStatus(NOT_INSTALLED)
         else:
             self.unit.status = WaitingStatus("Not registered.")
 
+    @hook_timing.timed
     def _on_stop(self, event):
+        self.drain()
         gitlab_runner.unregister()
         self._stored.registered = False
+        self._stored.verified_token = None
+        self._stored.identities = {}
 
+    @hook_timing.timed
     def _on_register_action(self, event):
-        if not gitlab_runner.gitlab_runner_registered_already():
+        if not self.registered(verify=True):
             if self.register():
                 self._stored.registered = True
                 event.set_results({"registered": True,
@@ -173,111 +330,260 @@ class GitlabRunnerCharm(CharmBase):
 
         self._on_update_status(event)
 
+    @hook_timing.timed
     def _on_unregister_action(self, event):
+        jobs = self.drain()
+        if jobs != 0:
+            event.log(f"Drain timed out, {'unknown' if jobs is None else jobs} running jobs are cancelled.")
         gitlab_runner.unregister()
         self._stored.registered = False
-        subprocess.run(['sudo', 'gitlab-runner', 'restart'])
+        self._stored.verified_token = None
+        self._stored.identities = {}
+        hook_timing.run(['sudo', 'gitlab-runner', 'restart'])
         self.unit.status = WaitingStatus("Unregistered. Manual registration possible.")
 
-    def register(self):
-        # Pdb self.framework.breakpoint("register")
-        logger.info(f"Register gitlab runner with executor: {self._stored.executor}")
-        if self._stored.executor == 'docker':
-            if gitlab_runner.register_docker(self, http_proxy=None, https_proxy=None):
-                self._stored.registered = True
-                logger.info("Ready (Registered)")
-            else:
-                logger.error("Failed in registration of Docker runner. Bailing out.")
-                self._stored.registered = False
-
-        elif self._stored.executor == 'lxd':
-            if gitlab_runner.register_lxd(self, http_proxy=None, https_proxy=None):
-                self._stored.registered = True
-                logger.info("Ready (Registered)")
-            else:
-                logger.error("Failed in registration of lxd runner. Bailing out.")
-                self._stored.registered = False
-        else:
-            logger.error("Unsupported runner class. Bailing out")
-            self._stored.registered = False
-
-        return self._stored.registered
-
-    def _on_upgrade_action(self, event):
-
-        logging.info("Executing upgrade of gitlab-runner with Docker executor")
+    def drain(self) -> typing.Optional[int]:
+        """
+        Lets running jobs finish for up to drain-timeout seconds before the runner goes
+        away, with the progress in the unit status.
+        Returns: Number of jobs still running, None if gitlab-runner did not tell.
+        """
+        timeout = self.config['drain-timeout']
+        if timeout <= 0:
+            return 0
 
-        # Unregister current runner
-        self._on_unregister_action(event)
+        def progress(jobs):
+            self.unit.status = MaintenanceStatus(f"draining: {'unknown' if jobs is None else jobs} jobs left")
 
-        # Perform upgrade of gitlab-runner
-        self.unit.status = WaitingStatus("Upgrading gitlab-runner")
+        jobs = gitlab_runner.drain(timeout, progress)
+        if jobs is None:
+            logger.warning(f"Drain timed out after {timeout}s, gitlab-runner did not report its jobs.")
+        elif jobs:
+            logger.warning(f"Drain timed out after {timeout}s with {jobs} jobs running.")
+        return jobs
 
-        # Get and set environment variables
-        gl_env = os.environ.copy()
-        gl_env['GITLAB_RUNNER_DISABLE_SKEL'] = 'true'
+    def configure_registry_mirror(self):
+        """
+        Points docker at the registry mirror. With registry-mirror=local the leader
+        runs the pull-through cache and shares it with the other units, so image
+        layers are pulled once per site.
+        """
+        if 'docker' not in self.executors():
+            return
+        url = self.config['registry-mirror']
+        if url == 'local':
+            port = gitlab_runner.REGISTRY_MIRROR_PORT
+            if self.unit.is_leader():
+                address = self.peers.address()
+                running = gitlab_runner.run_registry_mirror(self.config['registry-mirror-upstream'])
+                self.peers.publish('registry-mirror', f'http://{address}:{port}' if running and address else '')
+                url = f'http://127.0.0.1:{port}' if running else ''
+            else:
+                url = self.peers.get('registry-mirror')
+        if url and not gitlab_runner.registry_mirror_ready(url):
+            logger.warning(f"Registry mirror {url} is not answering, pulling from upstream registries.")
+            url = ''
+        if gitlab_runner.configure_docker_mirror(url) is None:
+            logger.error("Failed to configure the docker registry mirror.")
+
+    def shared_cache(self) -> dict:
+        """
+        Returns: The S3 endpoint of the build cache shared by all units, {} when each
+        unit keeps its own. The leader takes it from the shared-cache option, the
+        other units from the leader.
+        """
+        if not self.unit.is_leader():
+            try:
+                return json.loads(self.peers.get('shared-cache') or '{}')
+            except ValueError:
+                return {}
+        if self.config['shared-cache'] != 'local':
+            return gitlab_runner.shared_cache_endpoint(self, '', '')
+        if not self._stored.shared_cache_secret:
+            self._stored.shared_cache_secret = secrets.token_hex(20)
+        return gitlab_runner.shared_cache_endpoint(self, self.peers.address(), self._stored.shared_cache_secret)
+
+    def configure_shared_cache(self):
+        """
+        Shares the build cache of the jobs between the units. With shared-cache=local
+        the leader serves it from the package cache service, and publishes it to the
+        other units either way, so a job finds the cache of its last run on any unit.
+        """
+        cache = self.shared_cache()
+        serve = {}
+        if self.unit.is_leader():
+            self.peers.publish('shared-cache', json.dumps(cache, sort_keys=True) if cache else '')
+            serve = cache if self.config['shared-cache'] == 'local' else {}
+        if not gitlab_runner.render_shared_cache_config(self, serve):
+            logger.error("Failed to render the shared cache config.")
+
+    def attached_runner_deb(self):
+        """
+        Returns: Path of the gitlab-runner package attached as the gitlab-runner-deb
+        resource, None when none is attached. An empty file counts as none.
+        """
+        try:
+            path = self.model.resources.fetch('gitlab-runner-deb')
+        except (ModelError, NameError):
+            return None
+        return str(path) if path.stat().st_size else None
 
-        # Update gitlab-runner system
-        cmd = 'sudo -E apt-get -y update'
-        process = subprocess.Popen(cmd,
-                                   shell=True,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT,
-                                   universal_newlines=True,
-                                   env=gl_env)
+    def registered(self, verify=False) -> bool:
+        """
+        Returns: True if all runners are registered. A successful gitlab-runner verify
+        is trusted for VERIFY_TTL seconds while the runner tokens and names stay the
+        same, so hooks don't call the GitLab server every time.
+        """
         try:
-            std_out, std_err = process.communicate(timeout=120)
-            if std_out:
-                logging.info(std_out)
-            if std_err:
-                logging.error(std_err)
-        except subprocess.TimeoutExpired:
-            process.kill()
-            logging.error('Upgrade of gitlab-runner timed out and failed')
+            names = [spec['name'] for spec in gitlab_runner.runner_specs(self)]
+        except ValueError:
             return False
+        try:
+            token = gitlab_runner.get_token()
+        except OSError:
+            token = None
+        verified = f"{token} {','.join(names)}" if token else None
+        if not verify and verified and verified == self._stored.verified_token and \
+                time.time() - self._stored.verified_at < VERIFY_TTL:
+            return True
+        if gitlab_runner.gitlab_runner_registered_already(names):
+            self._stored.verified_token = verified
+            self._stored.verified_at = time.time()
+            return True
+        self._stored.verified_token = None
+        return False
+
+    def executors(self) -> list:
+        """
+        Returns: The executors installed at deploy.
+        """
+        return list(self._stored.executors or filter(None, [self._stored.executor]))
 
-        # Upgrade all packages
-        cmd = 'sudo -E apt-get -y upgrade'
+    def identity(self, spec) -> str:
+        """
+        Returns: A digest of the settings that make up the runner spec on the server.
+        """
+        identity = '\n'.join([self.config['gitlab-server'],
+                              self.config['gitlab-registration-token'],
+                              spec['executor'],
+                              spec['tag-list'],
+                              str(spec['run-untagged']),
+                              str(spec['locked'])])
+        return hashlib.sha256(identity.encode()).hexdigest()
+
+    def outdated_runners(self) -> list:
+        """
+        Returns: The names of the runners in config.toml that are no longer configured,
+        or whose identity changed since they were registered.
+        """
+        wanted = {spec['name']: self.identity(spec) for spec in gitlab_runner.runner_specs(self)}
+        try:
+            live = gitlab_runner.runner_names()
+        except OSError:
+            return []
+        return [name for name in live
+                if name not in wanted or self._stored.identities.get(name) not in (None, wanted[name])]
 
-        process = subprocess.Popen(cmd,
-                                   shell=True,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT,
-                                   universal_newlines=True,
-                                   env=gl_env)
+    def register(self):
+        """
+        Registers the runners missing from config.toml, after unregistering the
+        outdated ones.
+        Returns: True if all runners are registered.
+        """
+        # Pdb self.framework.breakpoint("register")
+        outdated = self.outdated_runners()
+        for name in outdated:
+            logger.info(f"Unregister gitlab runner {name}")
+            gitlab_runner.unregister(name)
+            self._stored.identities.pop(name, None)
         try:
-            std_out, std_err = process.communicate(timeout=600)
-            if std_out:
-                logging.info(std_out)
-            if std_err:
-                logging.error(std_err)
-        except subprocess.TimeoutExpired:
-            process.kill()
-            logging.error('Upgrade of gitlab-runner system timed out and failed')
-            return False
+            live = [name for name in gitlab_runner.runner_names() if name not in outdated]
+        except OSError:
+            live = []
+
+        self._stored.registered = True
+        for spec in gitlab_runner.runner_specs(self):
+            if spec['name'] in live:
+                continue
+            logger.info(f"Register gitlab runner {spec['name']} with executor: {spec['executor']}")
+            http_proxy, https_proxy = gitlab_runner.job_proxies(self, spec['executor'])
+            if spec['executor'] == 'docker':
+                registered = gitlab_runner.register_docker(self, spec, http_proxy=http_proxy,
+                                                           https_proxy=https_proxy, cache=self.shared_cache())
+            elif spec['executor'] == 'lxd':
+                registered = gitlab_runner.register_lxd(self, spec, http_proxy=http_proxy,
+                                                        https_proxy=https_proxy, cache=self.shared_cache())
+            else:
+                logger.error("Unsupported runner class. Bailing out")
+                registered = False
 
-        # Clean up system
-        cmd = 'sudo -E apt-get -y autoremove'
+            if registered:
+                self._stored.identities[spec['name']] = self.identity(spec)
+                logger.info("Ready (Registered)")
+            else:
+                logger.error(f"Failed in registration of {spec['executor']} runner {spec['name']}. Bailing out.")
+                self._stored.registered = False
 
-        process = subprocess.Popen(cmd,
-                                   shell=True,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT,
-                                   universal_newlines=True,
-                                   env=gl_env)
-        try:
-            std_out, std_err = process.communicate(timeout=120)
-            if std_out:
-                logging.info(std_out)
-            if std_err:
-                logging.error(std_err)
-        except subprocess.TimeoutExpired:
-            process.kill()
-            logging.error('Clean up of gitlab-runner system timed out and failed')
-            return False
+        return self._stored.registered
 
-        # Register new runner
-        self._on_register_action(event)
+    @hook_timing.timed
+    def _on_upgrade_action(self, event):
+
+        logging.info("Executing upgrade of gitlab-runner")
+        timings = {}
+
+        # Fetch the package while jobs keep running, the runner is only down to install it.
+        self.unit.status = MaintenanceStatus("Downloading gitlab-runner")
+        started = time.monotonic()
+        deb = self.attached_runner_deb() or gitlab_runner.download_runner_deb(self, log=event.log)
+        timings['download-seconds'] = round(time.monotonic() - started, 1)
+        if not deb:
+            event.fail("Failed to download gitlab-runner.")
+            self._on_update_status(event)
+            return
+
+        version = gitlab_runner.deb_version(deb)
+        installed = True
+        if version == gitlab_runner.installed_version():
+            event.log(f"gitlab-runner {version} is already installed.")
+        else:
+            # The runner stays registered, running jobs finish before the upgrade.
+            started = time.monotonic()
+            jobs = self.drain()
+            timings['drain-seconds'] = round(time.monotonic() - started, 1)
+            if jobs != 0:
+                event.log(f"Drain timed out, {'unknown' if jobs is None else jobs} running jobs are cancelled.")
+
+            self.unit.status = MaintenanceStatus(f"Upgrading gitlab-runner to {version}")
+            started = time.monotonic()
+            installed = gitlab_runner.install_runner_deb(deb, log=event.log)
+            if installed and self._stored.runner_missing:
+                # The install hook failed closed, the runner unit and the services of the
+                # executors come with the package.
+                gitlab_runner.install_runner_service()
+                self._install_services(self.executors())
+                self._stored.runner_missing = False
+            # The drain stopped gitlab-runner, bring it back with whichever version is installed.
+            hook_timing.run(['systemctl', 'restart', 'gitlab-runner.service'])
+            timings['install-seconds'] = round(time.monotonic() - started, 1)
+        event.set_results(timings)
+        if not installed:
+            event.fail(f"Failed to install gitlab-runner {version}.")
+            self._on_update_status(event)
+            return
+
+        # Job containers pick up the new versions when golden images are rebuilt.
+        if 'lxd' in self.executors():
+            gitlab_runner.expire_golden_images()
+
+        # Bring config.toml up to date with the charm config and the new version.
+        if not self.registered(verify=True):
+            self._on_register_action(event)
+            return
+        gitlab_runner.reconcile_config(self, self.shared_cache())
+        self.unit.set_workload_version(gitlab_runner.get_gitlab_runner_version())
+        event.set_results({"registered": True, "token": gitlab_runner.get_token()})
+        self._on_update_status(event)
 
 
 if __name__ == "__main__":
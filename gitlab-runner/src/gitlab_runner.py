@@ -3,43 +3,351 @@
 # See LICENSE file for licensing details.
 #
 # Learn more at: https://juju.is/docs/sdk
+import functools
+import hashlib
 import logging
 import pathlib
 import stat
 import re
 import glob
+import http.client
+import json
 import shutil
 import socket
 import subprocess
+import os
+import threading
+import time
 import toml
+import typing
+import urllib.parse
+import yaml
 from pathlib import Path
 import jinja2
 
+import hook_timing
+import lxd_executor
 
-def install_lxd_executor():
-    subprocess.run(['useradd', '-g', 'lxd', 'gitlab-runner'])
-    subprocess.run(['mkdir', '-p', '/opt/lxd-executor'])
-    for file in glob.glob('templates/lxd-executor/*.sh'):
+
+# Templates and sources of the charm, whatever the working directory of the hook.
+CHARM_DIR = Path(__file__).resolve().parent.parent
+RUNNER_CONFIG = '/etc/gitlab-runner/config.toml'
+LXD_EXECUTOR_STATE = '/var/lib/lxd-executor'
+PACKAGE_CACHE_DIR = '/var/cache/package-cache'
+RUNNER_DEB_DIR = '/var/cache/gitlab-runner'
+RUNNER_DEB_URL = ('https://s3.dualstack.us-east-1.amazonaws.com/gitlab-runner-downloads/'
+                  'latest/deb/gitlab-runner_{arch}.deb')
+# sha256 of every file of the latest release, e.g. deb/gitlab-runner_amd64.deb
+RUNNER_SHA256_URL = ('https://s3.dualstack.us-east-1.amazonaws.com/gitlab-runner-downloads/'
+                     'latest/release.sha256')
+PACKAGE_CACHE_PORT = 3142
+DOCKER_DAEMON_CONFIG = '/etc/docker/daemon.json'
+REGISTRY_MIRROR_DIR = '/var/lib/registry-mirror'
+REGISTRY_MIRROR_PORT = 5000
+SHARED_CACHE_CONFIG = '/etc/default/shared-cache'
+SHARED_CACHE_DIR = '/var/cache/shared-cache'
+SHARED_CACHE_PORT = 9000
+METRICS_PORT = 9252
+LXD_METRICS_ADDRESS = '127.0.0.1:9254'
+RUNNER_METRICS_ADDRESS = '127.0.0.1:9253'
+# Where units deployed before the package cache fronted the metrics still serve them.
+LEGACY_RUNNER_METRICS_ADDRESS = '127.0.0.1:9252'
+# Per job needs and the host memory reserve (MB) when concurrent is sized automatically.
+AUTO_JOB_MEMORY = 2048
+AUTO_JOB_DISK = 10240
+AUTO_HOST_MEMORY = 1024
+# Seconds between polls of the running jobs while draining.
+DRAIN_POLL = 10
+
+
+def install_lxd_executor(charm):
+    hook_timing.run(['useradd', '-g', 'lxd', 'gitlab-runner'])
+    hook_timing.run(['mkdir', '-p', '/opt/lxd-executor'])
+    hook_timing.run(['mkdir', '-p', LXD_EXECUTOR_STATE])
+    hook_timing.run(['lxd', 'init', '--auto'])
+
+
+def install_lxd_executor_services(charm):
+    """
+    Installs the lxd executor and its services, again on upgrades of the charm.
+    """
+    for file in glob.glob(CHARM_DIR.joinpath('templates/lxd-executor/*.sh').as_posix()):
         f = Path(file)
         installed_file = Path(shutil.copy2(f, '/opt/lxd-executor/'))
         installed_file.chmod(stat.S_IEXEC)
-    subprocess.run(['lxd', 'init', '--auto'])
+    # The stage scripts hand over to the executor talking to the LXD socket.
+    shutil.copy2(CHARM_DIR.joinpath('src/lxd_executor.py'), '/opt/lxd-executor/lxd_executor.py')
+    configure_lxd(charm)
+
+    # Warm pool refill, a no-op until lxd-pool-size is set, the container reaper
+    # and the stage metrics endpoint. Restarted so they run the installed executor.
+    units = ['lxd-executor-pool.timer', 'lxd-executor-reaper.service', 'lxd-executor-metrics.service']
+    for unit in ['lxd-executor-pool.service', *units]:
+        shutil.copy2(CHARM_DIR.joinpath(f'templates/etc/systemd/system/{unit}'), f'/etc/systemd/system/{unit}')
+    hook_timing.run(['systemctl', 'daemon-reload'])
+    hook_timing.run(['systemctl', 'enable', *units])
+    hook_timing.run(['systemctl', 'restart', *units])
+
+
+def install_runner_service() -> bool:
+    """
+    Installs the modified systemd unit of gitlab-runner.
+    Returns: True if the unit changed, gitlab-runner picks it up when restarted.
+    """
+    source = CHARM_DIR.joinpath('templates/etc/systemd/system/gitlab-runner.service')
+    target = Path('/etc/systemd/system/gitlab-runner.service')
+    if target.exists() and target.read_bytes() == source.read_bytes():
+        return False
+    shutil.copy2(source, target)
+    hook_timing.run(['systemctl', 'daemon-reload'])
+    return True
 
 
-def install_docker_executor():
-    subprocess.run(['apt', 'install', '-y', 'docker.io'])
-    subprocess.run(['systemctl', 'start', 'docker.service'])
+def install_package_cache(charm):
+    """
+    Installs the host package cache, which also serves the scrape endpoint.
+    """
+    hook_timing.run(['mkdir', '-p', '/opt/package-cache', PACKAGE_CACHE_DIR])
+    shutil.copy2(CHARM_DIR.joinpath('src/package_cache.py'), '/opt/package-cache/package_cache.py')
+    shutil.copy2(CHARM_DIR.joinpath('templates/etc/systemd/system/package-cache.service'),
+                 '/etc/systemd/system/package-cache.service')
+    render_package_cache_config(charm)
+    # The leader serves the shared cache once it published it.
+    render_shared_cache_config(charm, {})
+    hook_timing.run(['systemctl', 'daemon-reload'])
+    hook_timing.run(['systemctl', 'enable', 'package-cache.service'])
+    hook_timing.run(['systemctl', 'restart', 'package-cache.service'])
+
+
+def install_docker_executor(charm):
+    hook_timing.run(['apt', 'install', '-y', 'docker.io'])
+    hook_timing.run(['systemctl', 'start', 'docker.service'])
+
+
+def install_docker_executor_services(charm):
+    """
+    Installs the services of the docker executor, again on upgrades of the charm.
+    """
+    # Job images are pulled in the background, ahead of the first jobs.
+    source = CHARM_DIR.joinpath('templates/etc/systemd/system/docker-prepull.service')
+    target = Path('/etc/systemd/system/docker-prepull.service')
+    changed = not target.exists() or target.read_bytes() != source.read_bytes()
+    if changed:
+        shutil.copy2(source, target)
+    render_docker_prepull(charm, reload=changed)
+
+
+def docker_pull_images(charm) -> list:
+    """
+    Returns: The images pre-pulled for docker jobs, those of the docker runners
+    followed by docker-pull-images.
+    """
+    images = [spec['docker-image'] for spec in runner_specs(charm) if spec['executor'] == 'docker']
+    images += [image.strip() for image in charm.config['docker-pull-images'].split(',') if image.strip()]
+    return list(dict.fromkeys(images))
+
+
+def render_docker_prepull(charm, reload=False) -> bool:
+    """
+    Renders the pre-pulled images and their refresh timer. Changed images are
+    pulled in the background right away. Systemd reloads the units when the timer
+    changed, or with reload when the service was replaced.
+    Returns: False if either failed to render.
+    """
+    images = _render_template(CHARM_DIR.joinpath('templates/etc/default/'),
+                              'docker-prepull',
+                              Path('/etc/default/docker-prepull'),
+                              {'images': ' '.join(docker_pull_images(charm)),
+                               'parallelism': 4})
+    interval = charm.config['docker-pull-interval']
+    timer = _render_template(CHARM_DIR.joinpath('templates/etc/systemd/system/'),
+                             'docker-prepull.timer',
+                             Path('/etc/systemd/system/docker-prepull.timer'),
+                             {'interval': interval})
+    if images is None or timer is None:
+        return False
+    if timer or reload:
+        hook_timing.run(['systemctl', 'daemon-reload'])
+    if timer:
+        if interval > 0:
+            hook_timing.run(['systemctl', 'enable', 'docker-prepull.timer'])
+            hook_timing.run(['systemctl', 'restart', 'docker-prepull.timer'])
+        else:
+            hook_timing.run(['systemctl', 'disable', '--now', 'docker-prepull.timer'])
+    if images:
+        hook_timing.run(['systemctl', 'start', '--no-block', 'docker-prepull.service'])
+    return True
 
 
 def get_gitlab_runner_version():
     cmd = "gitlab-runner --version"
-    r = subprocess.run(cmd.split(),
-                       stdout=subprocess.PIPE,
-                       stderr=subprocess.STDOUT,
-                       universal_newlines=True)
+    r = hook_timing.run(cmd.split(),
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT,
+                        universal_newlines=True)
     return re.search('Version:(.*)', r.stdout).group(1).lstrip()
 
 
+def stream(cmd: list, log: typing.Callable[[str], None], env=None, timeout=None) -> typing.Optional[int]:
+    """
+    Runs cmd and hands its output to log line by line while it runs.
+    Returns: The exit code, None when cmd was killed after timeout seconds.
+    """
+    process = hook_timing.Popen(cmd,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                universal_newlines=True,
+                                env=env)
+    # Set by the timer only, a cancelled timer is finished as well.
+    timed_out = threading.Event()
+
+    def kill():
+        if process.poll() is None:
+            timed_out.set()
+            process.kill()
+    timer = threading.Timer(timeout, kill) if timeout else None
+    if timer:
+        timer.start()
+    for line in process.stdout:
+        log(line.rstrip())
+    process.wait()
+    if timer:
+        timer.cancel()
+    if timed_out.is_set():
+        logging.error(f"{cmd[0]} timed out after {timeout}s and was killed.")
+        return None
+    return process.returncode
+
+
+def _sha256(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def runner_checksums(env=None, log=logging.debug) -> dict:
+    """
+    Fetches the checksums of the latest gitlab-runner release, keeping the last
+    ones fetched when the download fails.
+    Returns: {path: sha256} of the release files, empty when there are none.
+    """
+    sums = f'{RUNNER_DEB_DIR}/release.sha256'
+    os.makedirs(RUNNER_DEB_DIR, exist_ok=True)
+    cmd = ['curl', '--fail', '--silent', '--show-error', '--location', '--output', f'{sums}.part',
+           RUNNER_SHA256_URL]
+    if stream(cmd, log, env=env, timeout=60) == 0:
+        os.replace(f'{sums}.part', sums)
+    else:
+        logging.warning("Failed to download the gitlab-runner checksums.")
+    checksums = {}
+    try:
+        with open(sums) as f:
+            for line in f:
+                words = line.split()
+                if len(words) == 2:
+                    checksums[words[1].lstrip('*')] = words[0].lower()
+    except FileNotFoundError:
+        pass
+    return checksums
+
+
+def download_runner_deb(charm, log=logging.debug) -> typing.Optional[str]:
+    """
+    Downloads the gitlab-runner package through the configured proxies into a cache.
+    An interrupted download resumes, and the download is skipped when the cached
+    package is as new as the upstream one. Packages are only used when their sha256
+    matches the release checksums, without checksums the install fails closed and
+    the download is kept for the next try.
+    Returns: Path of the package, None when there is none.
+    """
+    arch = charm.config['gitlab-runner-architecture']
+    deb = f'{RUNNER_DEB_DIR}/gitlab-runner_{arch}.deb'
+    part = f'{deb}.part'
+    env = os.environ.copy()
+    for key in ('http_proxy', 'https_proxy'):
+        if charm.config[key]:
+            env[key] = charm.config[key]
+    expected = runner_checksums(env, log).get(f'deb/gitlab-runner_{arch}.deb')
+
+    cmd = ['curl', '--fail', '--silent', '--show-error', '--location', '--remote-time',
+           '--continue-at', '-', '--output', part]
+    if os.path.exists(deb) and not os.path.exists(part):
+        cmd += ['--time-cond', deb]
+    cmd.append(RUNNER_DEB_URL.format(arch=arch))
+    rc = stream(cmd, log, env=env, timeout=600)
+    if rc != 0:
+        logging.error("Failed to download gitlab-runner, the download resumes on the next try.")
+    if os.path.exists(part) and os.path.getsize(part):
+        # curl fails resuming a download that was already complete, the checksum tells.
+        digest = _sha256(part)
+        if not expected:
+            logging.error("No checksum of the gitlab-runner package is available to verify the download, "
+                          "attach it as the gitlab-runner-deb resource or retry once the checksums can be fetched.")
+            return None
+        if digest == expected:
+            os.replace(part, deb)
+            Path(f'{deb}.sha256').write_text(digest)
+            return deb
+        if rc == 0:
+            logging.error(f"Downloaded gitlab-runner package does not match its checksum {expected}.")
+            os.unlink(part)
+    elif os.path.exists(part):
+        # Left empty by a not modified answer.
+        os.unlink(part)
+
+    if not os.path.exists(deb):
+        return None
+    # Cached packages are checked against the checksum they were verified with.
+    try:
+        verified = Path(f'{deb}.sha256').read_text().strip()
+    except FileNotFoundError:
+        verified = expected
+    if not verified:
+        logging.error("No checksum of the cached gitlab-runner package is available to verify it.")
+        return None
+    if _sha256(deb) == verified:
+        Path(f'{deb}.sha256').write_text(verified)
+        return deb
+    logging.error("Cached gitlab-runner package does not match its checksum, removed it.")
+    for path in (deb, f'{deb}.sha256'):
+        if os.path.exists(path):
+            os.unlink(path)
+    return None
+
+
+def deb_version(deb: str) -> str:
+    """
+    Returns: The version of the package file deb.
+    """
+    r = hook_timing.run(['dpkg-deb', '--field', deb, 'Version'],
+                        stdout=subprocess.PIPE,
+                        universal_newlines=True)
+    return r.stdout.strip()
+
+
+def installed_version() -> str:
+    """
+    Returns: The installed gitlab-runner package version, empty when not installed.
+    """
+    r = hook_timing.run(['dpkg-query', '--show', '--showformat=${Version}', 'gitlab-runner'],
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.DEVNULL,
+                        universal_newlines=True)
+    return r.stdout.strip() if r.returncode == 0 else ''
+
+
+def install_runner_deb(deb: str, log=logging.debug) -> bool:
+    """
+    Installs the gitlab-runner package file deb.
+    Returns: True on success.
+    """
+    gl_env = os.environ.copy()
+    gl_env['GITLAB_RUNNER_DISABLE_SKEL'] = 'true'
+    return stream(['sudo', '-E', 'dpkg', '-i', deb], log, env=gl_env, timeout=600) == 0
+
+
 def check_mandatory_config_values(charm) -> bool:
     nonempty = list()
     nonempty.append(charm.config['gitlab-registration-token'])
@@ -57,175 +365,910 @@ def check_docker_tmpfs_config(charm) -> bool:
     return True
 
 
-def gitlab_runner_registered_already() -> bool:
-    hostname_fqdn = socket.getfqdn()
-    cp = subprocess.run(("gitlab-runner verify -n " + hostname_fqdn).split())
-    return cp.returncode == 0
+def run_registry_mirror(upstream) -> bool:
+    """
+    Runs the pull-through registry cache of the site in docker, caching the
+    upstream registry under REGISTRY_MIRROR_DIR.
+    Returns: True if it runs.
+    """
+    r = hook_timing.run(['docker', 'inspect', '--format', '{{.Config.Env}}', 'registry-mirror'],
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.DEVNULL,
+                        universal_newlines=True)
+    if r.returncode == 0 and f'REGISTRY_PROXY_REMOTEURL={upstream}' in r.stdout:
+        return hook_timing.run(['docker', 'start', 'registry-mirror']).returncode == 0
+    if r.returncode == 0:
+        hook_timing.run(['docker', 'rm', '--force', 'registry-mirror'])
+    cmd = ['docker', 'run', '--detach', '--restart=always', '--name', 'registry-mirror',
+           '--publish', f'{REGISTRY_MIRROR_PORT}:5000',
+           '--volume', f'{REGISTRY_MIRROR_DIR}:/var/lib/registry',
+           '--env', f'REGISTRY_PROXY_REMOTEURL={upstream}',
+           'registry:2']
+    return hook_timing.run(cmd).returncode == 0
+
+
+def registry_mirror_ready(url) -> bool:
+    """
+    Returns: True if the registry at url answers the v2 API.
+    """
+    address = urllib.parse.urlsplit(url)
+    connection_class = http.client.HTTPSConnection if address.scheme == 'https' else http.client.HTTPConnection
+    connection = connection_class(address.netloc, timeout=5)
+    try:
+        connection.request('GET', '/v2/')
+        # A mirror of an authenticated registry asks for credentials.
+        return connection.getresponse().status in (200, 401)
+    except OSError:
+        return False
+    finally:
+        connection.close()
+
+
+def configure_docker_mirror(url) -> typing.Optional[bool]:
+    """
+    Points the registry-mirrors of the docker daemon at url, none when url is
+    empty, and reloads the daemon when that changed. Plain http mirrors are
+    also listed as insecure registries.
+    Returns: Whether it changed, None if daemon.json is broken.
+    """
+    try:
+        with open(DOCKER_DAEMON_CONFIG) as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        config = {}
+    except ValueError as e:
+        logging.error(f'Failed to parse {DOCKER_DAEMON_CONFIG}: {e}')
+        return None
+
+    wanted = dict(config)
+    # The insecure entries of the previous http mirrors go with them.
+    previous = [urllib.parse.urlsplit(m).netloc for m in wanted.pop('registry-mirrors', [])
+                if m.startswith('http://')]
+    insecure = [r for r in wanted.pop('insecure-registries', []) if r not in previous]
+    if url:
+        wanted['registry-mirrors'] = [url]
+        if url.startswith('http://'):
+            insecure.append(urllib.parse.urlsplit(url).netloc)
+    if insecure:
+        wanted['insecure-registries'] = insecure
+    if wanted == config:
+        return False
+
+    os.makedirs(os.path.dirname(DOCKER_DAEMON_CONFIG), exist_ok=True)
+    tmp = f'{DOCKER_DAEMON_CONFIG}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(wanted, f, indent=2)
+    os.rename(tmp, DOCKER_DAEMON_CONFIG)
+    # registry-mirrors and insecure-registries reload without restarting running jobs.
+    hook_timing.run(['systemctl', 'reload', 'docker.service'])
+    logging.info(f'Docker registry mirror set to {url or "none"}')
+    return True
+
+
+def shared_cache_endpoint(charm, address, secret_key) -> dict:
+    """
+    Returns: The S3 endpoint of the build cache shared by all units from the
+    shared-cache option, {} for a cache per unit or a malformed option. With
+    shared-cache=local it is served by this unit, reached on address and signed
+    with secret_key.
+    """
+    if not check_shared_cache_config(charm):
+        return {}
+    setting = charm.config['shared-cache']
+    if setting == 'local':
+        if not address:
+            return {}
+        return {'address': f'{address}:{SHARED_CACHE_PORT}',
+                'bucket': charm.config['shared-cache-bucket'],
+                'access-key': 'gitlab-runner',
+                'secret-key': secret_key,
+                'insecure': True,
+                'region': 'us-east-1'}
+    if setting:
+        url = urllib.parse.urlsplit(setting)
+        return {'address': url.netloc,
+                'bucket': charm.config['shared-cache-bucket'],
+                'access-key': charm.config['shared-cache-access-key'],
+                'secret-key': charm.config['shared-cache-secret-key'],
+                'insecure': url.scheme == 'http',
+                # Looked up by the runner.
+                'region': ''}
+    return {}
 
 
-def _render_runner_templates(charm) -> bool:
-    def _render_templates(_template_path: pathlib.Path,
-                          _template_filename: str,
-                          _rendered_target_path: pathlib.Path,
-                          _keywords) -> bool:
+def check_shared_cache_config(charm) -> bool:
+    setting = charm.config['shared-cache']
+    if setting in ('', 'local'):
+        return True
+    url = urllib.parse.urlsplit(setting)
+    keys = ('shared-cache-bucket', 'shared-cache-access-key', 'shared-cache-secret-key')
+    return url.scheme in ('http', 'https') and bool(url.netloc) and all(charm.config[key] for key in keys)
+
+
+def render_shared_cache_config(charm, cache) -> bool:
+    """
+    Renders SHARED_CACHE_CONFIG, so the package cache service serves the shared
+    cache endpoint cache, none when it is empty, and restarts it if that changed.
+    """
+    target = Path(SHARED_CACHE_CONFIG)
+    installed = target.exists()
+    # It holds the secret key, so it is only readable by root from the start.
+    target.touch(mode=0o600)
+    changed = _render_template(CHARM_DIR.joinpath('templates/etc/default/'),
+                               'shared-cache',
+                               target,
+                               {'listen': f':{SHARED_CACHE_PORT}' if cache else '',
+                                'cache_dir': SHARED_CACHE_DIR,
+                                'max_size': charm.config['shared-cache-max-size'],
+                                'bucket': cache.get('bucket', ''),
+                                'access_key': cache.get('access-key', ''),
+                                'secret_key': cache.get('secret-key', '')})
+    if changed is None:
+        return False
+    if changed and installed:
+        hook_timing.run(['systemctl', 'restart', 'package-cache.service'])
+    return True
+
+
+def runner_cache(cache) -> dict:
+    """
+    Returns: The [runners.cache] settings of a runner using the shared cache
+    endpoint cache, which keep the cache on the unit when it is empty.
+    """
+    if not cache:
+        return {'Type': ''}
+    # Shared, so the archives are not kept per runner token, which differs on every unit.
+    return {'Type': 's3',
+            'Shared': True,
+            's3': {'ServerAddress': cache['address'],
+                   'AccessKey': cache['access-key'],
+                   'SecretKey': cache['secret-key'],
+                   'BucketName': cache['bucket'],
+                   'BucketLocation': cache['region'],
+                   'Insecure': cache['insecure']}}
+
+
+def _cache_args(cache) -> list:
+    """
+    Returns: register arguments pointing the runner at the shared cache endpoint cache.
+    """
+    if not cache:
+        return []
+    args = ['--cache-type', 's3', '--cache-shared',
+            '--cache-s3-server-address', cache['address'],
+            '--cache-s3-access-key', cache['access-key'],
+            '--cache-s3-secret-key', cache['secret-key'],
+            '--cache-s3-bucket-name', cache['bucket']]
+    if cache['region']:
+        args.extend(['--cache-s3-bucket-location', cache['region']])
+    if cache['insecure']:
+        args.append('--cache-s3-insecure')
+    return args
+
+
+def job_no_proxy(charm, cache=None) -> str:
+    """
+    Returns: The hosts jobs reach without their proxies, those of the no_proxy
+    option and the one of the shared cache endpoint cache.
+    """
+    hosts = [host.strip() for host in charm.config['no_proxy'].split(',') if host.strip()]
+    if cache:
+        hosts.append(urllib.parse.urlsplit(f"//{cache['address']}").hostname)
+    return ','.join(dict.fromkeys(hosts))
+
+
+DOCKER_PULL_POLICIES = ('always', 'if-not-present', 'never')
+
+
+def docker_pull_policy(charm) -> list:
+    """
+    Returns: The pull policies of docker jobs from docker-pull-policy, tried in order.
+    """
+    return [policy.strip() for policy in charm.config['docker-pull-policy'].split(',') if policy.strip()]
+
+
+def check_docker_pull_policy(charm) -> bool:
+    return all(policy in DOCKER_PULL_POLICIES for policy in docker_pull_policy(charm))
+
+
+def _size_mb(value) -> int:
+    """
+    Returns: A size like 512m, 4g or 4096 (MB) in MB.
+    """
+    m = re.fullmatch(r'([0-9]+)([mg]?)b?', value.strip().lower())
+    if not m:
+        raise ValueError(f'Invalid size {value}')
+    return int(m.group(1)) * (1024 if m.group(2) == 'g' else 1)
+
+
+def build_tmpfs_mounts(charm) -> dict:
+    """
+    Returns: {path: size in MB} of the build-tmpfs option. Mounts sized 'auto'
+    share half of the host memory, divided by concurrent jobs.
+    Raises: ValueError on a malformed entry.
+    """
+    entries = [e.strip() for e in charm.config['build-tmpfs'].split(',') if e.strip()]
+    mounts = {}
+    for entry in entries:
+        path, _, size = entry.partition(':')
+        if not path.startswith('/'):
+            raise ValueError(f'Build tmpfs path {path} is not absolute')
+        mounts[path] = size.strip() or 'auto'
+
+    auto = [path for path, size in mounts.items() if size == 'auto']
+    if auto:
+        _, memory = host_resources()
+        share = memory // 2 // max(concurrency(charm), 1) // len(auto)
+        for path in auto:
+            mounts[path] = max(share, 256)
+    return {path: size if isinstance(size, int) else _size_mb(size)
+            for path, size in mounts.items()}
+
+
+def check_build_storage_config(charm) -> bool:
+    try:
+        build_tmpfs_mounts(charm)
+        lxd_storage_pool(charm)
+    except ValueError as e:
+        logging.error(f'{e}')
+        return False
+    return True
+
+
+RUNNER_SPEC_KEYS = ('name', 'executor', 'tag-list', 'run-untagged', 'locked', 'limit',
+                    'request-concurrency', 'docker-image')
+
+
+def runner_specs(charm) -> list:
+    """
+    Returns: The runners of this unit, from the runners option with unset keys taken
+    from the top level options. Without runners it is a single runner named after
+    the host FQDN, named runners are called <fqdn>-<name>.
+    Raises: ValueError when the runners option is malformed.
+    """
+    try:
+        specs = yaml.safe_load(charm.config['runners'] or '') or [{}]
+    except yaml.YAMLError as e:
+        raise ValueError(f'runners is not valid YAML: {e}')
+    if not isinstance(specs, list) or not all(isinstance(spec, dict) for spec in specs):
+        raise ValueError('runners must be a list of mappings')
+
+    resolved = []
+    for spec in specs:
+        unknown = set(spec) - set(RUNNER_SPEC_KEYS)
+        if unknown:
+            raise ValueError(f'Unknown runner keys: {", ".join(sorted(unknown))}')
+        name = str(spec.get('name', ''))
+        if charm.config['runners'] and not re.fullmatch(r'[A-Za-z0-9_.-]+', name):
+            raise ValueError(f'Runner name "{name}" must be letters, digits, "_", "." or "-"')
         try:
-            # Load template
-            template = jinja2.Environment(
-                loader=jinja2.FileSystemLoader(_template_path,),
-                undefined=jinja2.StrictUndefined
-            ).get_template(_template_filename)
-            # Redner template
-            rendered_template = template.render(_keywords)
-            rendered_target_path.write_text(rendered_template)
-
-            return True
-        except jinja2.exceptions.TemplateNotFound:
-            logging.error(f"Template {_template_filename} could not be found.")
-            return False
-        except jinja2.exceptions.TemplateSyntaxError as e:
-            logging.error(f'Template {_template_filename} could not be rendered due to syntax error\n'
-                          f'\tProblem: {e}')
-            return False
-        except jinja2.exceptions.UndefinedError as e:
-            logging.error(f'Template {_template_filename} could not be rendered due to syntax error\n'
-                          f'\tProblem: {e}')
-            return False
-        except jinja2.TemplateError as e:
-            logging.error(f'Template {template_filename} could not be rendered\n'
-                          f'\tProblem: {e}')
-            return False
+            limit = int(spec.get('limit', 0))
+            request_concurrency = int(spec.get('request-concurrency', limit or concurrency(charm)))
+        except (TypeError, ValueError):
+            raise ValueError(f'Runner {name} limit and request-concurrency must be numbers')
+        resolved.append({'name': f'{fqdn()}-{name}' if name else fqdn(),
+                         'executor': spec.get('executor', charm.config['executor']),
+                         'tag-list': spec.get('tag-list', charm.config['tag-list']),
+                         'run-untagged': spec.get('run-untagged', charm.config['run-untagged']),
+                         'locked': spec.get('locked', charm.config['locked']),
+                         'limit': limit,
+                         'request-concurrency': request_concurrency,
+                         'docker-image': spec.get('docker-image', charm.config['docker-image'])})
+        if resolved[-1]['executor'] not in ('docker', 'lxd'):
+            raise ValueError(f'Runner {name} has an unsupported executor {resolved[-1]["executor"]}')
+
+    names = [spec['name'] for spec in resolved]
+    if len(set(names)) != len(names):
+        raise ValueError('Runner names must be unique')
+    return resolved
+
 
-    # Render #1 - global runner config
-    template_path = Path('templates/etc/gitlab-runner/')
-    template_filename = 'config.toml'
-    rendered_target_path = Path('/etc/gitlab-runner/config.toml')
-    keywords_to_render = {'concurrent': charm.config['concurrent'],
-                          'checkinterval': charm.config['check-interval'],
-                          'sentrydsn': charm.config['sentry-dsn'],
-                          'loglevel': charm.config['log-level'],
-                          'logformat': charm.config['log-format']}
-    if not _render_templates(template_path,
-                             template_filename,
-                             rendered_target_path,
-                             keywords_to_render):
+def check_runner_specs(charm) -> bool:
+    try:
+        runner_specs(charm)
+    except ValueError as e:
+        logging.error(f'Malformed runners config: {e}')
         return False
+    return True
 
-    if charm.config['executor'] == 'docker':
-        # Render #2 - runner template.
-        template_path = Path('templates/runner-templates/')
-        template_filename = 'docker-1.template'
-        rendered_target_path = Path('/tmp/runner-template-config.toml')
-
-        keywords_to_render = {'docker_image': charm.config['docker-image']}
-        # If tmpfs was defined for Docker executor, render required config.
-        if charm.config['docker-tmpfs'] != '':
-            docker_tmpfs_path, docker_tmpfs_config = charm.config['docker-tmpfs'].split(':')
-            keywords_to_render['docker_tmpfs_path'] = docker_tmpfs_path
-            keywords_to_render['docker_tmpfs_config'] = docker_tmpfs_config
-        # If docker-in-docker is allowed
-        if isinstance(charm.config['docker-in-docker'], bool) and charm.config['docker-in-docker']:
-            keywords_to_render['docker_in_docker'] = True
-
-        if not _render_templates(template_path,
-                                 template_filename,
-                                 rendered_target_path,
-                                 keywords_to_render):
-            return False
 
+def runner_executors(charm) -> list:
+    """
+    Returns: The executors used by the runners of this unit, the executor option first.
+    """
+    executors = [charm.config['executor']]
+    for spec in runner_specs(charm):
+        if spec['executor'] not in executors:
+            executors.append(spec['executor'])
+    return executors
+
+
+def runner_capacity(charm) -> int:
+    """
+    Returns: The number of jobs the runners of this unit run at once, their limits
+    capped by the global concurrent.
+    """
+    concurrent = concurrency(charm)
+    return min(concurrent, sum(spec['limit'] or concurrent for spec in runner_specs(charm)))
+
+
+def lxd_storage_pool(charm):
+    """
+    Returns: (name, driver, config) of the lxd-storage-pool option, written like
+    the arguments of lxc storage create, or None if unset.
+    """
+    words = charm.config['lxd-storage-pool'].split()
+    if not words:
+        return None
+    config = {}
+    for word in words[2:]:
+        key, sep, value = word.partition('=')
+        if not sep:
+            raise ValueError(f'Invalid storage pool setting {word}')
+        config[key] = value
+    return words[0], words[1] if len(words) > 1 else None, config
+
+
+def lxd_pool_size(charm) -> int:
+    """
+    Returns: Number of idle containers to keep per pooled image.
+    A negative lxd-pool-size follows the concurrent setting.
+    """
+    size = charm.config['lxd-pool-size']
+    if size < 0:
+        return max(concurrency(charm), 0)
+    return size
+
+
+def render_lxd_executor_config(charm) -> typing.Optional[bool]:
+    """
+    Renders /etc/default/lxd-executor which is read by the lxd executor on every stage.
+    Returns: Whether it changed, or None if it failed to render.
+    """
+    try:
+        build_tmpfs = ','.join(f'{path}:{size}' for path, size in build_tmpfs_mounts(charm).items())
+    except ValueError as e:
+        logging.error(f'{e}')
+        return None
+    return _render_template(CHARM_DIR.joinpath('templates/etc/default/'),
+                            'lxd-executor',
+                            Path('/etc/default/lxd-executor'),
+                            {'boot_timeout': charm.config['lxd-boot-timeout'],
+                             'cpu_slots': len(lxd_slot_cpus(charm)),
+                             'package_cache': package_cache_url(charm),
+                             'project_cache': str(charm.config['lxd-project-cache']).lower(),
+                             'project_cache_max_size': charm.config['lxd-project-cache-max-size'],
+                             'build_tmpfs': build_tmpfs,
+                             'recycle': str(charm.config['lxd-recycle-containers']).lower(),
+                             'exec_agent': str(charm.config['lxd-exec-agent']).lower(),
+                             'reap_parallelism': charm.config['lxd-reaper-parallelism'],
+                             'reap_max_age': charm.config['lxd-reaper-max-age'],
+                             'pool_size': lxd_pool_size(charm),
+                             'pool_images': charm.config['lxd-pool-images'],
+                             'golden_images': str(charm.config['lxd-golden-images']).lower(),
+                             'golden_max_age': charm.config['lxd-golden-image-max-age'],
+                             'metrics_listen': LXD_METRICS_ADDRESS})
+
+
+def bridge_address(interface) -> str:
+    """
+    Returns: The IPv4 address of the host on a container bridge, or ''.
+    """
+    r = hook_timing.run(['ip', '-4', '-o', 'addr', 'show', 'dev', interface],
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.DEVNULL,
+                        universal_newlines=True)
+    m = re.search(r'inet ([0-9.]+)/', r.stdout)
+    return m.group(1) if m else ''
+
+
+def package_cache_url(charm) -> str:
+    """
+    Returns: The package cache url as seen from job containers of the executor
+    option, '' when disabled. It listens on that executor's bridge only.
+    """
+    if not charm.config['package-cache']:
+        return ''
+    bridge = lxd_executor.NETWORK if charm.config['executor'] == 'lxd' else 'docker0'
+    address = bridge_address(bridge)
+    if not address:
+        logging.warning(f'No address on {bridge}, package cache disabled.')
+        return ''
+    return f'http://{address}:{PACKAGE_CACHE_PORT}'
+
+
+def job_proxies(charm, executor=None):
+    """
+    Returns: (http_proxy, https_proxy) for jobs of executor. Plain http goes through
+    the package cache when enabled, which forwards to the http_proxy option.
+    """
+    cache = package_cache_url(charm) if executor in (None, charm.config['executor']) else ''
+    http_proxy = cache or charm.config['http_proxy']
+    return http_proxy or None, charm.config['https_proxy'] or None
+
+
+def render_package_cache_config(charm) -> bool:
+    """
+    Renders /etc/default/package-cache and restarts the cache if it changed.
+    """
+    target = Path('/etc/default/package-cache')
+    installed = target.exists()
+    cache = urllib.parse.urlsplit(package_cache_url(charm))
+    changed = _render_template(CHARM_DIR.joinpath('templates/etc/default/'),
+                               'package-cache',
+                               target,
+                               {'listen': cache.netloc,
+                                'cache_dir': PACKAGE_CACHE_DIR,
+                                'max_size': charm.config['package-cache-max-size'],
+                                'ttl': 3600,
+                                'metrics_listen': f':{METRICS_PORT}',
+                                'runner_metrics': f'http://{RUNNER_METRICS_ADDRESS}/metrics',
+                                'lxd_metrics': f'http://{LXD_METRICS_ADDRESS}/metrics',
+                                'hook_metrics': hook_timing.HOOK_METRICS,
+                                'http_proxy': charm.config['http_proxy'],
+                                'https_proxy': charm.config['https_proxy']})
+    if changed is None:
+        return False
+    if changed and installed:
+        hook_timing.run(['systemctl', 'restart', 'package-cache.service'])
     return True
 
 
-def register_docker(charm, https_proxy=None, http_proxy=None) -> bool:
+def host_resources():
+    """
+    Returns: (cores, memory in MB) of this host.
+    """
+    memory = 0
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                memory = int(line.split()[1]) // 1024
+    return os.cpu_count() or 1, memory
 
-    # Render Gitlab runner templates
-    if not _render_runner_templates(charm):
+
+def host_free_disk(path='/var/lib') -> int:
+    """
+    Returns: The free disk space in MB where docker and lxd keep their data.
+    """
+    return shutil.disk_usage(path).free // 1024 // 1024
+
+
+def concurrency(charm) -> int:
+    """
+    Returns: The number of concurrent jobs. A negative concurrent runs as many jobs
+    as the host has cores, memory and free disk for, at least 1.
+    """
+    if charm.config['concurrent'] >= 0:
+        return charm.config['concurrent']
+    cores, memory = host_resources()
+    return max(min(cores,
+                   (memory - AUTO_HOST_MEMORY) // AUTO_JOB_MEMORY,
+                   host_free_disk() // AUTO_JOB_DISK), 1)
+
+
+def job_limits(charm) -> dict:
+    """
+    Returns: The cpus and memory (MB) of each job when concurrent is sized
+    automatically, their equal share of the host. Empty otherwise.
+    """
+    if charm.config['concurrent'] >= 0:
+        return {}
+    cores, memory = host_resources()
+    concurrent = concurrency(charm)
+    return {'cpus': round(cores / concurrent, 1),
+            'memory': max((memory - AUTO_HOST_MEMORY) // concurrent, 256)}
+
+
+def lxd_slot_cpus(charm) -> list:
+    """
+    Returns: The pinned cores of each concurrency slot as limits.cpu ranges,
+    empty unless lxd-resource-limits is 'pinned'.
+    """
+    if charm.config['lxd-resource-limits'] != 'pinned':
+        return []
+    cores, _ = host_resources()
+    concurrent = max(concurrency(charm), 1)
+    share = max(cores // concurrent, 1)
+    slots = []
+    for slot in range(concurrent):
+        first = (slot * share) % cores
+        last = min(first + share, cores) - 1
+        slots.append(f'{first}-{last}' if last > first else f'{first}')
+    return slots
+
+
+def lxd_profile_config(charm) -> dict:
+    """
+    Returns: Config of the gitlab job profile, the charm lxd-profile.yaml plus an
+    equal share of host cores and memory per concurrent job when enabled.
+    """
+    with open(CHARM_DIR.joinpath('lxd-profile.yaml')) as f:
+        config = {k: str(v).lower() if isinstance(v, bool) else str(v)
+                  for k, v in yaml.safe_load(f)['config'].items()}
+
+    limits = charm.config['lxd-resource-limits']
+    if limits in ('auto', 'pinned'):
+        cores, memory = host_resources()
+        concurrent = max(concurrency(charm), 1)
+        config['limits.memory'] = f'{max(memory // concurrent, 256)}MB'
+        if limits == 'auto':
+            config['limits.cpu'] = str(max(cores // concurrent, 1))
+    elif limits:
+        logging.warning(f'Unsupported lxd-resource-limits {limits}, no limits set.')
+    return config
+
+
+def configure_lxd(charm) -> bool:
+    """
+    Converges the gitlab job profile, the per slot pinning profiles, the build
+    storage pool and the lxdbr0 network once, instead of on every job.
+    """
+    client = lxd_executor.LXDClient()
+    try:
+        client.update_network(lxd_executor.NETWORK, lxd_executor.NETWORK_CONFIG)
+        devices = {}
+        pool = lxd_storage_pool(charm)
+        if pool:
+            name, driver, config = pool
+            if client.storage_pool(name) is None:
+                if not driver:
+                    raise lxd_executor.LXDError(f'Storage pool {name} does not exist, '
+                                                f'and no driver is configured to create it')
+                client.create_storage_pool(name, driver, config)
+            # Job containers get their root disk, and so /builds, on the dedicated pool.
+            devices['root'] = {'type': 'disk', 'path': '/', 'pool': name}
+        client.set_profile(lxd_executor.PROFILE, lxd_profile_config(charm),
+                           'gitlab-runner job containers (Deployed by Juju)', devices)
+        for slot, cpus in enumerate(lxd_slot_cpus(charm)):
+            client.set_profile(f'{lxd_executor.PROFILE}-slot-{slot}', {'limits.cpu': cpus},
+                               f'gitlab-runner concurrency slot {slot} (Deployed by Juju)')
+        return True
+    except (lxd_executor.LXDError, OSError, ValueError) as e:
+        logging.error(f'Failed to configure LXD for the lxd executor: {e}')
         return False
+    finally:
+        client.close()
 
-    hostname_fqdn = socket.getfqdn()
-    gitlab_server = charm.config['gitlab-server']
-    gitlab_registration_token = charm.config['gitlab-registration-token']
-    tag_list = charm.config['tag-list']
-    concurrent = charm.config['concurrent']
-    run_untagged = charm.config['run-untagged']
-    locked = charm.config['locked']
-    proxyenv = ""
 
-    cmd = ["gitlab-runner", "register",
-           "--non-interactive",
-           "--config", "/etc/gitlab-runner/config.toml",
-           "--template-config", "/tmp/runner-template-config.toml",
-           "--name", f"{hostname_fqdn}",
-           "--url", f"{gitlab_server}",
-           "--registration-token", f"{gitlab_registration_token}",
-           "--request-concurrency", f"{concurrent}",
-           f"--run-untagged={run_untagged}",
-           f"--locked={locked}",
-           "--executor", "docker",
-           f"{proxyenv}"]
-
-    if not run_untagged and tag_list != "":
-        cmd.extend(["--tag-list", "{tag-list}"])
-    if run_untagged and tag_list != "":
-        logging.warning('Conflicting configuration, run-untagged=True and tag_list are mutually exclusive. \
-        Skipping tag-list.')
+def refill_lxd_pool():
+    """
+    Refills the warm pool in the background right away, instead of on the next
+    tick of its timer.
+    """
+    hook_timing.run(['systemctl', 'start', '--no-block', 'lxd-executor-pool.service'])
+
 
-    logging.info("Executing registration call for gitlab-runner with Docker executor")
-    process = subprocess.Popen(cmd)
+def expire_golden_images():
+    """
+    Removes the golden image stamps so the next job per image rebuilds it.
+    """
+    for stamp in glob.glob(f'{LXD_EXECUTOR_STATE}/golden/*'):
+        if not stamp.endswith('.lock'):
+            Path(stamp).unlink()
+
+
+def lxd_reaper_backlog() -> int:
+    """
+    Returns: Number of job containers waiting for the lxd executor reaper.
+    """
     try:
-        std_out, std_err = process.communicate(timeout=30)
-        if std_out:
-            logging.info(std_out)
-        if std_err:
-            logging.error(std_err)
-    except subprocess.TimeoutExpired:
-        process.kill()
-        logging.error('Registration of gitlab-runner timed out and failed')
+        with open(f'{LXD_EXECUTOR_STATE}/reaper.json') as f:
+            return json.load(f)['backlog']
+    except (OSError, ValueError, KeyError):
+        return 0
+
+
+@functools.lru_cache(maxsize=None)
+def fqdn() -> str:
+    """
+    Returns: The FQDN of this host, looked up once per hook.
+    """
+    return socket.getfqdn()
+
+
+def gitlab_runner_registered_already(names=None) -> bool:
+    """
+    Returns: True if the named runners, by default the one named after the FQDN,
+    are all in config.toml and verify with the GitLab server.
+    """
+    names = names or [fqdn()]
+    try:
+        live = runner_names()
+    except OSError:
+        return False
+    if any(name not in live for name in names):
         return False
+    return all(hook_timing.run(['gitlab-runner', 'verify', '-n', name]).returncode == 0
+               for name in names)
 
-    logging.info(f'Registration of Docker executor finished with exit code: {process.returncode}')
-    return process.returncode == 0
 
+@functools.lru_cache(maxsize=None)
+def _environment(template_path: str) -> jinja2.Environment:
+    """
+    Returns: The jinja environment of a template directory. It keeps the compiled
+    templates for the whole hook, templates don't change while it runs.
+    """
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(template_path,),
+        undefined=jinja2.StrictUndefined,
+        auto_reload=False
+    )
 
-def register_lxd(charm, https_proxy=None, http_proxy=None) -> bool:
 
-    # Render Gitlab runner templates
-    if not _render_runner_templates(charm):
+def _render(template_path: pathlib.Path, template_filename: str, keywords) -> str:
+    # Load template
+    template = _environment(str(template_path)).get_template(template_filename)
+    # Redner template
+    return template.render(keywords)
+
+
+def _render_template(template_path: pathlib.Path,
+                     template_filename: str,
+                     rendered_target_path: pathlib.Path,
+                     keywords) -> typing.Optional[bool]:
+    """
+    Returns: True if the target was written, False if it already had the rendered
+    content, so gitlab-runner and services watching it see no change, and None if
+    the template failed to render.
+    """
+    try:
+        rendered_template = _render(template_path, template_filename, keywords)
+    except jinja2.exceptions.TemplateNotFound:
+        logging.error(f"Template {template_filename} could not be found.")
+        return None
+    except jinja2.exceptions.TemplateSyntaxError as e:
+        logging.error(f'Template {template_filename} could not be rendered due to syntax error\n'
+                      f'\tProblem: {e}')
+        return None
+    except jinja2.exceptions.UndefinedError as e:
+        logging.error(f'Template {template_filename} could not be rendered due to syntax error\n'
+                      f'\tProblem: {e}')
+        return None
+    except jinja2.TemplateError as e:
+        logging.error(f'Template {template_filename} could not be rendered\n'
+                      f'\tProblem: {e}')
+        return None
+
+    rendered = rendered_template.encode()
+    try:
+        current = hashlib.sha256(rendered_target_path.read_bytes()).digest()
+    except FileNotFoundError:
+        current = None
+    if current == hashlib.sha256(rendered).digest():
+        return False
+    rendered_target_path.write_text(rendered_template)
+    return True
+
+
+def _global_keywords(charm) -> dict:
+    return {'concurrent': concurrency(charm),
+            'checkinterval': charm.config['check-interval'],
+            'sentrydsn': charm.config['sentry-dsn'],
+            'loglevel': charm.config['log-level'],
+            'logformat': charm.config['log-format'],
+            'listen_address': RUNNER_METRICS_ADDRESS}
+
+
+def _docker_keywords(charm, spec=None) -> dict:
+    spec = spec or runner_specs(charm)[0]
+    limits = job_limits(charm)
+    keywords_to_render = {'docker_image': spec['docker-image'],
+                          'docker_volume_driver': charm.config['docker-volume-driver'],
+                          'docker_pull_policy': json.dumps(docker_pull_policy(charm)),
+                          'docker_cpus': limits.get('cpus', ''),
+                          'docker_memory': limits.get('memory', ''),
+                          # /dev/shm gets a quarter of the job memory, up to 2GB.
+                          'docker_shm_size': min(limits.get('memory', 0) // 4, 2048) * 1024 * 1024}
+    # Build tmpfs mounts, and the tmpfs defined for Docker executor, render required config.
+    docker_tmpfs = {path: f'rw,exec,size={size}m'
+                    for path, size in build_tmpfs_mounts(charm).items()}
+    if charm.config['docker-tmpfs'] != '':
+        docker_tmpfs_path, docker_tmpfs_config = charm.config['docker-tmpfs'].split(':')
+        docker_tmpfs[docker_tmpfs_path] = docker_tmpfs_config
+    keywords_to_render['docker_tmpfs'] = docker_tmpfs
+    # If docker-in-docker is allowed
+    if isinstance(charm.config['docker-in-docker'], bool) and charm.config['docker-in-docker']:
+        keywords_to_render['docker_in_docker'] = True
+    return keywords_to_render
+
+
+def render_runner_templates(charm, cache=None):
+    """
+    Returns: Whether any of the rendered files changed, None if one failed to render,
+    or REGISTER_AGAIN from reconcile_config.
+    """
+    # Render #1 - global runner config. Once a runner is registered config.toml holds
+    # the runners and their tokens, so the globals are patched in place instead.
+    try:
+        live = _live_runners()
+    except (OSError, toml.TomlDecodeError):
+        live = []
+    reconciled = None
+    if live:
+        reconciled = reconcile_config(charm, cache)
+        if reconciled is None:
+            return None
+        changed = bool(reconciled)
+    else:
+        template_path = CHARM_DIR.joinpath('templates/etc/gitlab-runner/')
+        template_filename = 'config.toml'
+        rendered_target_path = Path(RUNNER_CONFIG)
+        changed = _render_template(template_path,
+                                   template_filename,
+                                   rendered_target_path,
+                                   _global_keywords(charm))
+        if changed is None:
+            return None
+
+    if 'lxd' in runner_executors(charm):
+        # Render #2 - lxd executor settings.
+        rendered = render_lxd_executor_config(charm)
+        if rendered is None:
+            return None
+        changed |= rendered
+
+    return REGISTER_AGAIN if reconciled is REGISTER_AGAIN else changed
+
+
+def _render_docker_template(charm, spec) -> bool:
+    """
+    Renders the register template of a docker runner.
+    Returns: False if it failed to render.
+    """
+    try:
+        keywords = _docker_keywords(charm, spec)
+    except ValueError as e:
+        logging.error(f'{e}')
         return False
+    return _render_template(CHARM_DIR.joinpath('templates/runner-templates/'),
+                            'docker-1.template',
+                            Path('/tmp/runner-template-config.toml'),
+                            keywords) is not None
+
+
+def _proxy_env(http_proxy, https_proxy, no_proxy='') -> list:
+    """
+    Returns: register arguments setting the proxies in the job environment, and the
+    no_proxy hosts reached without them when there are any.
+    """
+    env = []
+    no_proxy = no_proxy if http_proxy or https_proxy else ''
+    for key, value in (('http_proxy', http_proxy), ('https_proxy', https_proxy), ('no_proxy', no_proxy)):
+        if value:
+            env.extend(['--env', f'{key}={value}', '--env', f'{key.upper()}={value}'])
+    return env
+
+
+LXD_RUNNER = {'executor': 'custom',
+              'builds_dir': '/builds',
+              'cache_dir': '/cache',
+              'custom': {'prepare_exec': '/opt/lxd-executor/prepare.sh',
+                         'run_exec': '/opt/lxd-executor/run.sh',
+                         'cleanup_exec': '/opt/lxd-executor/cleanup.sh'}}
+
+
+def desired_runner(charm, spec, cache=None) -> dict:
+    """
+    Returns: The config.toml [[runners]] settings of the runner spec, using the
+    shared cache endpoint cache.
+    """
+    if spec['executor'] == 'docker':
+        runner = toml.loads(_render(CHARM_DIR.joinpath('templates/runner-templates/'), 'docker-1.template',
+                                    _docker_keywords(charm, spec)))['runners'][0]
+        runner['executor'] = 'docker'
+    else:
+        runner = json.loads(json.dumps(LXD_RUNNER))
+    runner['name'] = spec['name']
+    runner['url'] = charm.config['gitlab-server']
+    runner['limit'] = spec['limit']
+    runner['request_concurrency'] = spec['request-concurrency']
+    runner['environment'] = _proxy_env(*job_proxies(charm, spec['executor']), job_no_proxy(charm, cache))[1::2]
+    runner['cache'] = runner_cache(cache)
+    return runner
 
-    hostname_fqdn = socket.getfqdn()
-    gitlab_server = charm.config['gitlab-server']
-    gitlab_registration_token = charm.config['gitlab-registration-token']
-    tag_list = charm.config['tag-list']
-    concurrent = charm.config['concurrent']
-    run_untagged = charm.config['run-untagged']
-    locked = charm.config['locked']
-    proxyenv = ""
 
+def desired_config(charm, cache=None) -> dict:
+    """
+    Returns: The config.toml settings the charm config maps to, with one entry
+    in runners per runner spec.
+    """
+    config = toml.loads(_render(CHARM_DIR.joinpath('templates/etc/gitlab-runner/'), 'config.toml',
+                                _global_keywords(charm)))
+    config['runners'] = [desired_runner(charm, spec, cache) for spec in runner_specs(charm)]
+    return config
+
+
+def _empty(value) -> bool:
+    return value in ([], {}, '') or isinstance(value, dict) and all(_empty(v) for v in value.values())
+
+
+# Tables of config.toml the charm renders in full. Keys of them it no longer renders,
+# e.g. a cleared pull_policy or tmpfs, are dropped.
+OWNED_TABLES = ('runners.docker.', 'runners.cache.')
+
+
+def _patch(live: dict, desired: dict, prefix: str, changed: list):
+    for key, value in desired.items():
+        if isinstance(value, dict) and isinstance(live.get(key), dict):
+            _patch(live[key], value, f'{prefix}{key}.', changed)
+        elif live.get(key) != value and (key in live or not _empty(value)):
+            live[key] = value
+            changed.append(f'{prefix}{key}')
+    if prefix == '' or prefix.startswith(OWNED_TABLES):
+        # The runners are matched by name, and tables left empty hold no setting.
+        for key in [key for key in live if key not in desired and key != 'runners' and not _empty(live[key])]:
+            del live[key]
+            changed.append(f'{prefix}{key}')
+
+
+# Returned by reconcile_config when the runners have to be registered again.
+REGISTER_AGAIN = object()
+
+
+def reconcile_config(charm, cache=None):
+    """
+    Patches the keys of the live config.toml that differ from the charm config and
+    the shared cache endpoint cache in place, with an atomic write that
+    gitlab-runner reloads on its own.
+    Returns: The changed keys, None if the config failed to render, or REGISTER_AGAIN
+    if no runner is there or the identity (url or executor) of one changed.
+    """
+    try:
+        desired = desired_config(charm, cache)
+    except (jinja2.TemplateError, toml.TomlDecodeError, ValueError) as e:
+        logging.error(f'Failed to render the desired runner config: {e}')
+        return None
+    try:
+        with open(RUNNER_CONFIG) as f:
+            live = toml.load(f)
+    except FileNotFoundError:
+        return REGISTER_AGAIN
+
+    runners = {r.get('name'): r for r in live.get('runners', [])}
+    matched = [(runners[wanted['name']], wanted) for wanted in desired.pop('runners')
+               if wanted['name'] in runners]
+    if not matched or any(runner.get(key) != wanted[key]
+                          for runner, wanted in matched for key in ('url', 'executor')):
+        return REGISTER_AGAIN
+
+    # Runners missing from config.toml are registered, extra ones unregistered, by the charm.
+    changed = []
+    _patch(live, desired, '', changed)
+    for runner, wanted in matched:
+        _patch(runner, wanted, 'runners.', changed)
+    if changed:
+        tmp = f'{RUNNER_CONFIG}.tmp'
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            toml.dump(live, f)
+        os.rename(tmp, RUNNER_CONFIG)
+        logging.info(f'Patched {", ".join(changed)} in {RUNNER_CONFIG}')
+    return changed
+
+
+def _register(spec, charm, executor_args: list, https_proxy=None, http_proxy=None, cache=None) -> bool:
     cmd = ["gitlab-runner", "register",
            "--non-interactive",
-           "--config", "/etc/gitlab-runner/config.toml",
-           "--name", f"{hostname_fqdn}",
-           "--url", f"{gitlab_server}",
-           "--registration-token", f"{gitlab_registration_token}",
-           "--request-concurrency", f"{concurrent}",
-           f"--run-untagged={run_untagged}",
-           f"--locked={locked}",
-           "--executor", "custom",
-           "--builds-dir", "/builds ",
-           "--cache-dir", "/cache",
-           "--custom-run-exec", "/opt/lxd-executor/run.sh",
-           "--custom-prepare-exec", "/opt/lxd-executor/prepare.sh",
-           "--custom-cleanup-exec", "/opt/lxd-executor/cleanup.sh",
-           f"{proxyenv}"]
-
-    if not run_untagged and tag_list != "":
-        cmd.extend(["--tag-list", "{tag-list}"])
-    if run_untagged and tag_list != "":
+           "--config", RUNNER_CONFIG,
+           "--name", spec['name'],
+           "--url", f"{charm.config['gitlab-server']}",
+           "--registration-token", f"{charm.config['gitlab-registration-token']}",
+           "--request-concurrency", f"{spec['request-concurrency']}",
+           f"--run-untagged={spec['run-untagged']}",
+           f"--locked={spec['locked']}"]
+    if spec['limit']:
+        cmd.extend(["--limit", f"{spec['limit']}"])
+    cmd.extend(executor_args)
+    cmd.extend(_cache_args(cache))
+    cmd.extend(_proxy_env(http_proxy, https_proxy, job_no_proxy(charm, cache)))
+
+    if not spec['run-untagged'] and spec['tag-list'] != "":
+        cmd.extend(["--tag-list", spec['tag-list']])
+    if spec['run-untagged'] and spec['tag-list'] != "":
         logging.warning('Conflicting configuration, run-untagged=True and tag_list are mutually exclusive. \
         Skipping tag-list.')
 
-    logging.info("Executing registration call for gitlab-runner with lxd executor")
-    process = subprocess.Popen(cmd)
+    logging.info(f"Executing registration call for gitlab-runner {spec['name']} with {spec['executor']} executor")
+    process = hook_timing.Popen(cmd)
     try:
         std_out, std_err = process.communicate(timeout=30)
         if std_out:
@@ -237,25 +1280,142 @@ def register_lxd(charm, https_proxy=None, http_proxy=None) -> bool:
         logging.error('Registration of gitlab-runner timed out and failed')
         return False
 
-    logging.info(f'Registration of lxd executor finished with exit code: {process.returncode}')
+    logging.info(f'Registration of {spec["executor"]} executor finished with exit code: {process.returncode}')
     return process.returncode == 0
 
 
-def get_token() -> str:
+def register_docker(charm, spec=None, https_proxy=None, http_proxy=None, cache=None) -> bool:
     """
-    Returns: The 8 first chars of the token
+    Registers the docker runner spec, by default the first one of the unit, using
+    the shared cache endpoint cache.
     """
-    with open('/etc/gitlab-runner/config.toml') as f:
-        try:
+    spec = spec or runner_specs(charm)[0]
+    # Render Gitlab runner templates
+    if render_runner_templates(charm, cache) is None or not _render_docker_template(charm, spec):
+        return False
+
+    return _register(spec, charm,
+                     ["--template-config", "/tmp/runner-template-config.toml",
+                      "--executor", "docker"],
+                     https_proxy=https_proxy, http_proxy=http_proxy, cache=cache)
+
+
+def register_lxd(charm, spec=None, https_proxy=None, http_proxy=None, cache=None) -> bool:
+    """
+    Registers the lxd runner spec, by default the first one of the unit, using
+    the shared cache endpoint cache.
+    """
+    spec = spec or runner_specs(charm)[0]
+    # Render Gitlab runner templates
+    if render_runner_templates(charm, cache) is None:
+        return False
+
+    return _register(spec, charm,
+                     ["--executor", "custom",
+                      "--builds-dir", LXD_RUNNER['builds_dir'],
+                      "--cache-dir", LXD_RUNNER['cache_dir'],
+                      "--custom-run-exec", LXD_RUNNER['custom']['run_exec'],
+                      "--custom-prepare-exec", LXD_RUNNER['custom']['prepare_exec'],
+                      "--custom-cleanup-exec", LXD_RUNNER['custom']['cleanup_exec']],
+                     https_proxy=https_proxy, http_proxy=http_proxy, cache=cache)
+
+
+_runners_cache = {}
+
+
+def _live_runners() -> list:
+    """
+    Returns: (name, token) of the runners in config.toml, parsed again only when it changed.
+    """
+    mtime = os.stat(RUNNER_CONFIG).st_mtime_ns
+    if _runners_cache.get('mtime') != mtime:
+        with open(RUNNER_CONFIG) as f:
             data = toml.load(f)
-            return data['runners'][0]['token'][0:8]
-        except KeyError as e:
-            return str(e)
+        runners = [(r.get('name', ''), r.get('token', '')) for r in data.get('runners', [])]
+        _runners_cache.update(mtime=mtime, runners=runners)
+    return _runners_cache['runners']
+
+
+def get_token() -> str:
+    """
+    Returns: The 8 first chars of the runner tokens, comma separated.
+    """
+    return ','.join(token[0:8] for _, token in _live_runners())
+
+
+def runner_names() -> list:
+    """
+    Returns: The names of the runners in config.toml.
+    """
+    return [name for name, _ in _live_runners()]
+
+
+def _runner_metrics(address) -> typing.Optional[str]:
+    """
+    Returns: The metrics gitlab-runner serves on address, or None if it does not.
+    """
+    host, port = address.rsplit(':', 1)
+    connection = http.client.HTTPConnection(host, int(port), timeout=5)
+    try:
+        connection.request('GET', '/metrics')
+        text = connection.getresponse().read().decode()
+    except OSError:
+        return None
+    finally:
+        connection.close()
+    # The package cache answers on the legacy address without a runner behind it.
+    return text if 'gitlab_runner_version_info' in text else None
 
 
-def unregister() -> bool:
-    hostname_fqdn = socket.getfqdn()
-    cmd = f"gitlab-runner unregister -n {hostname_fqdn} --all-runners"
-    cp = subprocess.run(cmd.split())
+def running_jobs() -> typing.Optional[int]:
+    """
+    Returns: Number of jobs gitlab-runner is running, summed from its gitlab_runner_jobs
+    gauge. 0 when gitlab-runner is not running, None when it runs without serving
+    its metrics, e.g. still on the listen address of an older unit file.
+    """
+    for address in (RUNNER_METRICS_ADDRESS, LEGACY_RUNNER_METRICS_ADDRESS):
+        text = _runner_metrics(address)
+        if text is not None:
+            break
+    else:
+        active = hook_timing.run(['systemctl', 'is-active', '--quiet', 'gitlab-runner.service'])
+        return None if active.returncode == 0 else 0
+    jobs = 0
+    for line in text.splitlines():
+        if re.match(r'gitlab_runner_jobs[{ ]', line):
+            jobs += int(float(line.rsplit(None, 1)[1]))
+    return jobs
+
+
+def drain(timeout: int, progress: typing.Callable[[typing.Optional[int]], None] = None) -> typing.Optional[int]:
+    """
+    Stops gitlab-runner from requesting new jobs with a graceful shutdown (SIGQUIT)
+    and waits up to timeout seconds for the running jobs to finish. gitlab-runner
+    exits once drained, callers restart it when it should keep running. An unknown
+    number of jobs is waited for like running ones.
+    Returns: Number of jobs still running when the deadline passed, None if unknown.
+    """
+    hook_timing.run(['systemctl', 'kill', '--kill-who=main', '--signal=SIGQUIT',
+                    'gitlab-runner.service'])
+    deadline = time.monotonic() + timeout
+    jobs = running_jobs()
+    while jobs != 0 and time.monotonic() < deadline:
+        logging.info(f"Draining gitlab-runner, {'unknown' if jobs is None else jobs} jobs left.")
+        if progress:
+            progress(jobs)
+        time.sleep(DRAIN_POLL)
+        jobs = running_jobs()
+    return jobs
+
+
+def unregister(name=None) -> bool:
+    """
+    Unregisters the named runner, all runners without a name.
+    """
+    if name:
+        cmd = ['gitlab-runner', 'unregister', '-n', name]
+    else:
+        cmd = ['gitlab-runner', 'unregister', '--all-runners']
+    cp = hook_timing.run(cmd)
     logging.debug(cp.stdout)
     return cp.returncode == 0
@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+"""Wall time of the charm hooks and of the subprocesses they run."""
+
+import contextlib
+import functools
+import json
+import logging
+import os
+import subprocess
+import time
+
+from ops.framework import EventBase
+
+logger = logging.getLogger(__name__)
+
+# Totals per hook and command over all hooks, and the prometheus text of them
+# appended to the scrape endpoint by the package cache.
+HOOK_TIMINGS = '/var/lib/gitlab-runner-charm/hook-timings.json'
+HOOK_METRICS = '/var/lib/gitlab-runner-charm/hook-metrics.prom'
+
+# The measured hooks, innermost last. Only the outermost one is reported.
+_active = []
+# The hooks measured by this process, newest last.
+completed = []
+
+
+class HookTiming:
+    """The duration of one hook and the subprocesses it ran."""
+
+    def __init__(self, hook):
+        self.hook = hook
+        self.started = time.monotonic()
+        self.seconds = 0.0
+        # (command, seconds, returncode)
+        self.calls = []
+        # (started, ended) of the calls
+        self.intervals = []
+
+    @property
+    def subprocess_seconds(self) -> float:
+        """Wall time with subprocesses running, concurrent ones counted once."""
+        seconds = 0.0
+        covered = float('-inf')
+        for started, ended in sorted(self.intervals):
+            seconds += max(ended - max(started, covered), 0.0)
+            covered = max(covered, ended)
+        return seconds
+
+    def as_dict(self) -> dict:
+        slowest = sorted(self.calls, key=lambda call: call[1], reverse=True)[:5]
+        return {'hook': self.hook,
+                'seconds': round(self.seconds, 3),
+                'subprocesses': len(self.calls),
+                'subprocess_seconds': round(self.subprocess_seconds, 3),
+                'slowest': [[command, round(seconds, 3)] for command, seconds, _ in slowest]}
+
+
+def command_name(args) -> str:
+    """
+    Returns: The program args runs, looking through sudo and its options.
+    """
+    words = args.split() if isinstance(args, str) else [str(arg) for arg in args]
+    for word in words:
+        if word != 'sudo' and not word.startswith('-'):
+            return os.path.basename(word)
+    return ''
+
+
+def _record(command, started, returncode):
+    """Adds a subprocess that ran from started until now to the measured hooks."""
+    ended = time.monotonic()
+    for timing in _active:
+        timing.calls.append((command, ended - started, returncode))
+        timing.intervals.append((started, ended))
+
+
+def run(*args, **kwargs) -> subprocess.CompletedProcess:
+    """
+    subprocess.run for the commands of the charm, recorded in the measured hooks.
+    The hook tools ops runs itself are left out.
+    """
+    command = command_name(args[0] if args else kwargs.get('args', ''))
+    started = time.monotonic()
+    try:
+        result = subprocess.run(*args, **kwargs)
+    except subprocess.TimeoutExpired:
+        _record(command, started, None)
+        raise
+    _record(command, started, result.returncode)
+    return result
+
+
+def Popen(*args, **kwargs) -> subprocess.Popen:
+    """
+    subprocess.Popen for the commands of the charm, recorded in the measured hooks
+    once waited for, which communicate always does.
+    """
+    command = command_name(args[0] if args else kwargs.get('args', ''))
+    started = time.monotonic()
+    process = subprocess.Popen(*args, **kwargs)
+    wait = process.wait
+    recorded = []
+
+    def timed_wait(*wait_args, **wait_kwargs):
+        try:
+            return wait(*wait_args, **wait_kwargs)
+        finally:
+            if process.returncode is not None and not recorded:
+                recorded.append(True)
+                _record(command, started, process.returncode)
+    process.wait = timed_wait
+    return process
+
+
+@contextlib.contextmanager
+def measure(hook):
+    """Times the block as hook, with every subprocess run through run and Popen in it."""
+    timing = HookTiming(hook)
+    _active.append(timing)
+    try:
+        yield timing
+    finally:
+        _active.remove(timing)
+        timing.seconds = time.monotonic() - timing.started
+        completed.append(timing)
+        report(timing)
+
+
+def timed(handler):
+    """
+    Measures an event handler of the charm. Handlers called from another
+    handler count towards the hook that called them.
+    """
+    @functools.wraps(handler)
+    def wrapper(charm, event):
+        if _active:
+            return handler(charm, event)
+        if isinstance(event, EventBase):
+            hook = event.handle.kind
+        else:
+            hook = handler.__name__[len('_on_'):]
+        with measure(hook):
+            return handler(charm, event)
+    return wrapper
+
+
+def report(timing):
+    """Logs timing and adds it to the totals served as metrics."""
+    logger.info(f"Hook {timing.hook} took {timing.seconds:.3f}s, "
+                f"{len(timing.calls)} subprocesses {timing.subprocess_seconds:.3f}s")
+    logger.info(f"hook-timing {json.dumps(timing.as_dict(), sort_keys=True)}")
+    try:
+        os.makedirs(os.path.dirname(HOOK_TIMINGS), exist_ok=True)
+        try:
+            with open(HOOK_TIMINGS) as f:
+                totals = json.load(f)
+        except (FileNotFoundError, ValueError):
+            totals = {}
+        hook = totals.setdefault('hooks', {}).setdefault(
+            timing.hook, {'count': 0, 'seconds': 0.0, 'last': 0.0, 'subprocesses': 0})
+        hook['count'] += 1
+        hook['seconds'] += timing.seconds
+        hook['last'] = timing.seconds
+        hook['subprocesses'] += len(timing.calls)
+        for command, seconds, _ in timing.calls:
+            entry = totals.setdefault('commands', {}).setdefault(command, {'count': 0, 'seconds': 0.0})
+            entry['count'] += 1
+            entry['seconds'] += seconds
+        _write(HOOK_TIMINGS, json.dumps(totals, sort_keys=True))
+        _write(HOOK_METRICS, render(totals))
+    except OSError as e:
+        # Timings never fail a hook.
+        logger.debug(f"Failed to record hook timings: {e}")
+
+
+def render(totals) -> str:
+    """
+    Returns: The hook totals in the prometheus text format.
+    """
+    hooks = sorted(totals.get('hooks', {}).items())
+    commands = sorted(totals.get('commands', {}).items())
+    lines = ['# HELP gitlab_runner_charm_hook_duration_seconds Wall time of charm hooks.',
+             '# TYPE gitlab_runner_charm_hook_duration_seconds summary']
+    for name, hook in hooks:
+        lines.append(f'gitlab_runner_charm_hook_duration_seconds_sum{{hook="{name}"}} {hook["seconds"]:.3f}')
+        lines.append(f'gitlab_runner_charm_hook_duration_seconds_count{{hook="{name}"}} {hook["count"]}')
+    lines += ['# HELP gitlab_runner_charm_hook_last_duration_seconds Wall time of the last run of charm hooks.',
+              '# TYPE gitlab_runner_charm_hook_last_duration_seconds gauge']
+    for name, hook in hooks:
+        lines.append(f'gitlab_runner_charm_hook_last_duration_seconds{{hook="{name}"}} {hook["last"]:.3f}')
+    lines += ['# HELP gitlab_runner_charm_hook_subprocesses_total Subprocesses run by charm hooks.',
+              '# TYPE gitlab_runner_charm_hook_subprocesses_total counter']
+    for name, hook in hooks:
+        lines.append(f'gitlab_runner_charm_hook_subprocesses_total{{hook="{name}"}} {hook["subprocesses"]}')
+    lines += ['# HELP gitlab_runner_charm_subprocess_seconds Wall time of subprocesses run by charm hooks.',
+              '# TYPE gitlab_runner_charm_subprocess_seconds summary']
+    for name, command in commands:
+        lines.append(f'gitlab_runner_charm_subprocess_seconds_sum{{command="{name}"}} {command["seconds"]:.3f}')
+        lines.append(f'gitlab_runner_charm_subprocess_seconds_count{{command="{name}"}} {command["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def _write(path, content):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(content)
+    os.replace(tmp, path)
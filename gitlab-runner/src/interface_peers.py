@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+"""gitlab-runner peer interface."""
+
+from ops.framework import Object
+
+
+class RunnerPeers(Object):
+    """Shares site wide endpoints of the leader with all units through the application data."""
+
+    def __init__(self, charm, relation_name):
+        super().__init__(charm, relation_name)
+        self._relation_name = relation_name
+
+    @property
+    def relation(self):
+        return self.model.get_relation(self._relation_name)
+
+    def get(self, key) -> str:
+        """
+        Returns: The value the leader published for key, '' when there is none.
+        """
+        if self.relation is None:
+            return ''
+        return self.relation.data[self.model.app].get(key, '')
+
+    def publish(self, key, value) -> bool:
+        """
+        Publishes value for key to all units, only the leader can.
+        Returns: True if published.
+        """
+        if self.relation is None or not self.model.unit.is_leader():
+            return False
+        if self.relation.data[self.model.app].get(key, '') != value:
+            self.relation.data[self.model.app][key] = value
+        return True
+
+    def address(self) -> str:
+        """
+        Returns: The address other units reach this unit on, '' when unknown.
+        """
+        binding = self.model.get_binding(self._relation_name)
+        if binding is None or binding.network.bind_address is None:
+            return ''
+        return str(binding.network.bind_address)
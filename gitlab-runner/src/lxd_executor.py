@@ -0,0 +1,1636 @@
+#!/usr/bin/env python3
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+"""
+lxd custom executor for gitlab-runner.
+
+Installed to /opt/lxd-executor/ by the charm and called through the prepare.sh,
+run.sh and cleanup.sh stage wrappers. It talks to LXD over its unix socket on a
+single reused connection instead of forking the lxc client for every step, and
+waits on LXD operations rather than polling. With LXD_EXEC_AGENT the same file
+also runs inside the job container as the exec agent the run stages stream
+their scripts to.
+
+Runs with the system python3 of the runner host, so only the standard library
+is used.
+"""
+import base64
+import calendar
+import concurrent.futures
+import errno
+import fcntl
+import hashlib
+import http.client
+import http.server
+import json
+import os
+import re
+import shutil
+import signal
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+LXD_SOCKET = '/var/snap/lxd/common/lxd/unix.socket'
+# Overridden by the load test, which runs the stages against a fake LXD.
+CONFIG_FILE = os.environ.get('LXD_EXECUTOR_CONFIG', '/etc/default/lxd-executor')
+LXD_EXECUTOR_STATE = '/var/lib/lxd-executor'
+
+# default to Ubuntu 18.04 if none has been set with the 'image' keyword in the .gitlab-ci.yml
+DEFAULT_IMAGE = 'ubuntu:18.04'
+
+# Job profile and network, converged by the charm rather than per job.
+PROFILE = 'gitlab'
+NETWORK = 'lxdbr0'
+# prevent name collisions when using nested LXD on .lxd
+NETWORK_CONFIG = {'dns.domain': 'juju-gitlab-runner'}
+
+# Recycled containers carry the image they were provisioned from and are reset
+# to this snapshot instead of being deleted.
+RECYCLE_KEY = 'user.lxd-executor.base'
+CLEAN_SNAPSHOT = 'clean'
+
+# Finished job containers are renamed with this prefix and deleted by the reaper.
+REAP_PREFIX = 'reap-'
+
+# Per project host directories, mounted into job containers.
+CACHE_DEVICE = 'project-cache'
+MIRROR_DEVICE = 'git-mirror'
+MIRROR_PATH = '/git-mirror'
+# Points the project build directory at the objects of the reference mirror, so
+# fetches in the job only transfer what the mirror does not have.
+BORROW_OBJECTS = ('mkdir -p "$1" && cd "$1" && { [ -d .git ] || git init -q; } && '
+                  f'echo {MIRROR_PATH}/objects > .git/objects/info/alternates')
+PROJECT_SLOT = re.compile(r'-project-([0-9]+)-concurrent-')
+
+# Mounts a RAM backed build directory, the job profile is privileged.
+MOUNT_TMPFS = ('mkdir -p "$1" && '
+               '{ mountpoint -q "$1" || mount -t tmpfs -o "size=$2m,mode=1777" tmpfs "$1"; }')
+
+# Blocks until the boot is finished. systemd before 240 has no --wait, the
+# isolate job then waits for multi-user.target instead.
+READY_CHECK = ('state="$(systemctl is-system-running --wait 2>/dev/null)"; '
+               'case "$state" in running|degraded) exit 0;; esac; '
+               'exec systemctl isolate multi-user.target')
+
+# Image remotes known to a stock lxc client.
+REMOTES = {'ubuntu': ('https://cloud-images.ubuntu.com/releases', 'simplestreams'),
+           'ubuntu-daily': ('https://cloud-images.ubuntu.com/daily', 'simplestreams'),
+           'images': ('https://images.linuxcontainers.org', 'simplestreams')}
+
+# The exec agent runs this file with the python3 of the job container, started
+# by prepare and reached from the host through a proxy device.
+AGENT_DEVICE = 'exec-agent'
+AGENT_PATH = '/run/lxd-executor-agent.py'
+AGENT_SOCKET = '/run/lxd-executor-agent.sock'
+AGENT_TIMEOUT = 5
+START_AGENT = ('command -v python3 >/dev/null || exit 1; '
+               'setsid python3 "$1" agent "$2" </dev/null >/dev/null 2>&1 &')
+# Agent frames are a channel byte and a payload length: P ping, S script (empty
+# for EOF) towards the agent, O stdout, E stderr and X exit status back.
+FRAME = struct.Struct('!cI')
+
+# Upper bounds in seconds of the stage duration histogram buckets.
+STAGE_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+METRICS_LISTEN = '127.0.0.1:9254'
+
+RUNNER_DOWNLOADS = 'https://gitlab-runner-downloads.s3.amazonaws.com'
+DEPENDENCIES = [
+    # Install Git LFS, git comes pre installed with ubuntu image.
+    "curl -s https://packagecloud.io/install/repositories/github/git-lfs/script.deb.sh | sudo -E bash",
+    "apt install -y git-lfs",
+    # Install gitlab-runner binary since we need for cache/artifacts.
+    "curl -L --output /usr/local/bin/gitlab-runner "
+    "{downloads}/latest/binaries/gitlab-runner-linux-amd64",
+    "chmod +x /usr/local/bin/gitlab-runner",
+]
+
+
+class LXDError(Exception):
+    """An error returned by the LXD API."""
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a unix socket."""
+
+    def __init__(self, path, timeout=None):
+        super().__init__('lxd', timeout=timeout)
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._path)
+
+
+class WebSocket:
+    """Minimal RFC 6455 websocket, enough for the LXD exec streams."""
+
+    OP_CONTINUATION = 0x0
+    OP_TEXT = 0x1
+    OP_BINARY = 0x2
+    OP_CLOSE = 0x8
+    OP_PING = 0x9
+    OP_PONG = 0xA
+
+    GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+    def __init__(self, sock, mask=True, buffer=b''):
+        self._sock = sock
+        self._mask = mask
+        self._buffer = buffer
+        self._send_lock = threading.Lock()
+        self.closed = False
+
+    @classmethod
+    def connect(cls, socket_path, path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(socket_path)
+        key = base64.b64encode(os.urandom(16)).decode()
+        sock.sendall(f'GET {path} HTTP/1.1\r\n'
+                     'Host: lxd\r\n'
+                     'Upgrade: websocket\r\n'
+                     'Connection: Upgrade\r\n'
+                     f'Sec-WebSocket-Key: {key}\r\n'
+                     'Sec-WebSocket-Version: 13\r\n\r\n'.encode())
+        response = b''
+        while b'\r\n\r\n' not in response:
+            chunk = sock.recv(4096)
+            if not chunk:
+                sock.close()
+                raise LXDError(f'Websocket {path} closed during handshake')
+            response += chunk
+        head, _, rest = response.partition(b'\r\n\r\n')
+        status = head.split(b'\r\n', 1)[0].split()
+        if len(status) < 2 or status[1] != b'101':
+            sock.close()
+            raise LXDError(f'Websocket {path} refused: {head.decode(errors="replace")}')
+        return cls(sock, mask=True, buffer=rest)
+
+    def _read(self, size):
+        while len(self._buffer) < size:
+            chunk = self._sock.recv(max(size - len(self._buffer), 4096))
+            if not chunk:
+                raise ConnectionError('websocket closed')
+            self._buffer += chunk
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def send(self, payload, opcode=OP_BINARY):
+        header = bytearray([0x80 | opcode])
+        length = len(payload)
+        mask_bit = 0x80 if self._mask else 0
+        if length < 126:
+            header.append(mask_bit | length)
+        elif length < 1 << 16:
+            header.append(mask_bit | 126)
+            header += struct.pack('!H', length)
+        else:
+            header.append(mask_bit | 127)
+            header += struct.pack('!Q', length)
+        if self._mask:
+            key = os.urandom(4)
+            header += key
+            payload = bytes(b ^ key[i % 4] for i, b in enumerate(payload))
+        with self._send_lock:
+            self._sock.sendall(bytes(header) + payload)
+
+    def recv(self):
+        """
+        Returns: (opcode, payload) of the next data or close message.
+        """
+        message = b''
+        opcode = None
+        while True:
+            first, second = self._read(2)
+            frame_opcode = first & 0x0F
+            length = second & 0x7F
+            if length == 126:
+                length = struct.unpack('!H', self._read(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', self._read(8))[0]
+            key = self._read(4) if second & 0x80 else None
+            payload = self._read(length)
+            if key:
+                payload = bytes(b ^ key[i % 4] for i, b in enumerate(payload))
+
+            if frame_opcode == self.OP_PING:
+                self.send(payload, self.OP_PONG)
+                continue
+            if frame_opcode == self.OP_PONG:
+                continue
+            if frame_opcode == self.OP_CLOSE:
+                return self.OP_CLOSE, payload
+            if frame_opcode != self.OP_CONTINUATION:
+                opcode = frame_opcode
+            message += payload
+            if first & 0x80:
+                return opcode, message
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                self.send(struct.pack('!H', 1000), self.OP_CLOSE)
+            except OSError:
+                pass
+        self._sock.close()
+
+
+class LXDClient:
+    """Client for the LXD REST API on a persistent unix socket connection."""
+
+    def __init__(self, socket_path=LXD_SOCKET):
+        self.socket_path = socket_path
+        self._conn = UnixHTTPConnection(socket_path)
+
+    def close(self):
+        self._conn.close()
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        Returns: The decoded LXD response.
+        Raises LXDError for error responses.
+        """
+        headers = dict(headers or {})
+        if body is not None and not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+            headers.setdefault('Content-Type', 'application/json')
+
+        for attempt in range(2):
+            try:
+                self._conn.request(method, path, body=body, headers=headers)
+                response = self._conn.getresponse()
+                payload = response.read()
+                break
+            except (http.client.HTTPException, OSError) as e:
+                # LXD may have closed an idle keep-alive connection, retry once.
+                self._conn.close()
+                if attempt:
+                    raise LXDError(f'{method} {path} failed: {e}')
+
+        try:
+            result = json.loads(payload.decode())
+        except ValueError:
+            raise LXDError(f'{method} {path} returned invalid JSON', response.status)
+        if result.get('type') == 'error':
+            raise LXDError(f"{method} {path}: {result.get('error')}", result.get('error_code'))
+        return result
+
+    def wait(self, operation, timeout=-1):
+        """
+        Blocks until a background operation is done.
+        Returns: The operation metadata.
+        """
+        op = self.request('GET', f'{operation}/wait?timeout={timeout}')['metadata']
+        if op['status_code'] == 200:
+            return op
+        if op['status_code'] < 200:
+            raise LXDError(f'Operation {operation} timed out after {timeout}s', 504)
+        raise LXDError(op.get('err') or op['status'], op['status_code'])
+
+    def _sync(self, method, path, body=None, timeout=-1):
+        """Runs a request and waits for the operation it may start."""
+        result = self.request(method, path, body)
+        if result['type'] == 'async':
+            return self.wait(result['operation'], timeout)
+        return result['metadata']
+
+    # Instances
+
+    def instances(self, prefix=''):
+        """
+        Returns: Names of the instances starting with prefix.
+        """
+        names = [url.rsplit('/', 1)[-1] for url in self.request('GET', '/1.0/instances')['metadata']]
+        return [urllib.parse.unquote(name) for name in names if name.startswith(prefix)]
+
+    def instances_info(self):
+        """
+        Returns: All instances with their config and status, in one request.
+        """
+        return self.request('GET', '/1.0/instances?recursion=1')['metadata']
+
+    def instance(self, name):
+        """
+        Returns: The instance, or None if it does not exist.
+        """
+        try:
+            return self.request('GET', f'/1.0/instances/{name}')['metadata']
+        except LXDError as e:
+            if e.code == 404:
+                return None
+            raise
+
+    def status(self, name):
+        """
+        Returns: The instance status, e.g. Running, or None if it does not exist.
+        """
+        instance = self.instance(name)
+        return instance['status'] if instance else None
+
+    def create(self, name, image, profiles):
+        self._sync('POST', '/1.0/instances', {'name': name,
+                                              'source': image_source(image),
+                                              'profiles': profiles})
+
+    def set_state(self, name, action, force=False, timeout=-1):
+        self._sync('PUT', f'/1.0/instances/{name}/state', {'action': action,
+                                                           'force': force,
+                                                           'timeout': timeout})
+
+    def launch(self, name, image, profiles):
+        self.create(name, image, profiles)
+        self.set_state(name, 'start')
+
+    def rename(self, name, new_name):
+        self._sync('POST', f'/1.0/instances/{name}', {'name': new_name})
+
+    def delete(self, name):
+        """Force deletes an instance, like lxc delete -f."""
+        status = self.status(name)
+        if status is None:
+            return
+        if status != 'Stopped':
+            self.set_state(name, 'stop', force=True)
+        self._sync('DELETE', f'/1.0/instances/{name}')
+
+    def exec(self, name, command, stdin=None, stdout=None, stderr=None, environment=None,
+             timeout=-1):
+        """
+        Runs command in the instance, streaming stdin from and output to the
+        given binary files. Without any streams nothing is attached and only
+        the exit status is collected.
+        Returns: The exit status of the command.
+        """
+        attach = stdin is not None or stdout is not None or stderr is not None
+        result = self.request('POST', f'/1.0/instances/{name}/exec',
+                              {'command': command,
+                               'environment': environment or {},
+                               'interactive': False,
+                               'wait-for-websocket': attach,
+                               'record-output': False})
+        operation = result['operation']
+        if not attach:
+            return self.wait(operation, timeout)['metadata']['return']
+
+        fds = result['metadata']['metadata']['fds']
+        sockets = {fd: WebSocket.connect(self.socket_path,
+                                         f'{operation}/websocket?secret={secret}')
+                   for fd, secret in fds.items()}
+        pumps = [threading.Thread(target=_pump_output, args=(sockets[fd], stream), daemon=True)
+                 for fd, stream in (('1', stdout), ('2', stderr))]
+        pumps.append(threading.Thread(target=_pump_input, args=(sockets['0'], stdin), daemon=True))
+        for pump in pumps:
+            pump.start()
+        try:
+            op = self.wait(operation, timeout)
+        finally:
+            for pump in pumps:
+                pump.join(5)
+            for ws in sockets.values():
+                ws.close()
+        return op['metadata']['return']
+
+    def update_instance(self, name, config):
+        """Sets the given config keys on an instance."""
+        self._sync('PATCH', f'/1.0/instances/{name}', {'config': config})
+
+    def add_devices(self, name, devices):
+        """Adds or replaces devices of an instance, hotplugged if it is running."""
+        self._sync('PATCH', f'/1.0/instances/{name}', {'devices': devices})
+
+    def set_profiles(self, name, profiles):
+        self._sync('PATCH', f'/1.0/instances/{name}', {'profiles': profiles})
+
+    def snapshot(self, name, snapshot):
+        self._sync('POST', f'/1.0/instances/{name}/snapshots', {'name': snapshot,
+                                                                'stateful': False})
+
+    def restore(self, name, snapshot):
+        self._sync('PUT', f'/1.0/instances/{name}', {'restore': snapshot})
+
+    # Files
+
+    def push_file(self, name, path, content, mode='0644'):
+        self.request('POST', f'/1.0/instances/{name}/files?path={urllib.parse.quote(path)}',
+                     content, {'Content-Type': 'application/octet-stream',
+                               'X-LXD-type': 'file',
+                               'X-LXD-mode': mode,
+                               'X-LXD-uid': '0',
+                               'X-LXD-gid': '0'})
+
+    # Profiles and networks
+
+    def set_profile(self, name, config, description='', devices=None):
+        """Creates the profile if missing and replaces its config and devices."""
+        body = {'config': config, 'description': description, 'devices': devices or {}}
+        try:
+            self.request('PUT', f'/1.0/profiles/{name}', body)
+        except LXDError as e:
+            if e.code != 404:
+                raise
+            self.request('POST', '/1.0/profiles', dict(body, name=name))
+
+    def update_network(self, name, config):
+        self.request('PATCH', f'/1.0/networks/{name}', {'config': config})
+
+    def storage_pool(self, name):
+        """
+        Returns: The storage pool, or None if it does not exist.
+        """
+        try:
+            return self.request('GET', f'/1.0/storage-pools/{name}')['metadata']
+        except LXDError as e:
+            if e.code == 404:
+                return None
+            raise
+
+    def create_storage_pool(self, name, driver, config=None):
+        self._sync('POST', '/1.0/storage-pools', {'name': name, 'driver': driver,
+                                                  'config': config or {}})
+
+    # Images
+
+    def image_fingerprint(self, alias):
+        """
+        Returns: The fingerprint an image alias points at, or None.
+        """
+        try:
+            return self.request('GET', f'/1.0/images/aliases/{alias}')['metadata']['target']
+        except LXDError as e:
+            if e.code == 404:
+                return None
+            raise
+
+    def publish(self, name, alias):
+        """
+        Publishes a stopped instance as an image and points alias at it.
+        Returns: The fingerprint of the new image.
+        """
+        op = self._sync('POST', '/1.0/images', {'source': {'type': 'instance', 'name': name}})
+        fingerprint = op['metadata']['fingerprint']
+        if self.image_fingerprint(alias):
+            self.request('PUT', f'/1.0/images/aliases/{alias}', {'target': fingerprint,
+                                                                 'description': ''})
+        else:
+            self.request('POST', '/1.0/images/aliases', {'name': alias, 'target': fingerprint})
+        return fingerprint
+
+    def delete_image(self, fingerprint):
+        self._sync('DELETE', f'/1.0/images/{fingerprint}')
+
+
+def _pump_output(ws, stream):
+    try:
+        while True:
+            opcode, payload = ws.recv()
+            # Older LXD releases mark the end of a stream with an empty text message.
+            if opcode == WebSocket.OP_CLOSE or (opcode == WebSocket.OP_TEXT and not payload):
+                return
+            if stream is not None:
+                stream.write(payload)
+                stream.flush()
+    except OSError:
+        pass
+
+
+def _pump_input(ws, stream):
+    try:
+        if stream is not None:
+            while True:
+                chunk = stream.read(65536)
+                if not chunk:
+                    break
+                ws.send(chunk)
+        # A close message is EOF for the process stdin.
+        ws.close()
+    except OSError:
+        pass
+
+
+def image_source(image):
+    """
+    Returns: The LXD instance source for an image in lxc launch notation,
+    e.g. ubuntu:18.04, images:debian/11, a local alias or a fingerprint.
+    """
+    remote, sep, alias = image.partition(':')
+    if sep:
+        if remote in REMOTES:
+            server, protocol = REMOTES[remote]
+            return {'type': 'image', 'mode': 'pull', 'server': server, 'protocol': protocol,
+                    'alias': alias}
+        if remote != 'local':
+            raise LXDError(f'Unknown image remote {remote}')
+        image = alias
+    if re.fullmatch('[0-9a-f]{12,64}', image):
+        return {'type': 'image', 'fingerprint': image}
+    return {'type': 'image', 'alias': image}
+
+
+def _timestamp(value):
+    """
+    Returns: Seconds since the epoch of an LXD UTC timestamp, 0 if unknown.
+    """
+    try:
+        return calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S'))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _disk_usage(path):
+    """
+    Returns: Bytes allocated below path.
+    """
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+
+def image_key(image):
+    return re.sub('[^a-zA-Z0-9]', '-', image)[:40]
+
+
+def load_config(path=CONFIG_FILE):
+    """
+    Returns: The KEY=VALUE settings rendered by the charm.
+    """
+    config = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#') or '=' not in line:
+                    continue
+                key, _, value = line.partition('=')
+                config[key.strip()] = value.strip().strip('"')
+    except FileNotFoundError:
+        pass
+    return config
+
+
+def _send_frame(sock, channel, payload=b''):
+    sock.sendall(FRAME.pack(channel, len(payload)) + payload)
+
+
+def _recv_frame(stream):
+    """
+    Returns: (channel, payload) of the next frame, or (None, None) at EOF.
+    """
+    header = stream.read(FRAME.size)
+    if len(header) < FRAME.size:
+        return None, None
+    channel, length = FRAME.unpack(header)
+    payload = stream.read(length)
+    if len(payload) < length:
+        return None, None
+    return channel, payload
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+    """
+    Runs one stage script with /bin/bash inside the job container, the way
+    lxc exec did, streaming its output back as frames.
+    """
+
+    def handle(self):
+        channel, payload = _recv_frame(self.rfile)
+        while channel == b'P':
+            _send_frame(self.connection, b'X', b'0')
+            channel, payload = _recv_frame(self.rfile)
+        if channel != b'S':
+            return
+
+        process = subprocess.Popen(['/bin/bash'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, start_new_session=True)
+        lock = threading.Lock()
+        pumps = [threading.Thread(target=self.pump, args=(process.stdout, b'O', lock), daemon=True),
+                 threading.Thread(target=self.pump, args=(process.stderr, b'E', lock), daemon=True)]
+        for pump in pumps:
+            pump.start()
+        try:
+            while payload:
+                process.stdin.write(payload)
+                process.stdin.flush()
+                channel, payload = _recv_frame(self.rfile)
+        except BrokenPipeError:
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+        # A cancelled job closes the connection, which kills the script.
+        threading.Thread(target=self.hangup, args=(process,), daemon=True).start()
+
+        rc = process.wait()
+        for pump in pumps:
+            pump.join()
+        with lock:
+            _send_frame(self.connection, b'X', str(rc).encode())
+
+    def pump(self, stream, channel, lock):
+        try:
+            while True:
+                chunk = os.read(stream.fileno(), 65536)
+                if not chunk:
+                    return
+                with lock:
+                    _send_frame(self.connection, channel, chunk)
+        except OSError:
+            pass
+
+    def hangup(self, process):
+        try:
+            self.rfile.read()
+        except OSError:
+            pass
+        if process.poll() is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+
+class AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Metrics:
+    """
+    Durations and failures of the executor stages. Every stage runs in its own
+    process, so they add up in metrics.json of the state directory.
+    """
+
+    def __init__(self, state):
+        self.path = os.path.join(state, 'metrics.json')
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def observe(self, stage, seconds, failed=False):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(f'{self.path}.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                stages = self.load()
+                entry = stages.setdefault(stage, {'buckets': [0] * len(STAGE_BUCKETS),
+                                                  'sum': 0.0, 'count': 0, 'failures': 0})
+                for i, bound in enumerate(STAGE_BUCKETS):
+                    if seconds <= bound:
+                        entry['buckets'][i] += 1
+                entry['sum'] += seconds
+                entry['count'] += 1
+                entry['failures'] += int(failed)
+                Executor._write_atomic(self.path, json.dumps(stages))
+        except (OSError, ValueError) as e:
+            # Metrics never fail a job.
+            sys.stderr.write(f'Failed to record the {stage} stage: {e}\n')
+
+    def time(self, stage, func, *args, failed=lambda result: result is False):
+        """
+        Returns: func(*args), recording its duration as stage. Exceptions and
+        results matching failed count as failures.
+        """
+        started = time.monotonic()
+        succeeded = False
+        try:
+            result = func(*args)
+            succeeded = not failed(result)
+            return result
+        finally:
+            self.observe(stage, time.monotonic() - started, not succeeded)
+
+    def render(self):
+        """
+        Returns: The stage metrics in the prometheus text format.
+        """
+        stages = self.load()
+        lines = ['# HELP lxd_executor_stage_duration_seconds Duration of lxd executor stages.',
+                 '# TYPE lxd_executor_stage_duration_seconds histogram']
+        for stage, entry in sorted(stages.items()):
+            for bound, count in zip(STAGE_BUCKETS, entry['buckets']):
+                lines.append(f'lxd_executor_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+            lines.append(f'lxd_executor_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {entry["count"]}')
+            lines.append(f'lxd_executor_stage_duration_seconds_sum{{stage="{stage}"}} {entry["sum"]:.3f}')
+            lines.append(f'lxd_executor_stage_duration_seconds_count{{stage="{stage}"}} {entry["count"]}')
+        lines += ['# HELP lxd_executor_stage_failures_total Failed lxd executor stages.',
+                  '# TYPE lxd_executor_stage_failures_total counter']
+        for stage, entry in sorted(stages.items()):
+            lines.append(f'lxd_executor_stage_failures_total{{stage="{stage}"}} {entry["failures"]}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the stage metrics on /metrics."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Executor:
+    """The custom executor stages for one job, or the pool refill."""
+
+    def __init__(self, client, config, env, out=None, err=None):
+        self.client = client
+        self.config = config
+        self.env = env
+        self.out = out or sys.stdout.buffer
+        self.err = err or sys.stderr.buffer
+        self.state = config.get('LXD_EXECUTOR_STATE') or LXD_EXECUTOR_STATE
+        self.metrics = Metrics(self.state)
+        self.pool_size = int(config.get('LXD_POOL_SIZE') or 0)
+        self.golden_images = config.get('LXD_GOLDEN_IMAGES') == 'true'
+        self.golden_max_age = int(config.get('LXD_GOLDEN_MAX_AGE') or 168)
+        self.boot_timeout = int(config.get('LXD_BOOT_TIMEOUT') or 60)
+        self.recycle = config.get('LXD_RECYCLE') == 'true'
+        self.cpu_slots = int(config.get('LXD_CPU_SLOTS') or 0)
+        self.package_cache = config.get('LXD_PACKAGE_CACHE', '')
+        self.project_cache = config.get('LXD_PROJECT_CACHE') == 'true'
+        self.cache_root = config.get('LXD_CACHE_DIR') or os.path.join(self.state, 'projects')
+        self.cache_max_size = int(config.get('LXD_CACHE_MAX_SIZE') or 0)
+        self.mirror_timeout = int(config.get('LXD_MIRROR_TIMEOUT') or 10)
+        # path:size in MB, resolved from the build-tmpfs option by the charm.
+        self.build_tmpfs = [entry.strip().rsplit(':', 1)
+                            for entry in config.get('LXD_BUILD_TMPFS', '').split(',')
+                            if ':' in entry]
+        self.reap_parallelism = max(int(config.get('LXD_REAP_PARALLELISM') or 2), 1)
+        self.reap_max_age = int(config.get('LXD_REAP_MAX_AGE') or 24)
+        self.exec_agent = config.get('LXD_EXEC_AGENT') == 'true'
+
+        # Original name had the JobID, removed to prevent build up of containers if they
+        # fail to clean.
+        self.slot = 'runner-{}-project-{}-concurrent-{}'.format(
+            env.get('CUSTOM_ENV_CI_RUNNER_ID', ''),
+            env.get('CUSTOM_ENV_CI_PROJECT_ID', ''),
+            env.get('CUSTOM_ENV_CI_CONCURRENT_PROJECT_ID', ''))
+        self.project = env.get('CUSTOM_ENV_CI_PROJECT_ID', '')
+        self.image = env.get('CUSTOM_ENV_CI_JOB_IMAGE') or DEFAULT_IMAGE
+        self.system_failure = int(env.get('SYSTEM_FAILURE_EXIT_CODE', 1))
+        self.build_failure = int(env.get('BUILD_FAILURE_EXIT_CODE', 1))
+
+    def echo(self, message):
+        self.out.write(f'{message}\n'.encode())
+        self.out.flush()
+
+    @property
+    def claim_file(self):
+        return os.path.join(self.state, 'claimed', self.slot)
+
+    @property
+    def container(self):
+        """
+        A container claimed from the warm pool keeps its pool name, the claim
+        file maps the job slot to it.
+        """
+        try:
+            with open(self.claim_file) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return self.slot
+
+    def agent_socket(self, name):
+        """The host end of the exec agent proxy device of container name."""
+        return os.path.join(self.state, 'agents', f'{name}.sock')
+
+    # Stages
+
+    def prepare(self):
+        return self.metrics.time('prepare', self._prepare, failed=bool)
+
+    def run(self, script, stage=None):
+        # Only the executor failing the job counts, not the job script.
+        return self.metrics.time('run', self._run, script, stage,
+                                 failed=lambda rc: rc == self.system_failure)
+
+    def cleanup(self):
+        return self.metrics.time('cleanup', self._cleanup, failed=bool)
+
+    def _prepare(self):
+        self.echo(f'Running in {self.slot}')
+        try:
+            self.start_container()
+        except (LXDError, OSError) as e:
+            self.echo(f'Failed to prepare {self.slot}: {e}')
+            return self.system_failure
+        try:
+            self.mount_build_tmpfs()
+        except (LXDError, OSError) as e:
+            self.echo(f'Failed to mount the build tmpfs: {e}')
+            return self.system_failure
+        try:
+            self.attach_project_cache()
+        except (LXDError, OSError) as e:
+            # The job still runs, only without its cache.
+            self.echo(f'Failed to attach the cache of project {self.project}: {e}')
+        if self.exec_agent:
+            try:
+                started = self.start_agent()
+            except (LXDError, OSError) as e:
+                self.echo(f'{e}')
+                started = False
+            if not started:
+                # The run stages fall back to lxc exec.
+                self.echo('Exec agent unavailable, running the job through lxc exec')
+        return 0
+
+    def _run(self, script, stage=None):
+        try:
+            with open(script, 'rb') as f:
+                rc = self.run_in_agent(f) if self.exec_agent else None
+                if rc is None:
+                    rc = self.client.exec(self.container, ['/bin/bash'],
+                                          stdin=f, stdout=self.out, stderr=self.err)
+        except (LXDError, OSError) as e:
+            self.echo(f'Failed to run {stage or script} in {self.container}: {e}')
+            return self.system_failure
+        if rc != 0:
+            # Exit using the variable, to make the build as failure in GitLab CI.
+            return self.build_failure
+        return 0
+
+    def _cleanup(self):
+        name = self.container
+        try:
+            instance = self.client.instance(name)
+            if instance and RECYCLE_KEY in instance.get('config', {}):
+                self.echo(f'Restoring container {name} to its clean snapshot')
+                self.reset_container(name)
+            elif instance:
+                # Storage teardown is left to the reaper, freeing the slot at once.
+                self.echo(f'Marking container {name} for reaping')
+                self.mark_for_reaping(name)
+        except LXDError as e:
+            self.echo(f'Failed to clean up {name}: {e}')
+            return 1
+        finally:
+            self._unlink(self.agent_socket(name))
+            self._unlink(self.claim_file)
+        return 0
+
+    # Exec agent
+
+    def start_agent(self):
+        """
+        Starts the exec agent in the job container, reached on the host through
+        a proxy device at agent_socket, so run stages skip the exec setup of LXD.
+        Returns: True once the agent answers.
+        """
+        name = self.container
+        path = self.agent_socket(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._unlink(path)
+        with open(os.path.abspath(__file__), 'rb') as f:
+            self.client.push_file(name, AGENT_PATH, f.read(), mode='0755')
+        self.client.add_devices(name, {AGENT_DEVICE: {'type': 'proxy', 'bind': 'host',
+                                                      'listen': f'unix:{path}',
+                                                      'connect': f'unix:{AGENT_SOCKET}',
+                                                      'uid': str(os.getuid()),
+                                                      'gid': str(os.getgid()),
+                                                      'mode': '0600'}})
+        if self.client.exec(name, ['sh', '-c', START_AGENT, 'sh', AGENT_PATH, AGENT_SOCKET]):
+            self._unlink(path)
+            return False
+
+        deadline = time.monotonic() + AGENT_TIMEOUT
+        while time.monotonic() < deadline:
+            connection = self.connect_agent(name)
+            if connection:
+                connection.close()
+                return True
+            time.sleep(0.1)
+        self._unlink(path)
+        return False
+
+    def connect_agent(self, name):
+        """
+        Returns: A connected socket to the exec agent of container name after a
+        ping, or None if it does not answer.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(AGENT_TIMEOUT)
+            sock.connect(self.agent_socket(name))
+            _send_frame(sock, b'P')
+            with sock.makefile('rb') as stream:
+                channel, _ = _recv_frame(stream)
+        except OSError:
+            channel = None
+        if channel != b'X':
+            # The proxy accepts and drops connections while the agent is down.
+            sock.close()
+            return None
+        sock.settimeout(None)
+        return sock
+
+    def run_in_agent(self, script):
+        """
+        Streams the script to the exec agent and its output to out and err.
+        Returns: The exit status, or None if the agent did not answer before
+        the script was sent.
+        """
+        if not os.path.exists(self.agent_socket(self.container)):
+            return None
+        sock = self.connect_agent(self.container)
+        if sock is None:
+            return None
+        with sock, sock.makefile('rb') as stream:
+            for chunk in iter(lambda: script.read(65536), b''):
+                _send_frame(sock, b'S', chunk)
+            _send_frame(sock, b'S')
+            while True:
+                channel, payload = _recv_frame(stream)
+                if channel is None:
+                    raise OSError('The exec agent closed the connection')
+                if channel == b'X':
+                    return int(payload)
+                out = self.out if channel == b'O' else self.err
+                out.write(payload)
+                out.flush()
+
+    # Container helpers
+
+    def start_container(self):
+        for name in {self.container, self.slot}:
+            instance = self.client.instance(name)
+            if instance is None:
+                continue
+            if RECYCLE_KEY in instance.get('config', {}):
+                self.echo('Found old recycled container, resetting')
+                self.reset_container(name)
+            else:
+                self.echo('Found old container, deleting')
+                self.client.delete(name)
+        self._unlink(self.claim_file)
+
+        if self.recycle:
+            self.start_recycled_container()
+            return
+
+        name = self.claim_from_pool()
+        if name:
+            self.echo(f'Claimed warm container {name} from pool')
+            self.apply_slot_profile(name)
+            return
+
+        if not self.provision_container(self.image, self.slot):
+            raise LXDError(f'Failed to provision container {self.slot}')
+
+    @property
+    def recycle_name(self):
+        """One base container is kept per image and job slot."""
+        return f'{self.slot}-{hashlib.sha1(self.image.encode()).hexdigest()[:8]}'
+
+    def start_recycled_container(self):
+        """
+        Starts the restored base container of this image and job slot, creating
+        it and its clean snapshot on first use.
+        """
+        name = self.recycle_name
+        base = self.golden_image(self.image) or self.image
+        instance = self.client.instance(name)
+        os.makedirs(os.path.dirname(self.claim_file), exist_ok=True)
+        self._write_atomic(self.claim_file, name)
+
+        if instance and instance.get('config', {}).get(RECYCLE_KEY) == base:
+            if instance['status'] != 'Stopped':
+                self.reset_container(name)
+            self.apply_slot_profile(name)
+            self.client.set_state(name, 'start')
+            if not self.wait_for_container(name):
+                raise LXDError(f'Recycled container {name} did not start')
+            self.echo(f'Started recycled container {name}')
+            return
+
+        if instance:
+            self.echo(f'Base image of {name} changed, recreating')
+            self.client.delete(name)
+        if not self.provision_container(self.image, name):
+            raise LXDError(f'Failed to provision container {name}')
+        # Restoring the snapshot also restores the config, so mark it first.
+        self.client.update_instance(name, {RECYCLE_KEY: base})
+        self.client.snapshot(name, CLEAN_SNAPSHOT)
+
+    @property
+    def profiles(self):
+        """
+        With CPU pinning each concurrency slot of the runner gets the cores of
+        its own gitlab-slot-N profile.
+        """
+        slot = self.env.get('CUSTOM_ENV_CI_CONCURRENT_ID', '')
+        # Later profiles override earlier ones, e.g. the root disk of default.
+        if self.cpu_slots and slot.isdigit():
+            return ['default', PROFILE, f'{PROFILE}-slot-{int(slot) % self.cpu_slots}']
+        return ['default', PROFILE]
+
+    def apply_slot_profile(self, name):
+        """Moves a container made outside of this job slot onto the slot profiles."""
+        if self.cpu_slots:
+            self.client.set_profiles(name, self.profiles)
+
+    def reset_container(self, name):
+        """Stops a recycled container and restores its clean snapshot."""
+        if self.client.status(name) != 'Stopped':
+            self.client.set_state(name, 'stop', force=True)
+        try:
+            self.client.restore(name, CLEAN_SNAPSHOT)
+        except LXDError:
+            # Without a usable snapshot the next job provisions it from scratch.
+            self.client.delete(name)
+            raise
+
+    def launch_container(self, image, name):
+        """
+        Returns: True once the container has booted.
+        """
+        self.metrics.time('launch', self.client.launch, name, image, self.profiles)
+        return self.metrics.time('boot', self.wait_for_container, name)
+
+    def wait_for_container(self, name):
+        """
+        Blocks until systemd in the container reports the boot as finished,
+        or LXD_BOOT_TIMEOUT seconds have passed.
+        Returns: True once the container is ready.
+        """
+        started = time.monotonic()
+        deadline = started + self.boot_timeout
+        while True:
+            remaining = int(deadline - time.monotonic())
+            if remaining <= 0:
+                break
+            try:
+                rc = self.client.exec(name, ['sh', '-c', READY_CHECK], timeout=remaining)
+            except LXDError as e:
+                if e.code == 504:
+                    break
+                rc = None
+            if rc == 0:
+                self.echo(f'Container {name} ready in {time.monotonic() - started:.2f}s')
+                return True
+            # Only reached while systemd is not accepting requests yet.
+            time.sleep(0.25)
+
+        self.echo(f'Waited for {self.boot_timeout} seconds to start container, exiting..')
+        return False
+
+    def install_dependencies(self, name):
+        """
+        Returns: True if all dependencies installed.
+        """
+        # Through the host package cache, which also mirrors the runner downloads.
+        environment = {'http_proxy': self.package_cache} if self.package_cache else {}
+        downloads = (f'{self.package_cache}/gitlab-runner-downloads' if self.package_cache
+                     else RUNNER_DOWNLOADS)
+        for command in DEPENDENCIES:
+            if self.client.exec(name, ['sh', '-c', command.format(downloads=downloads)],
+                                stdout=self.out, stderr=self.err, environment=environment):
+                return False
+        return True
+
+    def provision_container(self, image, name):
+        """
+        Launches a booted container with the job dependencies installed,
+        preferring the golden image of image when enabled.
+        Returns: True on success.
+        """
+        golden = self.golden_image(image)
+        if golden:
+            try:
+                if self.launch_container(golden, name):
+                    return True
+            except LXDError as e:
+                self.echo(f'{e}')
+            self.echo(f'Failed to launch {name} from the golden image of {image}, falling back')
+            self._delete_quietly(name)
+
+        return self.launch_container(image, name) and \
+            self.metrics.time('dependencies', self.install_dependencies, name)
+
+    def mount_build_tmpfs(self):
+        """Mounts the LXD_BUILD_TMPFS directories of the job in RAM."""
+        for path, size in self.build_tmpfs:
+            if self.client.exec(self.container, ['sh', '-c', MOUNT_TMPFS, 'sh', path, size]):
+                raise LXDError(f'Could not mount a {size}MB tmpfs on {path}')
+
+    # Project cache
+
+    def project_dir(self, project):
+        return os.path.join(self.cache_root, project)
+
+    def attach_project_cache(self):
+        """
+        Mounts the persistent cache directory of the project at /cache and its
+        git reference mirror read-only at /git-mirror, with the build directory
+        borrowing objects from the mirror.
+        """
+        if not self.project_cache or not self.project.isdigit():
+            return
+        project_dir = self.project_dir(self.project)
+        cache = os.path.join(project_dir, 'cache')
+        mirror = os.path.join(project_dir, 'git')
+        os.makedirs(cache, exist_ok=True)
+        # The mtime of the project directory orders the LRU eviction.
+        os.utime(project_dir)
+
+        devices = {CACHE_DEVICE: {'type': 'disk', 'source': cache, 'path': '/cache'}}
+        mirrored = self.update_mirror(mirror)
+        if mirrored:
+            devices[MIRROR_DEVICE] = {'type': 'disk', 'source': mirror, 'path': MIRROR_PATH,
+                                      'readonly': 'true'}
+        self.client.add_devices(self.container, devices)
+
+        build_dir = self.env.get('CUSTOM_ENV_CI_PROJECT_DIR')
+        if mirrored and build_dir:
+            if self.client.exec(self.container, ['sh', '-c', BORROW_OBJECTS, 'sh', build_dir]):
+                self.echo('Could not point the build directory at the git reference mirror')
+
+    def update_mirror(self, mirror):
+        """
+        Fetches the job repository into the bare reference mirror of the project,
+        unless another job of the project is already doing so. A fetch taking
+        longer than LXD_MIRROR_TIMEOUT seconds carries on in the background, the
+        job clones what the mirror is still missing.
+        Returns: True if the mirror can be used.
+        """
+        usable = os.path.isdir(os.path.join(mirror, 'objects'))
+        url = self.env.get('CUSTOM_ENV_CI_REPOSITORY_URL')
+        if not url:
+            return usable
+
+        with open(f'{mirror}.lock', 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return usable
+                raise
+            if not usable:
+                # Repacking would pull objects away from running jobs.
+                for command in (['git', 'init', '-q', '--bare', mirror],
+                                ['git', '-C', mirror, 'config', 'gc.auto', '0']):
+                    if subprocess.run(command, stdout=subprocess.DEVNULL,
+                                      stderr=subprocess.DEVNULL).returncode != 0:
+                        self.echo('Failed to create the git reference mirror')
+                        return False
+            # The url carries the job token, so it is never stored in the mirror.
+            # The fetch holds the lock through the inherited descriptor, also once
+            # it outlives this stage in its own session.
+            started = time.monotonic()
+            fetch = subprocess.Popen(['git', '-C', mirror, 'fetch', '-q', '--prune', url,
+                                      '+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*'],
+                                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                     stderr=subprocess.DEVNULL,
+                                     env=dict(os.environ, GIT_TERMINAL_PROMPT='0'),
+                                     pass_fds=(lock.fileno(),), start_new_session=True)
+            try:
+                returncode = fetch.wait(self.mirror_timeout)
+            except subprocess.TimeoutExpired:
+                self.echo(f'Updating the git reference mirror takes over {self.mirror_timeout}s, '
+                          'continuing in the background')
+            else:
+                if returncode != 0:
+                    self.echo('Failed to update the git reference mirror')
+                else:
+                    self.echo(f'Updated the git reference mirror in {time.monotonic() - started:.1f}s')
+        return os.path.isdir(os.path.join(mirror, 'objects'))
+
+    def evict_project_caches(self):
+        """
+        Deletes the least recently used project caches, skipping projects with
+        a job running, until all fit in LXD_CACHE_MAX_SIZE MB.
+        """
+        if not self.cache_max_size or not os.path.isdir(self.cache_root):
+            return
+        # Sizing walks every cache, so it is done every few minutes, not every pass.
+        stamp = os.path.join(self.state, 'evicted')
+        try:
+            if time.time() - os.stat(stamp).st_mtime < 300:
+                return
+        except FileNotFoundError:
+            pass
+        self._write_atomic(stamp, int(time.time()))
+
+        busy = set()
+        claimed = os.path.join(self.state, 'claimed')
+        slots = os.listdir(claimed) if os.path.isdir(claimed) else []
+        for name in slots + self.client.instances('runner-'):
+            match = PROJECT_SLOT.search(name)
+            if match:
+                busy.add(match.group(1))
+
+        projects = []
+        for project in os.listdir(self.cache_root):
+            path = self.project_dir(project)
+            if os.path.isdir(path):
+                projects.append((os.stat(path).st_mtime, _disk_usage(path), project))
+        total = sum(size for _, size, _ in projects)
+        for _, size, project in sorted(projects):
+            if total <= self.cache_max_size * 1024 ** 2:
+                break
+            if project in busy:
+                continue
+            self.echo(f'Evicting the cache of project {project}')
+            shutil.rmtree(self.project_dir(project), ignore_errors=True)
+            total -= size
+
+    # Reaper
+
+    def mark_for_reaping(self, name):
+        """Stops a container and renames it out of the way of the next job."""
+        if self.client.status(name) != 'Stopped':
+            self.client.set_state(name, 'stop', force=True)
+        self.client.rename(name, f'{REAP_PREFIX}{os.urandom(3).hex()}-{name}'[:63].rstrip('-'))
+
+    def reap_targets(self):
+        """
+        Returns: Containers marked by cleanup, and those orphaned by crashed jobs
+        or interrupted golden image builds once older than LXD_REAP_MAX_AGE hours.
+        """
+        max_age = self.reap_max_age * 3600
+        now = time.time()
+        targets = []
+        for instance in self.client.instances_info():
+            name = instance['name']
+            if name.startswith(REAP_PREFIX):
+                targets.append(name)
+            elif name.startswith(('runner-', 'golden-build-')) and \
+                    RECYCLE_KEY not in instance.get('config', {}) and \
+                    now - _timestamp(instance.get('created_at')) > max_age:
+                targets.append(name)
+
+        # Containers claimed from the warm pool by jobs that never cleaned up.
+        claimed = os.path.join(self.state, 'claimed')
+        if os.path.isdir(claimed):
+            for slot in os.listdir(claimed):
+                claim = os.path.join(claimed, slot)
+                try:
+                    if now - os.stat(claim).st_mtime <= max_age:
+                        continue
+                except FileNotFoundError:
+                    continue
+                name = self._read(claim)
+                if name.startswith('pool-'):
+                    targets.append(name)
+                    self._unlink(claim)
+        return sorted(set(targets))
+
+    def reap(self):
+        """
+        Deletes the reap targets, LXD_REAP_PARALLELISM at a time, and records
+        the backlog for the charm in reaper.json.
+        Returns: The number of containers that could not be reaped.
+        """
+        targets = self.reap_targets()
+        self.write_reaper_status(len(targets))
+        failed = 0
+        if targets:
+            with concurrent.futures.ThreadPoolExecutor(self.reap_parallelism) as workers:
+                futures = {workers.submit(self._reap_one, name): name for name in targets}
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        future.result()
+                        self.echo(f'Reaped container {futures[future]}')
+                    except (LXDError, OSError) as e:
+                        failed += 1
+                        self.echo(f'Failed to reap container {futures[future]}: {e}')
+        self.write_reaper_status(failed)
+        try:
+            self.evict_project_caches()
+        except (LXDError, OSError) as e:
+            self.echo(f'Failed to evict project caches: {e}')
+        return failed
+
+    def _reap_one(self, name):
+        # The API connection is not shared between threads.
+        client = LXDClient(self.client.socket_path)
+        try:
+            self.metrics.time('delete', client.delete, name)
+        finally:
+            client.close()
+
+    def write_reaper_status(self, backlog):
+        os.makedirs(self.state, exist_ok=True)
+        self._write_atomic(os.path.join(self.state, 'reaper.json'),
+                           json.dumps({'backlog': backlog, 'updated': int(time.time())}))
+
+    # Warm pool
+
+    def pool_dir(self, image):
+        """
+        Idle containers for an image are tracked as marker files in this
+        directory, named after the container.
+        """
+        return os.path.join(self.state, 'pool', image_key(image))
+
+    def claim_from_pool(self):
+        """
+        Returns: The name of the claimed container, or None.
+        """
+        pool_dir = self.pool_dir(self.image)
+        if self.pool_size <= 0 or not os.path.isdir(pool_dir):
+            return None
+
+        os.makedirs(os.path.dirname(self.claim_file), exist_ok=True)
+        for marker in sorted(os.listdir(pool_dir)):
+            if marker.startswith('.'):
+                continue
+            # rename(2) is atomic, so only one job can win each idle container.
+            try:
+                os.rename(os.path.join(pool_dir, marker), self.claim_file)
+            except FileNotFoundError:
+                continue
+            if self.client.status(marker) == 'Running':
+                return marker
+            self.echo(f'Pooled container {marker} is gone, trying next')
+            self._delete_quietly(marker)
+            self._unlink(self.claim_file)
+        return None
+
+    def pool(self):
+        """
+        Keeps LXD_POOL_SIZE idle, booted containers per image in LXD_POOL_IMAGES.
+        Run periodically by lxd-executor-pool.timer.
+        """
+        pool_root = os.path.join(self.state, 'pool')
+        os.makedirs(pool_root, exist_ok=True)
+        # Only one refill at a time, containers without a marker are then known
+        # to be leftovers from an interrupted run.
+        with open(os.path.join(pool_root, '.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return 0
+                raise
+
+            wanted = {}
+            if self.pool_size > 0:
+                for image in self.config.get('LXD_POOL_IMAGES', '').split(','):
+                    if image.strip():
+                        wanted[self.pool_dir(image.strip())] = image.strip()
+
+            # Drop stale or surplus containers, including pools for images no
+            # longer configured.
+            for key in os.listdir(pool_root):
+                pool_dir = os.path.join(pool_root, key)
+                if os.path.isdir(pool_dir):
+                    self.prune_pool(pool_dir, self.pool_size if pool_dir in wanted else 0)
+
+            # Pooled containers with no marker were left behind by an interrupted refill.
+            known = set()
+            for key in os.listdir(pool_root):
+                pool_dir = os.path.join(pool_root, key)
+                if os.path.isdir(pool_dir):
+                    for marker in os.listdir(pool_dir):
+                        if marker.startswith('.'):
+                            self._unlink(os.path.join(pool_dir, marker))
+                        else:
+                            known.add(marker)
+            claimed = os.path.join(self.state, 'claimed')
+            if os.path.isdir(claimed):
+                known.update(self._read(os.path.join(claimed, f)) for f in os.listdir(claimed))
+            for name in self.client.instances('pool-'):
+                if name not in known:
+                    self.echo(f'Removing orphaned pooled container {name}')
+                    self._delete_quietly(name)
+
+            failed = False
+            if wanted:
+                for pool_dir, image in wanted.items():
+                    failed |= not self.refill_pool(pool_dir, image)
+        return 1 if failed else 0
+
+    def prune_pool(self, pool_dir, size):
+        count = 0
+        for marker in sorted(os.listdir(pool_dir)):
+            if marker.startswith('.'):
+                continue
+            if count < size and self.client.status(marker) == 'Running':
+                count += 1
+                continue
+            # Only delete what we managed to take back from the pool.
+            pruned = os.path.join(pool_dir, f'.{marker}.prune')
+            try:
+                os.rename(os.path.join(pool_dir, marker), pruned)
+            except FileNotFoundError:
+                continue
+            self.echo(f'Removing pooled container {marker}')
+            self._delete_quietly(marker)
+            self._unlink(pruned)
+
+    def refill_pool(self, pool_dir, image):
+        """
+        Returns: False if a container could not be prepared.
+        """
+        os.makedirs(pool_dir, exist_ok=True)
+        count = len([m for m in os.listdir(pool_dir) if not m.startswith('.')])
+        while count < self.pool_size:
+            name = f'pool-{os.path.basename(pool_dir)}-{os.urandom(4).hex()}'
+            self.echo(f'Launching pooled container {name} from {image}')
+            try:
+                ready = self.provision_container(image, name)
+            except LXDError as e:
+                self.echo(f'{e}')
+                ready = False
+            if not ready:
+                self.echo(f'Failed to prepare pooled container {name}')
+                self._delete_quietly(name)
+                return False
+            # Publish the marker only once the container is fully ready.
+            self._write_atomic(os.path.join(pool_dir, name), name)
+            count += 1
+        return True
+
+    # Golden images
+
+    def golden_image(self, image):
+        """
+        The golden image of an image has the job dependencies baked in. It is
+        built on first use and rebuilt once older than LXD_GOLDEN_MAX_AGE hours,
+        or when the charm removes its stamp file on upgrade.
+        Returns: The fingerprint of the golden image, or None.
+        """
+        if not self.golden_images:
+            return None
+
+        key = image_key(image)
+        alias = f'golden-{key}'
+        stamp = os.path.join(self.state, 'golden', key)
+        os.makedirs(os.path.dirname(stamp), exist_ok=True)
+
+        # Jobs for the same image wait for a single build.
+        with open(f'{stamp}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not self.golden_image_fresh(alias, stamp):
+                try:
+                    if not self.build_golden_image(image, alias, stamp):
+                        return None
+                except LXDError as e:
+                    self.echo(f'Failed to build golden image {alias}: {e}')
+                    return None
+        return self.client.image_fingerprint(alias)
+
+    def golden_image_fresh(self, alias, stamp):
+        try:
+            age = time.time() - os.stat(stamp).st_mtime
+        except FileNotFoundError:
+            return False
+        return age < self.golden_max_age * 3600 and self.client.image_fingerprint(alias) is not None
+
+    def build_golden_image(self, image, alias, stamp):
+        builder = f'golden-build-{alias[len("golden-"):]}'
+        self.echo(f'Building golden image {alias} from {image}')
+
+        self._delete_quietly(builder)
+        if not self.launch_container(image, builder) or not self.install_dependencies(builder):
+            self.echo(f'Failed to build golden image {alias}')
+            self._delete_quietly(builder)
+            return False
+
+        # Let every container from the image get its own identity.
+        self.client.exec(builder, ['sh', '-c', 'apt-get clean; truncate -s0 /etc/machine-id; '
+                                               'cloud-init clean --logs || true'])
+        self.client.set_state(builder, 'stop', timeout=30)
+
+        old = self.client.image_fingerprint(alias)
+        try:
+            self.client.publish(builder, alias)
+        finally:
+            self._delete_quietly(builder)
+        if old:
+            try:
+                self.client.delete_image(old)
+            except LXDError as e:
+                self.echo(f'Failed to delete old golden image {old}: {e}')
+
+        with open(stamp, 'w'):
+            pass
+        return True
+
+    # Utilities
+
+    def _delete_quietly(self, name):
+        try:
+            self.client.delete(name)
+        except LXDError:
+            pass
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except OSError:
+            return ''
+
+    @staticmethod
+    def _write_atomic(path, content):
+        directory, name = os.path.split(path)
+        tmp = os.path.join(directory, f'.{name}')
+        with open(tmp, 'w') as f:
+            f.write(f'{content}\n')
+        os.rename(tmp, path)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in ('prepare', 'run', 'cleanup', 'pool', 'reap', 'metrics', 'agent'):
+        sys.stderr.write('usage: lxd_executor.py prepare|run <script> <stage>|cleanup|pool|reap|metrics'
+                         '|agent [socket]\n')
+        return 2
+
+    if argv[0] == 'reap':
+        return reaper()
+    if argv[0] == 'metrics':
+        return serve_metrics()
+    if argv[0] == 'agent':
+        return agent(argv[1] if len(argv) > 1 else AGENT_SOCKET)
+
+    config = load_config()
+    client = LXDClient(config.get('LXD_SOCKET') or LXD_SOCKET)
+    executor = Executor(client, config, os.environ)
+    try:
+        if argv[0] == 'prepare':
+            return executor.prepare()
+        if argv[0] == 'run':
+            return executor.run(*argv[1:3])
+        if argv[0] == 'cleanup':
+            return executor.cleanup()
+        return executor.pool()
+    finally:
+        client.close()
+
+
+def reaper():
+    """Runs reap passes forever, for lxd-executor-reaper.service."""
+    while True:
+        # Reloaded every pass so config changes apply without a restart.
+        config = load_config()
+        client = LXDClient(config.get('LXD_SOCKET') or LXD_SOCKET)
+        try:
+            Executor(client, config, os.environ).reap()
+        except (LXDError, OSError) as e:
+            sys.stderr.write(f'Reap pass failed: {e}\n')
+        finally:
+            client.close()
+        time.sleep(int(config.get('LXD_REAP_INTERVAL') or 10))
+
+
+def serve_metrics():
+    """Serves the stage metrics forever, for lxd-executor-metrics.service."""
+    config = load_config()
+    host, _, port = (config.get('LXD_METRICS_LISTEN') or METRICS_LISTEN).rpartition(':')
+    server = http.server.HTTPServer((host, int(port)), MetricsHandler)
+    server.metrics = Metrics(config.get('LXD_EXECUTOR_STATE') or LXD_EXECUTOR_STATE)
+    server.serve_forever()
+
+
+def agent(path):
+    """Serves stage scripts forever inside the job container."""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    server = AgentServer(path, AgentHandler)
+    os.chmod(path, 0o600)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,684 @@
+#!/usr/bin/env python3
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+"""
+Host-local package and artifact cache for job containers.
+
+Installed to /opt/package-cache/ by the charm and run by package-cache.service.
+Job containers use it as their http proxy: package downloads (.deb and apt
+by-hash files, which never change under the same name) are kept on local disk
+and served from there on repeat fetches, everything else passes through. https
+is tunnelled uncached, on port 443 only. Nothing on the runner host itself is
+reached through it. The gitlab-runner binaries are mirrored below
+/gitlab-runner-downloads/ and revalidated with the upstream after
+PACKAGE_CACHE_TTL seconds.
+
+On the leader unit it can also serve the build cache shared by all units, a
+stand-in for S3 that takes the presigned GET, HEAD and PUT requests of the
+gitlab-runner cache, configured in SHARED_CACHE_CONFIG.
+
+It also fronts the gitlab-runner metrics on the scrape port and appends the
+stage metrics of the lxd executor, its own hit and miss counters, and the hook
+timings the charm writes to HOOK_METRICS.
+
+Runs with the system python3 of the runner host, so only the standard library
+is used.
+"""
+import calendar
+import hashlib
+import hmac
+import http.client
+import http.server
+import ipaddress
+import json
+import os
+import re
+import select
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+CONFIG_FILE = '/etc/default/package-cache'
+CACHE_DIR = '/var/cache/package-cache'
+# Readable by root only, it holds the keys of the shared cache.
+SHARED_CACHE_CONFIG = '/etc/default/shared-cache'
+SHARED_CACHE_DIR = '/var/cache/shared-cache'
+
+# Cached as long as they exist, a changed file always gets a new name.
+IMMUTABLE = re.compile(r'(\.u?deb|\.ddeb|/by-hash/[^/]+/[0-9a-fA-F]+)$')
+
+# Artifact mirrors, served below /<name>/.
+MIRRORS = {'gitlab-runner-downloads': 'https://gitlab-runner-downloads.s3.amazonaws.com'}
+
+HOP_BY_HOP = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+              'proxy-connection', 'te', 'trailers', 'transfer-encoding', 'upgrade'}
+CHUNK = 64 * 1024
+
+
+def load_config(path=CONFIG_FILE):
+    """
+    Returns: The KEY=VALUE settings rendered by the charm.
+    """
+    config = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#') or '=' not in line:
+                    continue
+                key, _, value = line.partition('=')
+                config[key.strip()] = value.strip().strip('"')
+    except FileNotFoundError:
+        pass
+    return config
+
+
+class Stats:
+    """Hit and miss counters, exported in the prometheus text format."""
+
+    def __init__(self, name='package_cache', results=('hit', 'miss', 'pass')):
+        self.name = name
+        self.lock = threading.Lock()
+        self.requests = dict.fromkeys(results, 0)
+        self.bytes = dict.fromkeys(results, 0)
+
+    def count(self, result, size=0):
+        with self.lock:
+            self.requests[result] += 1
+            self.bytes[result] += size
+
+    def hit_ratio(self):
+        lookups = self.requests['hit'] + self.requests['miss']
+        return self.requests['hit'] / lookups if lookups else 0.0
+
+    def render(self, cache_size):
+        name, what = self.name, self.name.replace('_', ' ')
+        lines = [f'# HELP {name}_requests_total Requests served by the {what}.',
+                 f'# TYPE {name}_requests_total counter']
+        lines += [f'{name}_requests_total{{result="{k}"}} {v}'
+                  for k, v in sorted(self.requests.items())]
+        lines += [f'# HELP {name}_bytes_total Bytes served by the {what}.',
+                  f'# TYPE {name}_bytes_total counter']
+        lines += [f'{name}_bytes_total{{result="{k}"}} {v}'
+                  for k, v in sorted(self.bytes.items())]
+        lines += [f'# HELP {name}_hit_ratio Share of the {what} lookups that were hits.',
+                  f'# TYPE {name}_hit_ratio gauge',
+                  f'{name}_hit_ratio {self.hit_ratio():.3f}']
+        lines += [f'# HELP {name}_size_bytes Bytes stored by the {what}.',
+                  f'# TYPE {name}_size_bytes gauge',
+                  f'{name}_size_bytes {cache_size}']
+        return '\n'.join(lines) + '\n'
+
+
+class Store:
+    """Responses on disk, keyed by the sha256 of their url."""
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, url):
+        return os.path.join(self.path, hashlib.sha256(url.encode()).hexdigest())
+
+    def get(self, url):
+        """
+        Returns: (path of the body, metadata) of a stored response, or (None, None).
+        """
+        body = self._file(url)
+        try:
+            with open(body + '.json') as f:
+                meta = json.load(f)
+            os.utime(body)
+            return body, meta
+        except (OSError, ValueError):
+            return None, None
+
+    def touch(self, url):
+        """Marks a revalidated response as fresh again."""
+        try:
+            os.utime(self._file(url) + '.json')
+        except OSError:
+            pass
+
+    def age(self, url):
+        try:
+            return time.time() - os.stat(self._file(url) + '.json').st_mtime
+        except OSError:
+            return None
+
+    def temporary(self):
+        return tempfile.NamedTemporaryFile(dir=self.path, prefix='.tmp-', delete=False)
+
+    def put(self, url, tmp_path, meta):
+        """Moves a completely downloaded body into the store."""
+        body = self._file(url)
+        os.rename(tmp_path, body)
+        with open(body + '.json.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.rename(body + '.json.tmp', body + '.json')
+        self.evict(keep=body)
+
+    def size(self):
+        total = 0
+        for entry in os.scandir(self.path):
+            if not entry.name.startswith('.'):
+                total += entry.stat().st_size
+        return total
+
+    def evict(self, keep=None):
+        """Removes the least recently served responses above max_size, except keep."""
+        if not self.max_size:
+            return
+        with self.lock:
+            bodies = []
+            for entry in os.scandir(self.path):
+                if not entry.name.startswith('.') and not entry.name.endswith('.json'):
+                    st = entry.stat()
+                    bodies.append((st.st_atime, st.st_size, entry.path))
+            total = sum(size for _, size, _ in bodies)
+            for _, size, path in sorted(bodies):
+                if total <= self.max_size:
+                    break
+                if path == keep:
+                    continue
+                for name in (path + '.json', path):
+                    try:
+                        os.unlink(name)
+                    except FileNotFoundError:
+                        pass
+                total -= size
+
+
+def local_address(host):
+    """
+    Returns: True if host is this machine or link-local, which job containers must
+    not reach through the cache, e.g. the runner metrics on 127.0.0.1. Names that
+    only the upstream proxy resolves are not local.
+    """
+    if not host:
+        return True
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None)}
+    except (socket.gaierror, UnicodeError):
+        return False
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split('%')[0])
+        if ip.is_loopback or ip.is_link_local or ip.is_unspecified or ip.is_multicast:
+            return True
+        # Only the addresses of this machine can be bound.
+        family = socket.AF_INET6 if ip.version == 6 else socket.AF_INET
+        with socket.socket(family, socket.SOCK_STREAM) as sock:
+            try:
+                sock.bind((address, 0))
+                return True
+            except OSError:
+                pass
+    return False
+
+
+class RedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Follows redirects of the upstream, except to local addresses."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if local_address(urllib.parse.urlsplit(newurl).hostname):
+            return None
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+class CacheHandler(http.server.BaseHTTPRequestHandler):
+    """Responses from a Store and streamed bodies."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            super().log_message(fmt, *args)
+
+    def _send_headers(self, status, headers, length=None):
+        self.send_response(status)
+        for key, value in headers:
+            if key.lower() not in HOP_BY_HOP and key.lower() != 'content-length':
+                self.send_header(key, value)
+        if length is None:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        else:
+            self.send_header('Content-Length', str(length))
+        self.end_headers()
+
+    def _copy(self, response, *outputs):
+        size = 0
+        while True:
+            data = response.read(CHUNK)
+            if not data:
+                return size
+            for output in outputs:
+                output.write(data)
+            size += len(data)
+
+    def send_file(self, body, meta, result):
+        size = os.path.getsize(body)
+        self.server.stats.count(result, size)
+        self._send_headers(200, meta['headers'], size)
+        if self.command != 'HEAD':
+            with open(body, 'rb') as f:
+                while True:
+                    data = f.read(CHUNK)
+                    if not data:
+                        break
+                    self.wfile.write(data)
+
+
+class ProxyHandler(CacheHandler):
+    """http proxy requests from job containers and the artifact mirrors."""
+
+    def upstream(self):
+        """
+        Returns: The upstream url of the request, or None for unknown mirrors.
+        """
+        if not self.path.startswith('/'):
+            return self.path
+        name, _, rest = self.path[1:].partition('/')
+        return f'{MIRRORS[name]}/{rest}' if name in MIRRORS else None
+
+    def refuse(self, host, port=None):
+        """
+        Returns: True after refusing a request to host, a local address, or a tunnel
+        to any port but the https one.
+        """
+        if (port is not None and port != 443) or local_address(host):
+            self.send_error(403)
+            return True
+        return False
+
+    def do_GET(self):
+        url = self.upstream()
+        if not url:
+            return self.send_error(404)
+        if self.path.startswith('/'):
+            return self.serve_cached(url, self.server.ttl)
+        if self.refuse(urllib.parse.urlsplit(url).hostname):
+            return
+        if IMMUTABLE.search(urllib.parse.urlsplit(url).path):
+            return self.serve_cached(url, None)
+        self.relay(url)
+
+    def do_HEAD(self):
+        url = self.upstream()
+        if url and not self.path.startswith('/') and self.refuse(urllib.parse.urlsplit(url).hostname):
+            return
+        self.relay(url)
+
+    def do_CONNECT(self):
+        host, _, port = self.path.rpartition(':')
+        try:
+            port = int(port)
+        except ValueError:
+            return self.send_error(400)
+        if self.refuse(host.strip('[]'), port):
+            return
+        try:
+            upstream = self.server.tunnel(host, port)
+        except OSError as e:
+            return self.send_error(502, str(e))
+        self.send_response(200, 'Connection established')
+        self.end_headers()
+        self.close_connection = True
+        sockets = [self.connection, upstream]
+        try:
+            while True:
+                readable, _, _ = select.select(sockets, [], [], 300)
+                if not readable:
+                    break
+                for sock in readable:
+                    data = sock.recv(CHUNK)
+                    if not data:
+                        return
+                    (upstream if sock is self.connection else self.connection).sendall(data)
+        except OSError:
+            pass
+        finally:
+            upstream.close()
+
+    def _request(self, url, headers=None):
+        return urllib.request.Request(url, headers=headers or {}, method=self.command)
+
+    def relay(self, url):
+        """Passes a request through uncached."""
+        if not url:
+            return self.send_error(404)
+        try:
+            response = self.server.opener.open(self._request(url), timeout=60)
+        except urllib.error.HTTPError as e:
+            response = e
+        except (OSError, http.client.HTTPException) as e:
+            return self.send_error(502, str(e))
+        with response:
+            length = response.headers.get('Content-Length')
+            self.server.stats.count('pass', int(length or 0) if self.command != 'HEAD' else 0)
+            self._send_headers(response.getcode(), response.headers.items(),
+                               int(length) if length is not None else None)
+            if self.command != 'HEAD':
+                self._copy(response, self.wfile)
+
+    def serve_cached(self, url, ttl):
+        """Serves url from the store, fetching it on a miss or once stale."""
+        store = self.server.store
+        body, meta = store.get(url)
+        if body and ttl is not None and (store.age(url) or 0) >= ttl:
+            body = self.revalidate(url, meta) and body
+        if body:
+            return self.send_file(body, meta, 'hit')
+
+        try:
+            response = self.server.opener.open(self._request(url), timeout=60)
+        except urllib.error.HTTPError as e:
+            # Errors are not cached.
+            self.server.stats.count('pass')
+            with e:
+                self._send_headers(e.code, e.headers.items(), 0)
+            return
+        except (OSError, http.client.HTTPException) as e:
+            return self.send_error(502, str(e))
+
+        meta = {'headers': [(k, v) for k, v in response.headers.items()
+                            if k.lower() in ('content-type', 'last-modified', 'etag')]}
+        length = response.headers.get('Content-Length')
+        tmp = store.temporary()
+        try:
+            # Stored before it is served, so a repeat fetch right after is a hit.
+            with response, tmp:
+                size = self._copy(response, tmp)
+            if length is not None and size != int(length):
+                return self.send_error(502, f'Short read from {url}')
+            store.put(url, tmp.name, meta)
+        except (OSError, http.client.HTTPException) as e:
+            return self.send_error(502, str(e))
+        finally:
+            if os.path.exists(tmp.name):
+                os.unlink(tmp.name)
+        self.send_file(store.get(url)[0], meta, 'miss')
+
+    def revalidate(self, url, meta):
+        """
+        Returns: True if the upstream still has the stored response of url.
+        """
+        headers = dict(meta['headers'])
+        conditions = {}
+        if headers.get('ETag'):
+            conditions['If-None-Match'] = headers['ETag']
+        if headers.get('Last-Modified'):
+            conditions['If-Modified-Since'] = headers['Last-Modified']
+        if not conditions:
+            return False
+        request = urllib.request.Request(url, headers=conditions)
+        try:
+            self.server.opener.open(request, timeout=60).close()
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                self.server.store.touch(url)
+                return True
+        except (OSError, http.client.HTTPException):
+            # Better a stale binary than a failed job while the upstream is away.
+            return True
+        return False
+
+
+def signature(secret_key, method, path, query, headers):
+    """
+    Returns: The AWS signature version 4 of a presigned S3 request, from its
+    X-Amz-* query parameters and the lower case headers they sign.
+    """
+    scope = query['X-Amz-Credential'].split('/', 1)[1]
+    signed = query['X-Amz-SignedHeaders'].split(';')
+    canonical = '\n'.join([
+        method,
+        urllib.parse.quote(path, safe='/~'),
+        '&'.join(f'{urllib.parse.quote(k, safe="~")}={urllib.parse.quote(v, safe="~")}'
+                 for k, v in sorted(query.items()) if k != 'X-Amz-Signature'),
+        ''.join(f'{name}:{headers.get(name, "").strip()}\n' for name in signed),
+        ';'.join(signed),
+        'UNSIGNED-PAYLOAD'])
+    string_to_sign = '\n'.join([query['X-Amz-Algorithm'], query['X-Amz-Date'], scope,
+                                hashlib.sha256(canonical.encode()).hexdigest()])
+    # date/region/service/aws4_request, each one signing the next.
+    key = f'AWS4{secret_key}'.encode()
+    for part in scope.split('/'):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    return hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+
+class S3Handler(CacheHandler):
+    """
+    Cache archives of gitlab-runner, stored under /<bucket>/<key> with the
+    presigned urls the runner hands its jobs. Only those are answered.
+    """
+
+    def authorize(self):
+        """
+        Returns: The store key of a validly signed request, None after sending
+        the error of any other.
+        """
+        url = urllib.parse.urlsplit(self.path)
+        path = urllib.parse.unquote(url.path)
+        bucket, _, key = path.lstrip('/').partition('/')
+        if bucket != self.server.bucket or not key:
+            self.send_error(404)
+            return None
+        query = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+        headers = {k.lower(): v for k, v in self.headers.items()}
+        try:
+            secret_key = self.server.credentials[query['X-Amz-Credential'].split('/')[0]]
+            signed = calendar.timegm(time.strptime(query['X-Amz-Date'], '%Y%m%dT%H%M%SZ'))
+            valid = signed + int(query['X-Amz-Expires']) >= time.time() and hmac.compare_digest(
+                signature(secret_key, self.command, path, query, headers), query['X-Amz-Signature'])
+        except (KeyError, IndexError, ValueError):
+            valid = False
+        if not valid:
+            self.send_error(403)
+            return None
+        return path
+
+    def do_GET(self):
+        key = self.authorize()
+        if key is None:
+            return
+        body, meta = self.server.store.get(key)
+        if not body:
+            if self.command == 'GET':
+                self.server.stats.count('miss')
+            return self.send_error(404)
+        if self.command == 'HEAD':
+            return self._send_headers(200, meta['headers'], os.path.getsize(body))
+        self.send_file(body, meta, 'hit')
+
+    do_HEAD = do_GET
+
+    def do_PUT(self):
+        key = self.authorize()
+        if key is None:
+            return
+        if self.headers.get('Content-Length') is None:
+            return self.send_error(411)
+        length = int(self.headers['Content-Length'])
+        store = self.server.store
+        tmp = store.temporary()
+        try:
+            with tmp:
+                remaining = length
+                while remaining:
+                    data = self.rfile.read(min(CHUNK, remaining))
+                    if not data:
+                        break
+                    tmp.write(data)
+                    remaining -= len(data)
+            if remaining:
+                self.close_connection = True
+                return
+            # Replaces the archive at once, jobs fetching it get the old or the new one.
+            store.put(key, tmp.name, {'headers': [
+                ('Content-Type', self.headers.get('Content-Type') or 'application/octet-stream'),
+                ('Last-Modified', self.date_time_string())]})
+        except OSError as e:
+            return self.send_error(500, str(e))
+        finally:
+            if os.path.exists(tmp.name):
+                os.unlink(tmp.name)
+        self.server.stats.count('upload', length)
+        self._send_headers(200, [], 0)
+
+
+# The metrics fronted are served on the loopback, never through the upstream proxies in
+# the environment.
+LOCAL_OPENER = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """
+    The scrape endpoint, gitlab-runner metrics followed by the lxd executor stage metrics, the
+    cache counters, those of the shared cache when this unit serves it, and the hook timings.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        pass
+
+    @staticmethod
+    def _fetch(url):
+        """
+        Returns: The metrics served at url, or '' if there are none.
+        """
+        if not url:
+            return ''
+        try:
+            with LOCAL_OPENER.open(url, timeout=5) as response:
+                return response.read().decode()
+        except (OSError, http.client.HTTPException):
+            return ''
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            return self.send_error(404)
+        text = self._fetch(self.server.runner_metrics)
+        text += self._fetch(self.server.lxd_metrics)
+        store = self.server.store
+        text += self.server.stats.render(store.size() if store else 0)
+        shared = self.server.shared_cache
+        if shared:
+            text += shared.stats.render(shared.store.size())
+        if self.server.hook_metrics:
+            try:
+                with open(self.server.hook_metrics) as f:
+                    text += f.read()
+            except FileNotFoundError:
+                pass
+        data = text.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, handler, stats, store=None, opener=None,
+                 ttl=3600, runner_metrics=None, lxd_metrics=None, hook_metrics=None, verbose=False,
+                 bucket=None, credentials=None, shared_cache=None):
+        super().__init__(address, handler)
+        self.stats = stats
+        self.store = store
+        self.opener = opener or urllib.request.build_opener(RedirectHandler)
+        self.ttl = ttl
+        self.runner_metrics = runner_metrics
+        self.lxd_metrics = lxd_metrics
+        self.hook_metrics = hook_metrics
+        self.verbose = verbose
+        # S3Handler: the bucket and the secret key of each access key.
+        self.bucket = bucket
+        self.credentials = credentials or {}
+        # MetricsHandler: the shared cache server of this unit.
+        self.shared_cache = shared_cache
+
+    def tunnel(self, host, port):
+        """
+        Returns: A socket connected to host:port, through the https_proxy if set.
+        """
+        proxy = urllib.request.getproxies().get('https')
+        if not proxy or urllib.request.proxy_bypass(host):
+            return socket.create_connection((host, port), timeout=60)
+        proxy = urllib.parse.urlsplit(proxy)
+        sock = socket.create_connection((proxy.hostname, proxy.port or 80), timeout=60)
+        sock.sendall(f'CONNECT {host}:{port} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n'.encode())
+        response = b''
+        while b'\r\n\r\n' not in response:
+            data = sock.recv(CHUNK)
+            if not data:
+                break
+            response += data
+        if response.split(b' ', 2)[1:2] != [b'200']:
+            sock.close()
+            raise OSError(f'Proxy refused CONNECT {host}:{port}')
+        return sock
+
+
+def _address(value, default_port):
+    host, _, port = value.rpartition(':')
+    return host, int(port or default_port)
+
+
+def main(argv=None):
+    config = load_config()
+    config.update(load_config(SHARED_CACHE_CONFIG))
+    stats = Stats()
+    store = None
+    shared_cache = None
+    servers = []
+
+    # Upstream proxies of the charm http_proxy and https_proxy options.
+    for key in ('http_proxy', 'https_proxy', 'no_proxy'):
+        if config.get(key):
+            os.environ[key] = config[key]
+
+    if config.get('PACKAGE_CACHE_LISTEN'):
+        store = Store(config.get('PACKAGE_CACHE_DIR') or CACHE_DIR,
+                      int(config.get('PACKAGE_CACHE_MAX_SIZE') or 0) * 1024 ** 2)
+        servers.append(Server(_address(config['PACKAGE_CACHE_LISTEN'], 3142), ProxyHandler,
+                              stats, store, ttl=int(config.get('PACKAGE_CACHE_TTL') or 3600),
+                              verbose=config.get('PACKAGE_CACHE_VERBOSE') == 'true'))
+    if config.get('SHARED_CACHE_LISTEN'):
+        shared_cache = Server(_address(config['SHARED_CACHE_LISTEN'], 9000), S3Handler,
+                              Stats('shared_cache', ('hit', 'miss', 'upload')),
+                              Store(config.get('SHARED_CACHE_DIR') or SHARED_CACHE_DIR,
+                                    int(config.get('SHARED_CACHE_MAX_SIZE') or 0) * 1024 ** 2),
+                              verbose=config.get('PACKAGE_CACHE_VERBOSE') == 'true',
+                              bucket=config.get('SHARED_CACHE_BUCKET'),
+                              credentials={config.get('SHARED_CACHE_ACCESS_KEY'):
+                                           config.get('SHARED_CACHE_SECRET_KEY')})
+        servers.append(shared_cache)
+    if config.get('METRICS_LISTEN'):
+        servers.append(Server(_address(config['METRICS_LISTEN'], 9252), MetricsHandler,
+                              stats, store, runner_metrics=config.get('RUNNER_METRICS'),
+                              lxd_metrics=config.get('LXD_METRICS'),
+                              hook_metrics=config.get('HOOK_METRICS'), shared_cache=shared_cache))
+    if not servers:
+        sys.stderr.write(f'Nothing to serve, see {CONFIG_FILE}\n')
+        return 1
+
+    for server in servers[1:]:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    servers[0].serve_forever()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
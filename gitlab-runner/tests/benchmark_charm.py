@@ -0,0 +1,191 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+"""
+Hook cost benchmark. Drives the charm through its hooks with ops.testing.Harness
+while gitlab-runner, apt, lxc and the other programs it runs are replaced by
+fake binaries that sleep CHARM_BENCH_LATENCY seconds (default 0.05). Files the
+charm writes go to a scratch directory.
+
+Not part of the unit tests, run it from the charm directory with:
+
+    PYTHONPATH=lib:src python3 -m unittest -v tests.benchmark_charm
+
+It prints the wall time and subprocesses of every hook and fails when a hook
+runs more subprocesses than SUBPROCESS_BUDGET allows, so changes to the hook
+cost show up in review as a budget change.
+"""
+import os
+import pathlib
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from ops.testing import Harness
+
+sys.path.append(pathlib.Path(__file__).parent.parent.joinpath('src').as_posix())
+
+import gitlab_runner  # noqa: E402
+import hook_timing  # noqa: E402
+from charm import GitlabRunnerCharm  # noqa: E402
+
+LATENCY = os.environ.get('CHARM_BENCH_LATENCY', '0.05')
+
+# Programs the charm runs, all answered by FAKE.
+FAKES = ('apt', 'apt-get', 'curl', 'docker', 'dpkg', 'dpkg-deb', 'dpkg-query', 'gitlab-runner',
+         'ip', 'lxc', 'lxd', 'mkdir', 'snap', 'sudo', 'systemctl', 'useradd')
+FAKE = r'''#!/bin/bash
+sleep "$CHARM_BENCH_LATENCY"
+name="$(basename "$0")"
+if [ "$name" = sudo ]; then
+    while [ "${1#-}" != "$1" ]; do shift; done
+    name="$1"; shift
+fi
+case "$name $1" in
+    "gitlab-runner --version")
+        echo "Version:      14.0.0" ;;
+    "gitlab-runner register")
+        while [ $# -gt 0 ]; do [ "$1" = --name ] && runner="$2"; shift; done
+        printf '\n[[runners]]\n  name = "%s"\n  token = "%s"\n' \
+            "$runner" "$(echo "$runner" | sha1sum | cut -c1-20)" >> "$CHARM_BENCH_RUNNER_CONFIG" ;;
+    "dpkg-deb "* | "dpkg-query "*)
+        echo 14.0.0 ;;
+    "curl "*)
+        while [ $# -gt 0 ]; do [ "$1" = --output ] && output="$2"; url="$1"; shift; done
+        case "$url" in
+            *.sha256) echo "$(echo deb | sha256sum | cut -d' ' -f1) *deb/gitlab-runner_amd64.deb" ;;
+            *) echo deb ;;
+        esac > "$output" ;;
+esac
+exit 0
+'''
+
+# Most subprocesses each measured hook may run, see the module docstring.
+SUBPROCESS_BUDGET = {
+    'install (docker)': 16,
+    'config-changed (docker)': 2,
+    'start (docker)': 1,
+    'update-status (docker)': 0,
+    'config-changed, registered (docker)': 2,
+    'install (lxd)': 17,
+    'config-changed (lxd)': 2,
+    'start (lxd)': 1,
+    'update-status (lxd)': 0,
+}
+
+
+class BenchmarkCharm(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.results = []
+
+    @classmethod
+    def tearDownClass(cls):
+        sys.stderr.write(f'\n{"hook":<36} {"seconds":>8} {"subprocesses":>13} {"in them":>8} {"charm":>8}\n')
+        for name, timing in cls.results:
+            sys.stderr.write(f'{name:<36} {timing.seconds:8.3f} {len(timing.calls):13d} '
+                             f'{timing.subprocess_seconds:8.3f} '
+                             f'{timing.seconds - timing.subprocess_seconds:8.3f}\n')
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = pathlib.Path(tmp.name)
+        bin_dir = self.root.joinpath('bin')
+        bin_dir.mkdir()
+        fake = bin_dir.joinpath('fake')
+        fake.write_text(FAKE)
+        fake.chmod(fake.stat().st_mode | stat.S_IEXEC)
+        for name in FAKES:
+            bin_dir.joinpath(name).symlink_to(fake)
+
+        runner_config = self.root.joinpath('etc/gitlab-runner/config.toml')
+        runner_config.parent.mkdir(parents=True)
+        # Left by the gitlab-runner package.
+        runner_config.write_text('concurrent = 1\n')
+        env = {'PATH': f'{bin_dir}:{os.environ["PATH"]}',
+               'CHARM_BENCH_LATENCY': LATENCY,
+               'CHARM_BENCH_RUNNER_CONFIG': runner_config.as_posix()}
+        constants = {'RUNNER_CONFIG': runner_config,
+                     'RUNNER_DEB_DIR': self.root.joinpath('var/cache/gitlab-runner'),
+                     'LXD_EXECUTOR_STATE': self.root.joinpath('var/lib/lxd-executor'),
+                     'PACKAGE_CACHE_DIR': self.root.joinpath('var/cache/package-cache'),
+                     'SHARED_CACHE_CONFIG': self.root.joinpath('etc/default/shared-cache'),
+                     'DOCKER_DAEMON_CONFIG': self.root.joinpath('etc/docker/daemon.json')}
+        patches = [patch.dict(os.environ, env),
+                   patch('hook_timing.HOOK_TIMINGS', self.scratch('/var/lib/hook-timings.json')),
+                   patch('hook_timing.HOOK_METRICS', self.scratch('/var/lib/hook-metrics.prom')),
+                   patch('gitlab_runner._render_template', self.redirect(gitlab_runner._render_template, 2)),
+                   patch('shutil.copy2', self.redirect(shutil.copy2, 1))]
+        patches += [patch(f'gitlab_runner.{name}', path.as_posix()) for name, path in constants.items()]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        gitlab_runner._runners_cache.clear()
+
+        self.harness = Harness(GitlabRunnerCharm)
+        self.addCleanup(self.harness.cleanup)
+        self.harness.begin()
+
+    def scratch(self, path) -> str:
+        """
+        Returns: path below the scratch directory, with its directory created.
+        """
+        path = str(path)
+        if path.startswith(f'{self.root}/'):
+            return path
+        target = self.root.joinpath(path.lstrip('/'))
+        # A trailing slash names a directory to copy into.
+        directory = target if path.endswith('/') else target.parent
+        directory.mkdir(parents=True, exist_ok=True)
+        return f'{target}/' if path.endswith('/') else target.as_posix()
+
+    def redirect(self, func, index):
+        """
+        Returns: func writing its argument at index below the scratch directory.
+        """
+        def redirected(*args, **kwargs):
+            args = list(args)
+            args[index] = type(args[index])(self.scratch(args[index]))
+            return func(*args, **kwargs)
+        return redirected
+
+    def measure(self, name, emit):
+        """Runs a hook and checks it against its subprocess budget."""
+        count = len(hook_timing.completed)
+        emit()
+        timings = hook_timing.completed[count:]
+        self.assertEqual(len(timings), 1, msg=f"{name} ran {len(timings)} hooks")
+        timing = timings[0]
+        self.results.append((name, timing))
+        self.assertLessEqual(len(timing.calls), SUBPROCESS_BUDGET[name],
+                             msg=f"{name} runs more subprocesses than budgeted: "
+                                 f"{[command for command, _, _ in timing.calls]}")
+        return timing
+
+    def deploy(self, executor):
+        self.harness.disable_hooks()
+        self.harness.update_config({'gitlab-registration-token': 'abcdEFGH',
+                                    'gitlab-server': 'https://gitlab.example.com',
+                                    'executor': executor})
+        self.harness.enable_hooks()
+        self.measure(f'install ({executor})', self.harness.charm.on.install.emit)
+        self.measure(f'config-changed ({executor})', lambda: self.harness.update_config({}))
+        self.measure(f'start ({executor})', self.harness.charm.on.start.emit)
+
+    def test_01_docker_hooks(self):
+        self.deploy('docker')
+        self.assertEqual(self.harness.charm.unit.status.name, 'active', msg=self.harness.charm.unit.status.message)
+        self.measure('update-status (docker)', self.harness.charm.on.update_status.emit)
+        self.measure('config-changed, registered (docker)',
+                     lambda: self.harness.update_config({'check-interval': 5}))
+
+    def test_02_lxd_hooks(self):
+        # LXD itself is left out, its API is not a subprocess.
+        with patch('gitlab_runner.lxd_executor.LXDClient') as client:
+            client.return_value.storage_pool.return_value = {'driver': 'dir'}
+            self.deploy('lxd')
+            self.measure('update-status (lxd)', self.harness.charm.on.update_status.emit)
@@ -0,0 +1,357 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+"""
+A stand-in for the LXD REST API on a unix socket.
+
+Implements the subset used by lxd_executor, including exec websockets, and
+keeps instances, profiles and images in memory. Commands run through exec are
+answered by FakeLXD.exec_handler.
+"""
+import base64
+import hashlib
+import json
+import re
+import socketserver
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, unquote, urlparse
+
+from lxd_executor import WebSocket
+
+
+class FakeLXD:
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.instances = {}
+        self.profiles = {'default': {}}
+        self.profile_devices = {}
+        self.networks = {'lxdbr0': {}}
+        self.storage_pools = {'default': {'driver': 'dir', 'config': {}}}
+        self.images = {}
+        self.aliases = {}
+        self.operations = {}
+        self.requests = []
+        self.commands = []
+        # (instance, path) -> pushed file content
+        self.files = {}
+        self.connections = 0
+        self.websockets = 0
+        self.lock = threading.Lock()
+        # (instance, command, stdin) -> (stdout, stderr, return code)
+        self.exec_handler = lambda name, command, stdin: (b'', b'', 0)
+
+        self._server = socketserver.ThreadingUnixStreamServer(socket_path, _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_instance(self, name, status='Running', source=None, created_at=None):
+        created_at = created_at or time.strftime('%Y-%m-%dT%H:%M:%S.000000000Z', time.gmtime())
+        self.instances[name] = {'name': name, 'status': status, 'profiles': ['default'],
+                                'source': source or {}, 'config': {}, 'devices': {}, 'snapshots': {},
+                                'created_at': created_at}
+
+    def operation(self, metadata=None, status_code=200, err=''):
+        status = {200: 'Success', 103: 'Running'}.get(status_code, 'Failure')
+        op = {'id': str(uuid.uuid4()), 'status_code': status_code, 'status': status,
+              'err': err, 'metadata': metadata or {}, 'done': threading.Event()}
+        if status_code != 103:
+            op['done'].set()
+        self.operations[op['id']] = op
+        return op
+
+
+def _public(op):
+    return {k: v for k, v in op.items() if k not in ('done', 'exec')}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.fake.lock:
+            self.server.fake.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length) if length else b''
+        if self.headers.get('Content-Type') == 'application/json':
+            return json.loads(data.decode())
+        return data
+
+    def _send(self, payload, status=200):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _sync(self, metadata=None):
+        self._send({'type': 'sync', 'status_code': 200, 'metadata': metadata})
+
+    def _async(self, op):
+        self._send({'type': 'async', 'status_code': 100,
+                    'operation': f"/1.0/operations/{op['id']}", 'metadata': _public(op)}, 202)
+
+    def _error(self, code, message):
+        self._send({'type': 'error', 'error_code': code, 'error': message}, code)
+
+    def _dispatch(self):
+        url = urlparse(self.path)
+        path, query = unquote(url.path), parse_qs(url.query)
+        self.fake.requests.append((self.command, path))
+        body = self._body()
+        for method, pattern, handler in _ROUTES:
+            match = re.fullmatch(pattern, path)
+            if match and method == self.command:
+                return handler(self, body, query, *match.groups())
+        self._error(404, f'{self.command} {path} not found')
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _dispatch
+
+    # Instances
+
+    def instances(self, body, query):
+        if query.get('recursion') == ['1']:
+            return self._sync(list(self.fake.instances.values()))
+        self._sync([f'/1.0/instances/{name}' for name in self.fake.instances])
+
+    def instance(self, body, query, name):
+        if name not in self.fake.instances:
+            return self._error(404, 'Instance not found')
+        self._sync(self.fake.instances[name])
+
+    def create_instance(self, body, query):
+        # Checked and created at once, parallel jobs must see the conflict.
+        with self.fake.lock:
+            if body['name'] in self.fake.instances:
+                return self._error(409, 'Instance already exists')
+            self.fake.add_instance(body['name'], 'Stopped', body['source'])
+            self.fake.instances[body['name']]['profiles'] = body['profiles']
+        self._async(self.fake.operation())
+
+    def instance_state(self, body, query, name):
+        if name not in self.fake.instances:
+            return self._error(404, 'Instance not found')
+        self.fake.instances[name]['status'] = 'Running' if body['action'] == 'start' else 'Stopped'
+        self._async(self.fake.operation())
+
+    def delete_instance(self, body, query, name):
+        with self.fake.lock:
+            if name not in self.fake.instances:
+                return self._error(404, 'Instance not found')
+            if self.fake.instances[name]['status'] != 'Stopped':
+                return self._error(400, 'Instance is running')
+            del self.fake.instances[name]
+        self._async(self.fake.operation())
+
+    def rename_instance(self, body, query, name):
+        with self.fake.lock:
+            instance = self.fake.instances.get(name)
+            if not instance:
+                return self._error(404, 'Instance not found')
+            if instance['status'] != 'Stopped':
+                return self._error(400, 'Renaming of running instance not allowed')
+            if body['name'] in self.fake.instances:
+                return self._error(409, 'Instance already exists')
+            instance['name'] = body['name']
+            self.fake.instances[body['name']] = self.fake.instances.pop(name)
+        self._async(self.fake.operation())
+
+    def patch_instance(self, body, query, name):
+        if name not in self.fake.instances:
+            return self._error(404, 'Instance not found')
+        instance = self.fake.instances[name]
+        instance['config'].update(body.get('config', {}))
+        instance['devices'].update(body.get('devices', {}))
+        if 'profiles' in body:
+            instance['profiles'] = body['profiles']
+        self._sync()
+
+    def restore_instance(self, body, query, name):
+        instance = self.fake.instances.get(name)
+        if not instance or body['restore'] not in instance['snapshots']:
+            return self._error(404, 'Snapshot not found')
+        if instance['status'] != 'Stopped':
+            return self._error(400, 'Instance is running')
+        instance['config'] = dict(instance['snapshots'][body['restore']])
+        instance['restored'] = instance.get('restored', 0) + 1
+        self._async(self.fake.operation())
+
+    def create_snapshot(self, body, query, name):
+        instance = self.fake.instances[name]
+        instance['snapshots'][body['name']] = dict(instance['config'])
+        self._async(self.fake.operation())
+
+    def push_file(self, body, query, name):
+        self.fake.files[(name, query['path'][0])] = body
+        self._sync()
+
+    def exec(self, body, query, name):
+        instance = self.fake.instances.get(name)
+        if not instance or instance['status'] != 'Running':
+            return self._error(400, 'Instance is not running')
+        self.fake.commands.append((name, body['command']))
+        if not body['wait-for-websocket']:
+            _, _, rc = self.fake.exec_handler(name, body['command'], b'')
+            return self._async(self.fake.operation({'return': rc}))
+        fds = {fd: uuid.uuid4().hex for fd in ('0', '1', '2', 'control')}
+        op = self.fake.operation({'fds': fds}, status_code=103)
+        op['exec'] = {'name': name, 'command': body['command'], 'fds': fds,
+                      'result': None, 'ready': threading.Event(), 'sent': 0}
+        self._async(op)
+
+    # Profiles, networks and images
+
+    def patch_profile(self, body, query, name):
+        if name not in self.fake.profiles:
+            return self._error(404, 'Profile not found')
+        self.fake.profiles[name].update(body['config'])
+        self._sync()
+
+    def put_profile(self, body, query, name):
+        if name not in self.fake.profiles:
+            return self._error(404, 'Profile not found')
+        self.fake.profiles[name] = dict(body.get('config', {}))
+        self.fake.profile_devices[name] = dict(body.get('devices', {}))
+        self._sync()
+
+    def create_profile(self, body, query):
+        self.fake.profiles[body['name']] = dict(body.get('config', {}))
+        self.fake.profile_devices[body['name']] = dict(body.get('devices', {}))
+        self._sync()
+
+    def patch_network(self, body, query, name):
+        self.fake.networks.setdefault(name, {}).update(body['config'])
+        self._sync()
+
+    def storage_pool(self, body, query, name):
+        if name not in self.fake.storage_pools:
+            return self._error(404, 'Storage pool not found')
+        self._sync(dict(self.fake.storage_pools[name], name=name))
+
+    def create_storage_pool(self, body, query):
+        self.fake.storage_pools[body['name']] = {'driver': body['driver'], 'config': body['config']}
+        self._sync()
+
+    def alias(self, body, query, name):
+        if name not in self.fake.aliases:
+            return self._error(404, 'Alias not found')
+        self._sync({'name': name, 'target': self.fake.aliases[name]})
+
+    def update_alias(self, body, query, name):
+        self.fake.aliases[name] = body['target']
+        self._sync()
+
+    def create_alias(self, body, query):
+        self.fake.aliases[body['name']] = body['target']
+        self._sync()
+
+    def publish(self, body, query):
+        fingerprint = hashlib.sha256(uuid.uuid4().bytes).hexdigest()
+        self.fake.images[fingerprint] = body['source']
+        self._async(self.fake.operation({'fingerprint': fingerprint}))
+
+    def delete_image(self, body, query, fingerprint):
+        self.fake.images.pop(fingerprint, None)
+        self._async(self.fake.operation())
+
+    # Operations
+
+    def wait(self, body, query, op_id):
+        op = self.fake.operations.get(op_id)
+        if not op:
+            return self._error(404, 'Operation not found')
+        timeout = float(query.get('timeout', ['-1'])[0])
+        op['done'].wait(None if timeout < 0 else timeout)
+        self._sync(_public(op))
+
+    def websocket(self, body, query, op_id):
+        op = self.fake.operations[op_id]
+        secret = query['secret'][0]
+        fd = [fd for fd, s in op['exec']['fds'].items() if s == secret][0]
+        accept = base64.b64encode(hashlib.sha1(
+            (self.headers['Sec-WebSocket-Key'] + WebSocket.GUID).encode()).digest()).decode()
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+        with self.fake.lock:
+            self.fake.websockets += 1
+
+        ws = WebSocket(self.connection, mask=False)
+        exec_ = op['exec']
+        if fd == '0':
+            stdin = b''
+            while True:
+                opcode, payload = ws.recv()
+                if opcode == WebSocket.OP_CLOSE:
+                    break
+                stdin += payload
+            exec_['result'] = self.fake.exec_handler(exec_['name'], exec_['command'], stdin)
+            exec_['ready'].set()
+        elif fd in ('1', '2'):
+            exec_['ready'].wait()
+            output = exec_['result'][int(fd) - 1]
+            if output:
+                ws.send(output)
+            ws.send(b'', WebSocket.OP_CLOSE)
+            with self.fake.lock:
+                exec_['sent'] += 1
+                if exec_['sent'] == 2:
+                    op.update(status_code=200, status='Success',
+                              metadata={'return': exec_['result'][2]})
+                    op['done'].set()
+        else:
+            op['done'].wait()
+
+
+_ROUTES = [
+    ('GET', '/1.0/instances', _Handler.instances),
+    ('POST', '/1.0/instances', _Handler.create_instance),
+    ('GET', '/1.0/instances/([^/]+)', _Handler.instance),
+    ('DELETE', '/1.0/instances/([^/]+)', _Handler.delete_instance),
+    ('POST', '/1.0/instances/([^/]+)', _Handler.rename_instance),
+    ('PATCH', '/1.0/instances/([^/]+)', _Handler.patch_instance),
+    ('PUT', '/1.0/instances/([^/]+)', _Handler.restore_instance),
+    ('POST', '/1.0/instances/([^/]+)/snapshots', _Handler.create_snapshot),
+    ('PUT', '/1.0/instances/([^/]+)/state', _Handler.instance_state),
+    ('POST', '/1.0/instances/([^/]+)/exec', _Handler.exec),
+    ('POST', '/1.0/instances/([^/]+)/files', _Handler.push_file),
+    ('PATCH', '/1.0/profiles/([^/]+)', _Handler.patch_profile),
+    ('PUT', '/1.0/profiles/([^/]+)', _Handler.put_profile),
+    ('POST', '/1.0/profiles', _Handler.create_profile),
+    ('PATCH', '/1.0/networks/([^/]+)', _Handler.patch_network),
+    ('GET', '/1.0/storage-pools/([^/]+)', _Handler.storage_pool),
+    ('POST', '/1.0/storage-pools', _Handler.create_storage_pool),
+    ('GET', '/1.0/images/aliases/(.+)', _Handler.alias),
+    ('PUT', '/1.0/images/aliases/(.+)', _Handler.update_alias),
+    ('POST', '/1.0/images/aliases', _Handler.create_alias),
+    ('POST', '/1.0/images', _Handler.publish),
+    ('DELETE', '/1.0/images/([^/]+)', _Handler.delete_image),
+    ('GET', '/1.0/operations/([^/]+)/wait', _Handler.wait),
+    ('GET', '/1.0/operations/([^/]+)/websocket', _Handler.websocket),
+]
@@ -0,0 +1,239 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+"""
+Load test of the lxd custom executor. Runs jobs the way gitlab-runner does at a
+given concurrency: every job calls the installed prepare.sh, run.sh once per
+stage with a script file and the stage name, then cleanup.sh, with the
+CUSTOM_ENV_* variables gitlab-runner sets. FakeLXD stands in for LXD, and a
+background thread reaps and refills the pool like the lxd-executor services.
+
+Run it from the charm directory:
+
+    PYTHONPATH=lib:src python3 -m tests.loadtest_lxd_executor --jobs 64 --concurrent 16
+
+It reports the p50 and p99 latency of each stage, the job throughput and the
+failures, and exits 1 when any stage failed or a p99 is above --max-p99, so it
+can gate executor performance changes.
+"""
+import argparse
+import concurrent.futures
+import glob
+import math
+import os
+import pathlib
+import queue
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(pathlib.Path(__file__).parent.parent.joinpath('src').as_posix())
+
+import lxd_executor  # noqa: E402
+from tests.fake_lxd import FakeLXD  # noqa: E402
+
+CHARM_DIR = pathlib.Path(__file__).parent.parent
+# The run stages of a job, in the order gitlab-runner calls them.
+RUN_STAGES = ('prepare_script', 'get_sources', 'restore_cache', 'step_script', 'after_script',
+              'archive_cache', 'upload_artifacts_on_success', 'cleanup_file_variables')
+SYSTEM_FAILURE = 2
+BUILD_FAILURE = 3
+
+
+def percentile(values, p) -> float:
+    """
+    Returns: The nearest rank p-th percentile of values, 0 without any.
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(math.ceil(p / 100 * len(values)), 1) - 1]
+
+
+class LoadTest:
+    """Simulated gitlab-runner jobs against an installed executor and FakeLXD."""
+
+    def __init__(self, root, jobs=32, concurrent=8, projects=4, exec_latency=0.0, config=None):
+        self.root = pathlib.Path(root)
+        self.jobs = jobs
+        self.concurrent = concurrent
+        self.projects = projects
+        self.exec_latency = exec_latency
+        self.executor_dir = self.root.joinpath('opt/lxd-executor')
+        self.config_file = self.root.joinpath('lxd-executor')
+        self.config = {'LXD_SOCKET': self.root.joinpath('lxd.socket').as_posix(),
+                       'LXD_EXECUTOR_STATE': self.root.joinpath('state').as_posix(),
+                       'LXD_BOOT_TIMEOUT': '10'}
+        self.config.update(config or {})
+        # (stage, seconds, returncode)
+        self.results = []
+        self.failures = []
+        self.lock = threading.Lock()
+        self.project_slots = {}
+        self.seconds = 0.0
+        self.fake = None
+
+    def install(self):
+        """Installs the stage wrappers and lxd_executor.py like the charm does."""
+        self.executor_dir.mkdir(parents=True)
+        for wrapper in glob.glob(CHARM_DIR.joinpath('templates/lxd-executor/*.sh').as_posix()):
+            installed = pathlib.Path(shutil.copy2(wrapper, self.executor_dir))
+            installed.chmod(installed.stat().st_mode | stat.S_IEXEC)
+        shutil.copy2(CHARM_DIR.joinpath('src/lxd_executor.py'), self.executor_dir)
+        self.config_file.write_text(''.join(f'{key}={value}\n' for key, value in self.config.items()))
+
+    def exec_handler(self, name, command, stdin):
+        time.sleep(self.exec_latency)
+        return stdin, b'', 0
+
+    def stage(self, stage, args, env):
+        started = time.monotonic()
+        process = subprocess.run([self.executor_dir.joinpath(f'{stage}.sh').as_posix()] + args, env=env,
+                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        seconds = time.monotonic() - started
+        with self.lock:
+            self.results.append((stage, seconds, process.returncode))
+            if process.returncode:
+                self.failures.append((stage, env['CUSTOM_ENV_CI_JOB_ID'], process.returncode,
+                                      process.stdout.decode(errors='replace')))
+        return process.returncode
+
+    def project_slot(self, project, release=None):
+        """
+        Returns: The lowest free concurrent project slot of project, like
+        CI_CONCURRENT_PROJECT_ID. With release, frees that slot instead.
+        """
+        with self.lock:
+            busy = self.project_slots.setdefault(project, set())
+            if release is not None:
+                busy.discard(release)
+                return release
+            slot = min(set(range(len(busy) + 1)) - busy)
+            busy.add(slot)
+            return slot
+
+    def job(self, job_id, slots):
+        slot = slots.get()
+        project = job_id % self.projects + 1
+        project_slot = self.project_slot(project)
+        try:
+            env = dict(os.environ,
+                       LXD_EXECUTOR_CONFIG=self.config_file.as_posix(),
+                       CUSTOM_ENV_CI_RUNNER_ID='1',
+                       CUSTOM_ENV_CI_JOB_ID=str(job_id),
+                       CUSTOM_ENV_CI_PROJECT_ID=str(project),
+                       CUSTOM_ENV_CI_CONCURRENT_ID=str(slot),
+                       CUSTOM_ENV_CI_CONCURRENT_PROJECT_ID=str(project_slot),
+                       CUSTOM_ENV_CI_PROJECT_DIR=f'/builds/group/project-{project}',
+                       SYSTEM_FAILURE_EXIT_CODE=str(SYSTEM_FAILURE),
+                       BUILD_FAILURE_EXIT_CODE=str(BUILD_FAILURE))
+            if self.stage('prepare', [], env) == 0:
+                script_dir = self.root.joinpath('builds', str(job_id))
+                script_dir.mkdir(parents=True)
+                for name in RUN_STAGES:
+                    script = script_dir.joinpath(f'script-{name}')
+                    script.write_text(f'echo "Running {name} of job {job_id}"\n')
+                    if self.stage('run', [script.as_posix(), name], env):
+                        break
+            # gitlab-runner cleans up after failed jobs too.
+            self.stage('cleanup', [], env)
+        finally:
+            self.project_slot(project, release=project_slot)
+            slots.put(slot)
+
+    def background(self, stop):
+        """Reaps and refills the pool, like the reaper service and pool timer."""
+        config = lxd_executor.load_config(self.config_file.as_posix())
+        with open(os.devnull, 'wb') as devnull:
+            while not stop.wait(0.2):
+                client = lxd_executor.LXDClient(config['LXD_SOCKET'])
+                try:
+                    executor = lxd_executor.Executor(client, config, {}, out=devnull)
+                    executor.reap()
+                    executor.pool()
+                except (lxd_executor.LXDError, OSError) as e:
+                    sys.stderr.write(f'Background pass failed: {e}\n')
+                finally:
+                    client.close()
+
+    def run(self):
+        self.install()
+        self.fake = FakeLXD(self.config['LXD_SOCKET']).start()
+        self.fake.exec_handler = self.exec_handler
+        stop = threading.Event()
+        background = threading.Thread(target=self.background, args=(stop,), daemon=True)
+        background.start()
+        slots = queue.Queue()
+        for slot in range(self.concurrent):
+            slots.put(slot)
+        started = time.monotonic()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(self.concurrent) as workers:
+                for future in [workers.submit(self.job, job_id, slots) for job_id in range(1, self.jobs + 1)]:
+                    future.result()
+            self.seconds = time.monotonic() - started
+        finally:
+            stop.set()
+            background.join()
+            self.fake.stop()
+        return self
+
+    def stages(self) -> dict:
+        """
+        Returns: {stage: (count, failures, p50, p99, max)} of the timed stages.
+        """
+        stages = {}
+        for stage in ('prepare', 'run', 'cleanup'):
+            seconds = [s for name, s, _ in self.results if name == stage]
+            failures = sum(1 for name, _, rc in self.results if name == stage and rc)
+            stages[stage] = (len(seconds), failures, percentile(seconds, 50), percentile(seconds, 99),
+                             max(seconds, default=0.0))
+        return stages
+
+    def report(self, out=sys.stdout):
+        out.write(f'{self.jobs} jobs, {self.concurrent} concurrent, {self.projects} projects, '
+                  f'{self.exec_latency}s exec latency\n\n')
+        out.write(f'{"stage":<10} {"count":>6} {"failed":>6} {"p50":>8} {"p99":>8} {"max":>8}\n')
+        for stage, (count, failures, p50, p99, slowest) in self.stages().items():
+            out.write(f'{stage:<10} {count:6d} {failures:6d} {p50:8.3f} {p99:8.3f} {slowest:8.3f}\n')
+        out.write(f'\n{self.jobs / self.seconds:.2f} jobs/s over {self.seconds:.2f}s\n')
+        job_containers = [name for name in self.fake.instances if name.startswith('runner-')]
+        out.write(f'{len(job_containers)} job containers left, '
+                  f'{len(self.fake.requests)} LXD API requests\n')
+        for stage, job_id, rc, output in self.failures[:3]:
+            out.write(f'\n{stage} of job {job_id} exited {rc}:\n{output}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--jobs', type=int, default=64)
+    parser.add_argument('--concurrent', type=int, default=16)
+    parser.add_argument('--projects', type=int, default=4)
+    parser.add_argument('--exec-latency', type=float, default=0.01,
+                        help='seconds every command run in a container takes')
+    parser.add_argument('--config', action='append', default=[], metavar='KEY=VALUE',
+                        help='executor setting, e.g. LXD_RECYCLE=true')
+    parser.add_argument('--max-p99', action='append', default=[], metavar='STAGE=SECONDS',
+                        help='fail when the p99 latency of a stage is above SECONDS')
+    args = parser.parse_args(argv)
+
+    config = dict(entry.split('=', 1) for entry in args.config)
+    limits = {stage: float(seconds) for stage, seconds in (entry.split('=', 1) for entry in args.max_p99)}
+    with tempfile.TemporaryDirectory() as root:
+        test = LoadTest(root, args.jobs, args.concurrent, args.projects, args.exec_latency, config).run()
+        test.report()
+
+    failed = bool(test.failures)
+    for stage, limit in limits.items():
+        p99 = test.stages()[stage][3]
+        if p99 > limit:
+            sys.stdout.write(f'{stage} p99 {p99:.3f}s is above {limit}s\n')
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
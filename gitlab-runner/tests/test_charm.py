@@ -2,19 +2,29 @@
 # See LICENSE file for licensing details.
 #
 # Learn more about testing at: https://juju.is/docs/sdk/testing
+import hashlib
+import http.server
+import json
+import os
 import pathlib
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 import ops.testing
+from ops.model import BlockedStatus
+import toml
 from ops.testing import Harness
 
 # Set testing environmental variable
 ops.testing.SIMULATE_CAN_CONNECT = True
 
 # Get paths
-current_path = pathlib.Path.cwd()
+current_path = pathlib.Path(__file__).resolve().parent
 src_path = current_path.parent.joinpath('src')
 templates_path = current_path.parent.joinpath('templates')
 
@@ -24,8 +34,24 @@ print(f"Current path: {current_path.as_posix()}\n"
 
 sys.path.append(src_path.as_posix())
 try:
-    from charm import GitlabRunnerCharm
+    from charm import GitlabRunnerCharm, NOT_INSTALLED
     from gitlab_runner import register_docker
+    from gitlab_runner import lxd_pool_size
+    from gitlab_runner import expire_golden_images
+    from gitlab_runner import lxd_profile_config, lxd_slot_cpus
+    from gitlab_runner import job_proxies
+    from gitlab_runner import get_token
+    from gitlab_runner import reconcile_config, REGISTER_AGAIN
+    from gitlab_runner import build_tmpfs_mounts, lxd_storage_pool, _render_template
+    from gitlab_runner import render_lxd_executor_config, _render_docker_template
+    from gitlab_runner import drain, running_jobs, stream
+    from gitlab_runner import fqdn, runner_capacity, runner_specs
+    from gitlab_runner import concurrency, desired_config
+    from gitlab_runner import check_docker_pull_policy, docker_pull_images, install_docker_executor_services
+    from gitlab_runner import configure_docker_mirror, registry_mirror_ready
+    from gitlab_runner import download_runner_deb
+    from gitlab_runner import check_shared_cache_config, runner_cache, shared_cache_endpoint, _register
+    import hook_timing
 except ImportError:
     print("ERROR: Import of charm.GitlabRunnerCharm failed!")
     raise
@@ -42,30 +68,81 @@ class MockCharm:
         self.config['run-untagged'] = True
         self.config['locked'] = True
         self.config['executor'] = "docker"
+        self.config['runners'] = ""
 
         self.config[''] = ""
         self.config['check-interval'] = 3
         self.config['sentry-dsn'] = True
         self.config['locked'] = True
         self.config['concurrent'] = 1
+        self.config['drain-timeout'] = 1800
         self.config['log-level'] = "error"
         self.config['log-format'] = "docker:latest"
         self.config['docker-image'] = "docker:latest"
         self.config['docker-tmpfs'] = "/scratch:rw,exec,size=1g"
+        self.config['docker-in-docker'] = False
+        self.config['lxd-boot-timeout'] = 60
+        self.config['lxd-recycle-containers'] = False
+        self.config['lxd-reaper-parallelism'] = 2
+        self.config['lxd-reaper-max-age'] = 24
+        self.config['lxd-pool-size'] = 0
+        self.config['lxd-pool-images'] = "ubuntu:18.04"
+        self.config['lxd-golden-images'] = False
+        self.config['lxd-exec-agent'] = False
+        self.config['lxd-golden-image-max-age'] = 168
+        self.config['lxd-resource-limits'] = ''
+        self.config['lxd-project-cache'] = False
+        self.config['build-tmpfs'] = ''
+        self.config['lxd-storage-pool'] = ''
+        self.config['docker-volume-driver'] = ''
+        self.config['docker-pull-policy'] = ''
+        self.config['docker-pull-images'] = ''
+        self.config['docker-pull-interval'] = 6
+        self.config['registry-mirror'] = ''
+        self.config['registry-mirror-upstream'] = 'https://registry-1.docker.io'
+        self.config['lxd-project-cache-max-size'] = 51200
+        self.config['package-cache'] = False
+        self.config['package-cache-max-size'] = 10240
+        self.config['http_proxy'] = ''
+        self.config['https_proxy'] = ''
+        self.config['no_proxy'] = 'localhost,127.0.0.1,::1,docker,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16'
+        self.config['gitlab-runner-architecture'] = 'amd64'
+        self.config['shared-cache'] = ''
+        self.config['shared-cache-bucket'] = 'runner-cache'
+        self.config['shared-cache-access-key'] = ''
+        self.config['shared-cache-secret-key'] = ''
+        self.config['shared-cache-max-size'] = 51200
 
 
 class TestCharm(unittest.TestCase):
 
     def setUp(self):
+        # Hook timings and the shared cache config are written to a scratch directory.
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.timings = pathlib.Path(tmp.name)
+        patchers = [patch(f'hook_timing.{name}', self.timings.joinpath(name.lower()).as_posix())
+                    for name in ('HOOK_TIMINGS', 'HOOK_METRICS')]
+        patchers.append(patch('gitlab_runner.SHARED_CACHE_CONFIG', self.timings.joinpath('shared-cache').as_posix()))
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
         self.harness = Harness(GitlabRunnerCharm)
         self.addCleanup(self.harness.cleanup)
         self.harness.begin()
 
+    @patch('gitlab_runner.runner_names')
+    @patch('gitlab_runner.render_runner_templates')
+    @patch('gitlab_runner.render_package_cache_config')
     @patch('subprocess.Popen')
     @patch('subprocess.run')
     @patch('gitlab_runner.get_token')
-    def test_01_config_changed_docker(self, mock_subprocess_popen, mock_subprocess_run, mock_get_token):
+    def test_01_config_changed_docker(self, mock_get_token, mock_subprocess_run, mock_subprocess_popen,
+                                      mock_render_package_cache_config, mock_render_runner_templates,
+                                      mock_runner_names):
         # Mock return code from processes
+        mock_runner_names.return_value = [fqdn()]
+        mock_render_runner_templates.return_value = False
         mock_subprocess_popen.return_value.returncode = 0
         mock_subprocess_run.return_value.returncode = 0
         mock_get_token.return_value = 'ABCDEFGH'
@@ -80,11 +157,21 @@ class TestCharm(unittest.TestCase):
         print(f" Unit status after config changed:\n\t{harness.charm.unit.status}")
         self.assertEqual(harness.charm.config["executor"], "docker", msg='Executor not as configured')
 
+    @patch('gitlab_runner.runner_names')
+    @patch('gitlab_runner.render_runner_templates')
+    @patch('gitlab_runner.render_package_cache_config')
+    @patch('gitlab_runner.configure_lxd')
+    @patch('gitlab_runner.render_lxd_executor_config')
     @patch('subprocess.Popen')
     @patch('subprocess.run')
     @patch('gitlab_runner.get_token')
-    def test_02_config_changed_lxd(self, mock_subprocess_popen, mock_subprocess_run, mock_get_token):
+    def test_02_config_changed_lxd(self, mock_get_token, mock_subprocess_run, mock_subprocess_popen,
+                                   mock_render_lxd_executor_config, mock_configure_lxd,
+                                   mock_render_package_cache_config, mock_render_runner_templates,
+                                   mock_runner_names):
         # Mock return code from processes
+        mock_runner_names.return_value = [fqdn()]
+        mock_render_runner_templates.return_value = False
         mock_subprocess_popen.return_value.returncode = 0
         mock_subprocess_run.return_value.returncode = 0
         mock_get_token.return_value = 'ABCDEFGH'
@@ -99,12 +186,967 @@ class TestCharm(unittest.TestCase):
         print(f" Unit status after config changed:\n\t{harness.charm.unit.status}")
         self.assertEqual(harness.charm.config["executor"], "lxd", msg='Executor not as configured')
 
+    @patch('gitlab_runner.lxd_reaper_backlog')
+    @patch('gitlab_runner.gitlab_runner_registered_already')
+    @patch('gitlab_runner.get_token')
+    def test_03_update_status_reports_reaper_backlog(self, mock_get_token, mock_registered,
+                                                     mock_backlog):
+        mock_get_token.return_value = 'ABCDEFGH'
+        mock_registered.return_value = True
+        mock_backlog.return_value = 3
+
+        self.harness.charm._stored.executor = 'lxd'
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.charm.unit.status.message, "Ready lxd(ABCDEFGH) reaping 3")
+
+    @patch('gitlab_runner.gitlab_runner_registered_already')
+    @patch('gitlab_runner.get_token')
+    def test_04_verify_is_cached_per_token(self, mock_get_token, mock_registered):
+        mock_get_token.return_value = 'ABCDEFGH'
+        mock_registered.return_value = True
+
+        for _ in range(3):
+            self.harness.charm.on.update_status.emit()
+        self.assertEqual(mock_registered.call_count, 1, msg="Verify not cached")
+
+        mock_get_token.return_value = 'IJKLMNOP'
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(mock_registered.call_count, 2, msg="Cached verify of another token used")
+
+        with patch('charm.time.time', return_value=time.time() + 3600):
+            self.harness.charm.on.update_status.emit()
+        self.assertEqual(mock_registered.call_count, 3, msg="Verify cached past its TTL")
+
+    def test_05_get_token_parses_changed_config_only(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            config = pathlib.Path(tmp, 'config.toml')
+            config.write_text('[[runners]]\ntoken = "ABCDEFGHIJ"\n')
+            with patch('gitlab_runner.RUNNER_CONFIG', config.as_posix()), \
+                    patch('gitlab_runner.toml.load', wraps=toml.load) as mock_load:
+                self.assertEqual(get_token(), 'ABCDEFGH')
+                self.assertEqual(get_token(), 'ABCDEFGH')
+                self.assertEqual(mock_load.call_count, 1, msg="Unchanged config.toml parsed again")
+
+                config.write_text('[[runners]]\ntoken = "QRSTUVWXYZ"\n')
+                os.utime(config.as_posix(), ns=(0, 1))
+                self.assertEqual(get_token(), 'QRSTUVWX')
+
+    @patch('gitlab_runner.drain')
+    @patch('gitlab_runner.unregister')
+    def test_06_stop_drains_before_unregistering(self, mock_unregister, mock_drain):
+        statuses = []
+
+        def drain(timeout, progress):
+            self.assertFalse(mock_unregister.called, msg="Unregistered while draining")
+            progress(3)
+            statuses.append(self.harness.charm.unit.status.message)
+            return 0
+
+        mock_drain.side_effect = drain
+        self.harness.charm.on.stop.emit()
+        self.assertEqual(statuses, ["draining: 3 jobs left"])
+        self.assertEqual(mock_drain.call_args[0][0], 1800)
+        mock_unregister.assert_called_once()
+
+        mock_drain.reset_mock()
+        self.harness.disable_hooks()
+        self.harness.update_config({'drain-timeout': 0})
+        self.harness.enable_hooks()
+        self.harness.charm.on.stop.emit()
+        self.assertFalse(mock_drain.called, msg="Drained with drain-timeout=0")
+
+    @patch('gitlab_runner.installed_version')
+    @patch('gitlab_runner.deb_version')
+    @patch('gitlab_runner.download_runner_deb')
+    @patch('gitlab_runner.install_runner_deb')
+    @patch('subprocess.run')
+    @patch('charm.GitlabRunnerCharm.drain')
+    @patch('charm.GitlabRunnerCharm._on_register_action')
+    def test_07_upgrade_drains_only_for_a_new_version(self, mock_register_action, mock_drain, mock_subprocess_run,
+                                                      mock_install, mock_download, mock_deb_version,
+                                                      mock_installed_version):
+        mock_download.return_value = '/var/cache/gitlab-runner/gitlab-runner_amd64.deb'
+        mock_deb_version.return_value = '14.3.0'
+        mock_installed_version.return_value = '14.3.0'
+        mock_drain.return_value = 0
+        mock_install.return_value = True
+        self.harness.charm._stored.executor = 'docker'
+
+        event = MagicMock()
+        self.harness.charm._on_upgrade_action(event)
+        self.assertFalse(mock_drain.called, msg="Drained for the installed version")
+        self.assertFalse(mock_install.called)
+        self.assertEqual(list(event.set_results.call_args_list[0][0][0]), ['download-seconds'])
+
+        mock_installed_version.return_value = '14.2.0'
+        event = MagicMock()
+        self.harness.charm._on_upgrade_action(event)
+        mock_drain.assert_called_once()
+        mock_install.assert_called_once_with(mock_download.return_value, log=event.log)
+        self.assertEqual(sorted(event.set_results.call_args_list[0][0][0]),
+                         ['download-seconds', 'drain-seconds', 'install-seconds'])
+        self.assertFalse(event.fail.called)
+
+    @patch('gitlab_runner.register_lxd')
+    @patch('gitlab_runner.register_docker')
+    @patch('gitlab_runner.unregister')
+    @patch('gitlab_runner.job_proxies')
+    @patch('gitlab_runner.runner_names')
+    def test_08_register_covers_all_runner_specs(self, mock_runner_names, mock_job_proxies, mock_unregister,
+                                                 mock_register_docker, mock_register_lxd):
+        mock_job_proxies.return_value = (None, None)
+        mock_register_docker.return_value = True
+        mock_register_lxd.return_value = True
+        host = fqdn()
+        mock_runner_names.return_value = [host, f'{host}-big']
+        self.harness.charm._stored.identities = {f'{host}-big': 'outdated'}
+        self.harness.disable_hooks()
+        self.harness.update_config({'runners': '[{name: big, limit: 4}, {name: lxd, executor: lxd}]'})
+
+        self.assertTrue(self.harness.charm.register())
+        self.assertEqual(sorted(c[0][0] for c in mock_unregister.call_args_list), [host, f'{host}-big'],
+                         msg="Removed and changed runners not unregistered")
+        self.assertEqual(mock_register_docker.call_args[0][1]['name'], f'{host}-big')
+        self.assertEqual(mock_register_docker.call_args[0][1]['limit'], 4)
+        self.assertEqual(mock_register_lxd.call_args[0][1]['name'], f'{host}-lxd')
+        self.assertEqual(sorted(self.harness.charm._stored.identities), [f'{host}-big', f'{host}-lxd'])
+
+    @patch('gitlab_runner.host_free_disk')
+    @patch('gitlab_runner.host_resources')
+    @patch('gitlab_runner.lxd_reaper_backlog')
+    @patch('gitlab_runner.gitlab_runner_registered_already')
+    @patch('gitlab_runner.get_token')
+    def test_09_update_status_reports_auto_sizing(self, mock_get_token, mock_registered, mock_backlog,
+                                                  mock_host_resources, mock_host_free_disk):
+        mock_get_token.return_value = 'ABCDEFGH'
+        mock_registered.return_value = True
+        mock_host_resources.return_value = (8, 9216)
+        mock_host_free_disk.return_value = 102400
+        self.harness.charm._stored.executor = 'docker'
+        self.harness.disable_hooks()
+        self.harness.update_config({'concurrent': -1})
+
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.charm.unit.status.message,
+                         "Ready docker(ABCDEFGH) auto: 4 jobs, 2.0 cpus, 2048MB each")
+
+    @patch('interface_peers.RunnerPeers.address')
+    @patch('gitlab_runner.configure_docker_mirror')
+    @patch('gitlab_runner.registry_mirror_ready')
+    @patch('gitlab_runner.run_registry_mirror')
+    def test_10_registry_mirror_is_shared_by_the_leader(self, mock_run_registry_mirror, mock_ready,
+                                                        mock_configure_docker_mirror, mock_address):
+        mock_run_registry_mirror.return_value = True
+        mock_ready.return_value = True
+        mock_address.return_value = '10.0.0.1'
+        self.harness.charm._stored.executor = 'docker'
+        relation_id = self.harness.add_relation('runners', 'gitlab-runner')
+        self.harness.disable_hooks()
+        self.harness.update_config({'registry-mirror': 'local'})
+        self.harness.enable_hooks()
+
+        self.harness.set_leader(True)
+        mock_run_registry_mirror.assert_called_once_with('https://registry-1.docker.io')
+        mock_configure_docker_mirror.assert_called_with('http://127.0.0.1:5000')
+        self.assertEqual(self.harness.get_relation_data(relation_id, 'gitlab-runner')['registry-mirror'],
+                         'http://10.0.0.1:5000')
+
+        self.harness.set_leader(False)
+        self.harness.charm.configure_registry_mirror()
+        mock_configure_docker_mirror.assert_called_with('http://10.0.0.1:5000')
+        self.assertEqual(mock_run_registry_mirror.call_count, 1, msg="Mirror run on a non leader")
+
+        mock_ready.return_value = False
+        self.harness.charm.configure_registry_mirror()
+        mock_configure_docker_mirror.assert_called_with('')
+
+    @patch('charm.GitlabRunnerCharm.executors')
+    def test_11_scrape_advertises_the_metrics_front(self, mock_executors):
+        mock_executors.return_value = ['lxd']
+        harness = Harness(GitlabRunnerCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        relation_id = harness.add_relation('scrape', 'prometheus')
+        harness.add_relation_unit(relation_id, 'prometheus/0')
+
+        data = harness.get_relation_data(relation_id, harness.charm.unit.name)
+        self.assertEqual(data['hostname'], harness.charm._stored.fqdn)
+        self.assertEqual(data['port'], '9252')
+        self.assertEqual(data['metrics_path'], '/metrics')
+        self.assertNotIn('targets', data, msg="The lxd executor metrics are appended on port 9252")
+
     @patch('pathlib.Path.write_text')
     @patch('subprocess.Popen')
-    def test_20_templates_runner_templates(self, mock_write_text, mock_subprocess_popen):
+    def test_20_templates_runner_templates(self, mock_subprocess_popen, mock_write_text):
         # Mock return code from processes
         mock_subprocess_popen.return_value.returncode = 0
+        mock_subprocess_popen.return_value.communicate.return_value = (None, None)
 
         test_charm = MockCharm()
-        result = register_docker(test_charm)
+        with tempfile.TemporaryDirectory() as tmp, patch('gitlab_runner.CHARM_DIR', pathlib.Path(tmp)):
+            result = register_docker(test_charm)
         self.assertFalse(result, msg="Magically succeeded to render required templates")
+        mock_subprocess_popen.assert_not_called()
+
+        self.assertTrue(register_docker(test_charm))
+        rendered = ''.join(call[0][0] for call in mock_write_text.call_args_list)
+        self.assertIn('listen_address = "127.0.0.1:9253"', rendered, msg="Global config not rendered")
+        self.assertIn('[runners.docker]', rendered, msg="Docker runner template not rendered")
+
+    def test_21_lxd_pool_size(self):
+        test_charm = MockCharm()
+        test_charm.config['concurrent'] = 4
+        self.assertEqual(lxd_pool_size(test_charm), 0, msg="Pool should be disabled by default")
+
+        test_charm.config['lxd-pool-size'] = 2
+        self.assertEqual(lxd_pool_size(test_charm), 2)
+
+        test_charm.config['lxd-pool-size'] = -1
+        self.assertEqual(lxd_pool_size(test_charm), 4, msg="Pool not sized from concurrent")
+
+    def test_22_expire_golden_images(self):
+        with tempfile.TemporaryDirectory() as state:
+            golden = pathlib.Path(state, 'golden')
+            golden.mkdir()
+            golden.joinpath('ubuntu-18-04').touch()
+            golden.joinpath('ubuntu-18-04.lock').touch()
+            with patch('gitlab_runner.LXD_EXECUTOR_STATE', state):
+                expire_golden_images()
+            self.assertFalse(golden.joinpath('ubuntu-18-04').exists(), msg="Stamp not removed")
+            self.assertTrue(golden.joinpath('ubuntu-18-04.lock').exists(), msg="Lock file removed")
+
+    @patch('gitlab_runner.host_resources')
+    def test_23_lxd_resource_limits(self, mock_host_resources):
+        mock_host_resources.return_value = (8, 16384)
+        test_charm = MockCharm()
+        test_charm.config['concurrent'] = 4
+        config = lxd_profile_config(test_charm)
+        self.assertEqual(config['security.nesting'], 'true')
+        self.assertNotIn('limits.cpu', config, msg="Limits set without lxd-resource-limits")
+        self.assertEqual(lxd_slot_cpus(test_charm), [])
+
+        test_charm.config['lxd-resource-limits'] = 'auto'
+        config = lxd_profile_config(test_charm)
+        self.assertEqual((config['limits.cpu'], config['limits.memory']), ('2', '4096MB'))
+
+        test_charm.config['lxd-resource-limits'] = 'pinned'
+        self.assertNotIn('limits.cpu', lxd_profile_config(test_charm),
+                         msg="Pinned cores belong to the slot profiles")
+        self.assertEqual(lxd_slot_cpus(test_charm), ['0-1', '2-3', '4-5', '6-7'])
+
+    @patch('gitlab_runner.bridge_address')
+    def test_24_job_proxies(self, mock_bridge_address):
+        mock_bridge_address.return_value = '10.0.8.1'
+        test_charm = MockCharm()
+        self.assertEqual(job_proxies(test_charm), (None, None))
+
+        test_charm.config['http_proxy'] = 'http://proxy.example.com:8080/'
+        test_charm.config['https_proxy'] = 'http://proxy.example.com:8080/'
+        self.assertEqual(job_proxies(test_charm), ('http://proxy.example.com:8080/',
+                                                   'http://proxy.example.com:8080/'))
+
+        test_charm.config['package-cache'] = True
+        self.assertEqual(job_proxies(test_charm)[0], 'http://10.0.8.1:3142',
+                         msg="Jobs bypass the package cache")
+        mock_bridge_address.assert_called_with('docker0')
+
+    @patch('gitlab_runner.host_resources')
+    def test_25_build_storage(self, mock_host_resources):
+        mock_host_resources.return_value = (8, 16384)
+        test_charm = MockCharm()
+        test_charm.config['concurrent'] = 4
+        test_charm.config['build-tmpfs'] = '/builds:auto, /tmp:512m,/scratch:2g'
+        self.assertEqual(build_tmpfs_mounts(test_charm), {'/builds': 2048, '/tmp': 512, '/scratch': 2048})
+
+        test_charm.config['build-tmpfs'] = 'builds:1g'
+        with self.assertRaises(ValueError, msg="Relative tmpfs path accepted"):
+            build_tmpfs_mounts(test_charm)
+
+        test_charm.config['lxd-storage-pool'] = 'builds btrfs source=/dev/nvme1n1'
+        self.assertEqual(lxd_storage_pool(test_charm), ('builds', 'btrfs', {'source': '/dev/nvme1n1'}))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            target = pathlib.Path(tmp, 'runner-template-config.toml')
+            self.assertTrue(_render_template(templates_path.joinpath('runner-templates'), 'docker-1.template',
+                                             target, {'docker_image': 'docker:latest',
+                                                      'docker_volume_driver': 'local',
+                                                      'docker_cpus': '', 'docker_memory': '',
+                                                      'docker_shm_size': 0, 'docker_pull_policy': '[]',
+                                                      'docker_tmpfs': {'/builds': 'rw,exec,size=2048m',
+                                                                       '/tmp': 'rw,exec,size=512m'}}))
+            docker = toml.loads(target.read_text())['runners'][0]['docker']
+        self.assertEqual(docker['tmpfs'], {'/builds': 'rw,exec,size=2048m', '/tmp': 'rw,exec,size=512m'})
+        self.assertEqual(docker['volume_driver'], 'local')
+
+    @patch('gitlab_runner.fqdn')
+    @patch('gitlab_runner.job_proxies')
+    def test_26_reconcile_config_patches_in_place(self, mock_job_proxies, mock_fqdn):
+        mock_job_proxies.return_value = (None, None)
+        mock_fqdn.return_value = 'runner.example.com'
+        test_charm = MockCharm()
+        test_charm.config['executor'] = 'lxd'
+        with tempfile.TemporaryDirectory() as tmp:
+            config = pathlib.Path(tmp, 'config.toml')
+            live = {'concurrent': 1, 'check_interval': 3, 'log_level': 'error',
+                    'runners': [{'name': 'runner.example.com', 'url': 'https://gitlab.com',
+                                 'token': 'ABCDEFGHIJ', 'executor': 'custom',
+                                 'builds_dir': '/builds', 'cache_dir': '/cache',
+                                 'request_concurrency': 1,
+                                 'custom': {'run_exec': '/opt/lxd-executor/run.sh'}}]}
+            config.write_text(toml.dumps(live))
+            with patch('gitlab_runner.RUNNER_CONFIG', config.as_posix()):
+                test_charm.config['concurrent'] = 4
+                changed = reconcile_config(test_charm)
+                self.assertIn('concurrent', changed)
+                self.assertIn('runners.request_concurrency', changed)
+                self.assertIn('runners.custom.prepare_exec', changed)
+                patched = toml.loads(config.read_text())
+                self.assertEqual(patched['concurrent'], 4)
+                self.assertEqual(patched['runners'][0]['token'], 'ABCDEFGHIJ', msg="Runner token lost")
+
+                self.assertEqual(reconcile_config(test_charm), [], msg="Unchanged config patched")
+
+                test_charm.config['gitlab-server'] = 'https://gitlab.example.com'
+                self.assertIs(reconcile_config(test_charm), REGISTER_AGAIN,
+                              msg="New server did not require registration")
+
+    def test_27_render_template_skips_unchanged_content(self):
+        keywords = {'concurrent': 2, 'checkinterval': 3, 'sentrydsn': '', 'loglevel': 'error',
+                    'logformat': 'runner', 'listen_address': '127.0.0.1:9253'}
+        with tempfile.TemporaryDirectory() as tmp:
+            target = pathlib.Path(tmp, 'config.toml')
+            template_path = templates_path.joinpath('etc/gitlab-runner')
+            self.assertTrue(_render_template(template_path, 'config.toml', target, keywords))
+            os.utime(target.as_posix(), ns=(0, 0))
+
+            self.assertFalse(_render_template(template_path, 'config.toml', target, keywords),
+                             msg="Unchanged content reported as changed")
+            self.assertEqual(target.stat().st_mtime_ns, 0, msg="Unchanged content written again")
+
+            keywords['concurrent'] = 4
+            self.assertTrue(_render_template(template_path, 'config.toml', target, keywords))
+            self.assertIsNone(_render_template(template_path, 'missing.toml', target, keywords))
+
+    @patch('gitlab_runner.subprocess.run')
+    def test_28_running_jobs_from_metrics(self, mock_run):
+        metrics = ('# TYPE gitlab_runner_jobs gauge\n'
+                   'gitlab_runner_jobs{executor_stage="step_script",runner="abcdEFGH",state="running"} 2\n'
+                   'gitlab_runner_jobs{executor_stage="prepare_executor",runner="abcdEFGH",state="running"} 1\n'
+                   'gitlab_runner_jobs_total{runner="abcdEFGH"} 40\n'
+                   'gitlab_runner_version_info{version="14.3.0"} 1\n')
+        with patch('gitlab_runner.http.client.HTTPConnection') as mock_connection:
+            mock_connection.return_value.getresponse.return_value.read.return_value = metrics.encode()
+            self.assertEqual(running_jobs(), 3)
+
+            # A runner started from the unit file of an older charm.
+            mock_connection.return_value.request.side_effect = [ConnectionRefusedError, None]
+            self.assertEqual(running_jobs(), 3, msg="Jobs on the legacy metrics address missed")
+            self.assertEqual(mock_connection.call_args[0], ('127.0.0.1', 9252))
+
+            mock_connection.return_value.request.side_effect = ConnectionRefusedError
+            mock_run.return_value.returncode = 3
+            self.assertEqual(running_jobs(), 0, msg="A stopped runner has running jobs")
+            self.assertEqual(mock_run.call_args[0][0][:2], ['systemctl', 'is-active'])
+            mock_run.return_value.returncode = 0
+            self.assertIsNone(running_jobs(), msg="An active runner without metrics has no jobs")
+
+            # The package cache front without a runner behind it.
+            mock_connection.return_value.request.side_effect = None
+            mock_connection.return_value.getresponse.return_value.read.return_value = b'package_cache_requests_total 1\n'
+            self.assertIsNone(running_jobs())
+
+    @patch('gitlab_runner.time.sleep')
+    @patch('gitlab_runner.hook_timing.run')
+    @patch('gitlab_runner.running_jobs')
+    def test_29_drain_waits_for_jobs_until_deadline(self, mock_running_jobs, mock_run, mock_sleep):
+        progress = []
+        mock_running_jobs.side_effect = [3, 1, 0]
+        self.assertEqual(drain(60, progress.append), 0)
+        self.assertEqual(progress, [3, 1])
+        self.assertIn('--signal=SIGQUIT', mock_run.call_args[0][0])
+
+        mock_running_jobs.side_effect = None
+        mock_running_jobs.return_value = 2
+        with patch('gitlab_runner.time.monotonic', side_effect=[0, 30, 61]):
+            self.assertEqual(drain(60, progress.append), 2, msg="Drain ran past the deadline")
+
+        # Unknown while gitlab-runner is up without its metrics, waited for all the same.
+        progress.clear()
+        mock_running_jobs.side_effect = [None, None, 0]
+        self.assertEqual(drain(60, progress.append), 0)
+        self.assertEqual(progress, [None, None])
+
+    def test_30_stream_hands_over_output_lines(self):
+        lines = []
+        self.assertEqual(stream(['sh', '-c', 'echo one; echo two >&2; exit 3'], lines.append), 3)
+        self.assertEqual(lines, ['one', 'two'])
+        self.assertIsNone(stream(['sleep', '10'], lines.append, timeout=0.2), msg="Timeout not enforced")
+        # Killed by a signal, e.g. the OOM killer, is no timeout.
+        self.assertEqual(stream(['sh', '-c', 'kill -9 $$'], lines.append, timeout=10), -9)
+
+    @patch('gitlab_runner.fqdn')
+    def test_31_runner_specs(self, mock_fqdn):
+        mock_fqdn.return_value = 'runner.example.com'
+        test_charm = MockCharm()
+        test_charm.config['concurrent'] = 8
+        specs = runner_specs(test_charm)
+        self.assertEqual([spec['name'] for spec in specs], ['runner.example.com'])
+        self.assertEqual(specs[0]['request-concurrency'], 8)
+
+        test_charm.config['runners'] = ('- {name: big, tag-list: big, limit: 4, docker-image: "ubuntu:20.04"}\n'
+                                        '- {name: small, limit: 2}\n')
+        big, small = runner_specs(test_charm)
+        self.assertEqual(big['name'], 'runner.example.com-big')
+        self.assertEqual((big['docker-image'], big['request-concurrency']), ('ubuntu:20.04', 4))
+        self.assertEqual(small['docker-image'], 'docker:latest', msg="Top level default not used")
+        self.assertEqual(runner_capacity(test_charm), 6)
+        test_charm.config['concurrent'] = 5
+        self.assertEqual(runner_capacity(test_charm), 5, msg="Capacity above concurrent")
+
+        for runners in ('{name: big}', '- {name: big}\n- {name: big}', '- {limits: 2, name: a}',
+                        '- {executor: shell, name: a}', '- {limit: 2}', '- {name: a, limit: [2]}',
+                        '- {name: a, limit: {a: 1}}', '- {name: a, request-concurrency: many}'):
+            test_charm.config['runners'] = runners
+            with self.assertRaises(ValueError, msg=runners):
+                runner_specs(test_charm)
+
+    @patch('gitlab_runner.fqdn')
+    @patch('gitlab_runner.job_proxies')
+    def test_32_reconcile_config_patches_each_runner(self, mock_job_proxies, mock_fqdn):
+        mock_job_proxies.return_value = (None, None)
+        mock_fqdn.return_value = 'runner.example.com'
+        test_charm = MockCharm()
+        test_charm.config['executor'] = 'lxd'
+        test_charm.config['concurrent'] = 6
+        test_charm.config['runners'] = '[{name: a, limit: 2}, {name: b, limit: 4}, {name: c}]'
+        runner = {'url': 'https://gitlab.com', 'executor': 'custom', 'limit': 1}
+        live = {'concurrent': 1,
+                'runners': [dict(runner, name='runner.example.com-a', token='A'),
+                            dict(runner, name='runner.example.com-b', token='B'),
+                            dict(runner, name='runner.example.com', token='OLD')]}
+        with tempfile.TemporaryDirectory() as tmp:
+            config = pathlib.Path(tmp, 'config.toml')
+            config.write_text(toml.dumps(live))
+            with patch('gitlab_runner.RUNNER_CONFIG', config.as_posix()):
+                self.assertIn('runners.limit', reconcile_config(test_charm))
+                patched = {r['name']: r for r in toml.loads(config.read_text())['runners']}
+                self.assertEqual(patched['runner.example.com-a']['limit'], 2)
+                self.assertEqual(patched['runner.example.com-b']['limit'], 4)
+                self.assertEqual(patched['runner.example.com']['limit'], 1, msg="Unwanted runner patched")
+                self.assertNotIn('runner.example.com-c', patched, msg="Missing runner added without a token")
+
+    @patch('gitlab_runner.fqdn')
+    @patch('gitlab_runner.job_proxies')
+    @patch('gitlab_runner.host_free_disk')
+    @patch('gitlab_runner.host_resources')
+    def test_33_auto_concurrency_sizes_docker_jobs(self, mock_host_resources, mock_host_free_disk,
+                                                   mock_job_proxies, mock_fqdn):
+        mock_host_resources.return_value = (16, 33792)
+        mock_host_free_disk.return_value = 61440
+        mock_job_proxies.return_value = (None, None)
+        mock_fqdn.return_value = 'runner.example.com'
+        test_charm = MockCharm()
+        test_charm.config['docker-in-docker'] = False
+        test_charm.config['concurrent'] = 4
+        runner = desired_config(test_charm)['runners'][0]['docker']
+        self.assertEqual(runner['shm_size'], 0)
+        self.assertNotIn('cpus', runner, msg="Jobs limited without auto sizing")
+
+        test_charm.config['concurrent'] = -1
+        self.assertEqual(concurrency(test_charm), 6, msg="Free disk not limiting")
+        config = desired_config(test_charm)
+        runner = config['runners'][0]['docker']
+        self.assertEqual(config['concurrent'], 6)
+        self.assertEqual((runner['cpus'], runner['memory']), ('2.7', '5461m'))
+        self.assertEqual(runner['shm_size'], 1365 * 1024 * 1024)
+
+        mock_host_resources.return_value = (1, 1024)
+        self.assertEqual(concurrency(test_charm), 1, msg="Small hosts run no jobs")
+
+    @patch('gitlab_runner.fqdn')
+    @patch('gitlab_runner.job_proxies')
+    def test_34_docker_pull_policy_and_images(self, mock_job_proxies, mock_fqdn):
+        mock_job_proxies.return_value = (None, None)
+        mock_fqdn.return_value = 'runner.example.com'
+        test_charm = MockCharm()
+        test_charm.config['docker-in-docker'] = False
+        self.assertNotIn('pull_policy', desired_config(test_charm)['runners'][0]['docker'])
+
+        test_charm.config['docker-pull-policy'] = 'if-not-present, always'
+        self.assertTrue(check_docker_pull_policy(test_charm))
+        self.assertEqual(desired_config(test_charm)['runners'][0]['docker']['pull_policy'],
+                         ['if-not-present', 'always'])
+        test_charm.config['docker-pull-policy'] = 'sometimes'
+        self.assertFalse(check_docker_pull_policy(test_charm))
+
+        test_charm.config['runners'] = '[{name: a, docker-image: "ubuntu:20.04"}, {name: b}, {name: c, executor: lxd}]'
+        test_charm.config['docker-pull-images'] = 'python:3.9, docker:latest'
+        self.assertEqual(docker_pull_images(test_charm), ['ubuntu:20.04', 'docker:latest', 'python:3.9'])
+
+    @patch('gitlab_runner.subprocess.run')
+    def test_35_docker_mirror_config(self, mock_subprocess_run):
+        class StandInRegistry(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self.send_response(200 if self.path == '/v2/' else 404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+        registry = http.server.HTTPServer(('127.0.0.1', 0), StandInRegistry)
+        threading.Thread(target=registry.serve_forever, daemon=True).start()
+        self.addCleanup(registry.server_close)
+        self.addCleanup(registry.shutdown)
+        url = 'http://{}:{}'.format(*registry.server_address)
+        self.assertTrue(registry_mirror_ready(url))
+        self.assertFalse(registry_mirror_ready('http://127.0.0.1:1'))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            daemon = pathlib.Path(tmp, 'daemon.json')
+            daemon.write_text(json.dumps({'log-driver': 'journald', 'insecure-registries': ['build:5000']}))
+            with patch('gitlab_runner.DOCKER_DAEMON_CONFIG', daemon.as_posix()):
+                self.assertTrue(configure_docker_mirror(url))
+                config = json.loads(daemon.read_text())
+                self.assertEqual(config['registry-mirrors'], [url])
+                self.assertEqual(config['insecure-registries'], ['build:5000', url[len('http://'):]])
+                self.assertEqual(config['log-driver'], 'journald', msg="Other daemon settings lost")
+                mock_subprocess_run.assert_called_once_with(['systemctl', 'reload', 'docker.service'])
+
+                self.assertFalse(configure_docker_mirror(url), msg="Unchanged mirror reloaded docker")
+                self.assertTrue(configure_docker_mirror(''))
+                self.assertEqual(json.loads(daemon.read_text()),
+                                 {'log-driver': 'journald', 'insecure-registries': ['build:5000']})
+
+    @patch('gitlab_runner.get_token')
+    def test_36_hooks_and_subprocesses_are_timed(self, mock_get_token):
+        mock_get_token.return_value = ''
+        self.harness.charm.on.update_status.emit()
+        timing = hook_timing.completed[-1]
+        self.assertEqual(timing.hook, 'update_status')
+
+        popen = subprocess.Popen
+        with hook_timing.measure('upgrade_action') as timing:
+            hook_timing.run(['true'])
+            hook_timing.run(['sh', '-c', 'exit 3'])
+            # Like the hook tools ops runs, e.g. juju-log for every log record.
+            subprocess.run(['echo', 'juju-log'], stdout=subprocess.DEVNULL)
+        self.assertEqual([(command, rc) for command, _, rc in timing.calls], [('true', 0), ('sh', 3)])
+        self.assertIs(subprocess.Popen, popen)
+
+        # Concurrent subprocesses, like the download during the install, count once.
+        with hook_timing.measure('install') as timing:
+            processes = [hook_timing.Popen(['sleep', '0.2']) for _ in range(3)]
+            for process in processes:
+                process.wait()
+        self.assertGreater(sum(seconds for _, seconds, _ in timing.calls), timing.seconds)
+        self.assertLessEqual(timing.subprocess_seconds, timing.seconds)
+        self.assertGreaterEqual(timing.subprocess_seconds, 0.2)
+        totals = json.loads(self.timings.joinpath('hook_timings').read_text())
+        self.assertEqual(totals['hooks']['upgrade_action']['subprocesses'], 2)
+        self.assertEqual(totals['hooks']['update_status']['count'], 1)
+        metrics = self.timings.joinpath('hook_metrics').read_text()
+        self.assertIn('gitlab_runner_charm_hook_duration_seconds_count{hook="update_status"} 1', metrics)
+        self.assertIn('gitlab_runner_charm_subprocess_seconds_count{command="true"} 1', metrics)
+        self.assertEqual(hook_timing.command_name(['sudo', '-E', 'dpkg', '-i', 'x.deb']), 'dpkg')
+
+    def test_37_runner_deb_is_verified_and_resumed(self):
+        package = b'gitlab-runner 14.3.0'
+        digest = hashlib.sha256(package).hexdigest()
+        served = {'release.sha256': f'{digest} *deb/gitlab-runner_amd64.deb\n'.encode()}
+        calls = []
+
+        def curl(cmd, log, env=None, timeout=None):
+            # Serves served[file], the deb only up to its first `limit` bytes and
+            # never newer than the cached one.
+            calls.append(cmd)
+            if '--time-cond' in cmd:
+                return 0
+            output = cmd[cmd.index('--output') + 1]
+            name = cmd[-1].rsplit('/', 1)[1]
+            if name in served and served[name] is None:
+                return 22
+            data = served.get(name, package)
+            done = os.path.getsize(output) if '--continue-at' in cmd and os.path.exists(output) else 0
+            data = data[done:served.get('limit', len(data))]
+            with open(output, 'ab' if done else 'wb') as f:
+                f.write(data)
+            return 0 if len(data) + done == len(served.get(name, package)) else 18
+
+        with tempfile.TemporaryDirectory() as tmp, patch('gitlab_runner.stream', curl), \
+                patch('gitlab_runner.RUNNER_DEB_DIR', tmp):
+            deb = f'{tmp}/gitlab-runner_amd64.deb'
+            served['limit'] = 5
+            self.assertIsNone(download_runner_deb(MockCharm()), msg="Used a partial download")
+            self.assertTrue(os.path.exists(f'{deb}.part'), msg="Partial download not kept to resume")
+
+            del served['limit']
+            self.assertEqual(download_runner_deb(MockCharm()), deb)
+            self.assertEqual(pathlib.Path(deb).read_bytes(), package)
+            self.assertNotIn('--time-cond', calls[-1])
+
+            self.assertEqual(download_runner_deb(MockCharm()), deb, msg="Verified cache not used")
+            self.assertIn('--time-cond', calls[-1])
+
+            pathlib.Path(deb).write_bytes(b'tampered')
+            self.assertIsNone(download_runner_deb(MockCharm()))
+            self.assertFalse(os.path.exists(deb), msg="Corrupt cached package kept")
+
+            served['release.sha256'] = b'0000 *deb/gitlab-runner_amd64.deb\n'
+            self.assertIsNone(download_runner_deb(MockCharm()), msg="Package with a wrong checksum used")
+            self.assertFalse(os.path.exists(f'{deb}.part'))
+
+        # A first install without the release checksums fails closed, the download is kept.
+        served['release.sha256'] = None
+        with tempfile.TemporaryDirectory() as tmp, patch('gitlab_runner.stream', curl), \
+                patch('gitlab_runner.RUNNER_DEB_DIR', tmp):
+            deb = f'{tmp}/gitlab-runner_amd64.deb'
+            with self.assertLogs(level='ERROR') as logs:
+                self.assertIsNone(download_runner_deb(MockCharm()), msg="Unverified package used")
+            self.assertIn('No checksum of the gitlab-runner package', logs.output[-1])
+            self.assertNotIn('does not match', ''.join(logs.output))
+            self.assertEqual(pathlib.Path(f'{deb}.part').read_bytes(), package)
+
+            served['release.sha256'] = f'{digest} *deb/gitlab-runner_amd64.deb\n'.encode()
+            self.assertEqual(download_runner_deb(MockCharm()), deb, msg="Kept download not verified")
+
+    @patch('gitlab_runner.get_gitlab_runner_version')
+    @patch('gitlab_runner.install_package_cache')
+    @patch('gitlab_runner.install_docker_executor_services')
+    @patch('gitlab_runner.install_docker_executor')
+    @patch('gitlab_runner.install_runner_deb')
+    @patch('gitlab_runner.download_runner_deb')
+    @patch('shutil.copy2')
+    @patch('subprocess.run')
+    def test_38_install_downloads_while_executors_install(self, mock_subprocess_run, mock_copy2, mock_download,
+                                                          mock_install_deb, mock_install_docker,
+                                                          mock_install_docker_services,
+                                                          mock_install_package_cache, mock_version):
+        mock_version.return_value = '14.3.0'
+        events = []
+        mock_download.side_effect = lambda charm: events.append('download') or '/cache/gitlab-runner_amd64.deb'
+        mock_install_docker.side_effect = lambda charm: time.sleep(0.1) or events.append('docker')
+        mock_install_deb.side_effect = lambda deb: events.append(('dpkg', deb)) or True
+
+        self.harness.charm.on.install.emit()
+        self.assertEqual(events, ['download', 'docker', ('dpkg', '/cache/gitlab-runner_amd64.deb')],
+                         msg="Package not fetched during the executor install, or installed before apt finished")
+
+        events.clear()
+        self.harness.add_resource('gitlab-runner-deb', 'attached package')
+        self.harness.charm.on.install.emit()
+        self.assertEqual(events[0], 'docker', msg="Downloaded with an attached package")
+        self.assertTrue(events[1][1].endswith('gitlab-runner.deb'))
+
+    @patch('gitlab_runner.fqdn')
+    @patch('gitlab_runner.job_proxies')
+    @patch('interface_peers.RunnerPeers.address')
+    @patch('gitlab_runner.reconcile_config')
+    @patch('subprocess.run')
+    def test_39_shared_cache_is_served_by_the_leader(self, mock_subprocess_run, mock_reconcile_config,
+                                                     mock_address, mock_job_proxies, mock_fqdn):
+        mock_address.return_value = '10.0.0.1'
+        mock_job_proxies.return_value = ('http://10.0.3.1:3142', None)
+        mock_fqdn.return_value = 'runner.example.com'
+        relation_id = self.harness.add_relation('runners', 'gitlab-runner')
+        self.harness.disable_hooks()
+        self.harness.update_config({'shared-cache': 'local'})
+        self.harness.enable_hooks()
+
+        self.harness.set_leader(True)
+        cache = json.loads(self.harness.get_relation_data(relation_id, 'gitlab-runner')['shared-cache'])
+        self.assertEqual(cache['address'], '10.0.0.1:9000')
+        self.assertEqual(cache['bucket'], 'runner-cache')
+        self.assertEqual(len(cache['secret-key']), 40)
+        served = self.timings.joinpath('shared-cache')
+        self.assertIn('SHARED_CACHE_LISTEN=:9000', served.read_text().splitlines())
+        self.assertIn(f"SHARED_CACHE_SECRET_KEY={cache['secret-key']}", served.read_text().splitlines())
+        self.assertEqual(served.stat().st_mode & 0o077, 0, msg="Secret key readable by other users")
+
+        # The other units use the cache of the leader, and stop serving one of their own.
+        self.harness.set_leader(False)
+        self.assertEqual(self.harness.charm.shared_cache(), cache)
+        self.harness.charm.configure_shared_cache()
+        self.assertIn('SHARED_CACHE_LISTEN=', served.read_text().splitlines())
+        mock_subprocess_run.assert_called_with(['systemctl', 'restart', 'package-cache.service'])
+
+        test_charm = MockCharm()
+        test_charm.config['executor'] = 'lxd'
+        runner = desired_config(test_charm, cache)['runners'][0]
+        self.assertEqual(runner['cache']['Type'], 's3')
+        self.assertTrue(runner['cache']['Shared'], msg="Cache kept per runner token")
+        self.assertEqual(runner['cache']['s3']['ServerAddress'], '10.0.0.1:9000')
+        self.assertTrue(runner['cache']['s3']['Insecure'])
+        no_proxy = [e for e in runner['environment'] if e.startswith('no_proxy=')][0].split('=')[1].split(',')
+        self.assertIn('10.0.0.1', no_proxy, msg="Cache uploads sent to the job proxy")
+        self.assertIn('localhost', no_proxy, msg="Local services sent to the job proxy")
+        self.assertEqual(runner_cache({}), {'Type': ''})
+
+        with patch('subprocess.Popen') as mock_popen:
+            mock_popen.return_value.communicate.return_value = (None, None)
+            mock_popen.return_value.returncode = 0
+            _register(runner_specs(test_charm)[0], test_charm, [], cache=cache)
+            cmd = mock_popen.call_args[0][0]
+        self.assertIn('--cache-shared', cmd)
+        self.assertEqual(cmd[cmd.index('--cache-s3-secret-key') + 1], cache['secret-key'])
+
+        test_charm.config['shared-cache'] = 'https://s3.example.com'
+        self.assertFalse(check_shared_cache_config(test_charm), msg="S3 server without keys accepted")
+        test_charm.config['shared-cache-access-key'] = 'runner'
+        test_charm.config['shared-cache-secret-key'] = 'secret'
+        self.assertTrue(check_shared_cache_config(test_charm))
+        self.assertFalse(shared_cache_endpoint(test_charm, '', '')['insecure'])
+
+    @patch('gitlab_runner.fqdn')
+    @patch('gitlab_runner.job_proxies')
+    @patch('gitlab_runner._render_docker_template')
+    @patch('subprocess.Popen')
+    def test_40_registering_a_runner_keeps_the_others(self, mock_popen, mock_render_docker_template,
+                                                      mock_job_proxies, mock_fqdn):
+        mock_render_docker_template.return_value = True
+        mock_job_proxies.return_value = (None, None)
+        mock_fqdn.return_value = 'runner.example.com'
+        test_charm = MockCharm()
+        test_charm.config['runners'] = '[{name: a}, {name: b}]'
+
+        def register(cmd):
+            # gitlab-runner register appends the new runner to the config.
+            name = cmd[cmd.index('--name') + 1]
+            with open(cmd[cmd.index('--config') + 1], 'a') as f:
+                f.write(f'\n[[runners]]\n  name = "{name}"\n  token = "TOKEN-{name[-1]}"\n'
+                        f'  url = "https://gitlab.com"\n  executor = "docker"\n')
+            process = MagicMock(returncode=0)
+            process.communicate.return_value = (None, None)
+            return process
+        mock_popen.side_effect = register
+
+        with tempfile.TemporaryDirectory() as tmp:
+            config = pathlib.Path(tmp, 'config.toml')
+            with patch('gitlab_runner.RUNNER_CONFIG', config.as_posix()):
+                for spec in runner_specs(test_charm):
+                    self.assertTrue(register_docker(test_charm, spec))
+                runners = toml.loads(config.read_text())['runners']
+        self.assertEqual({r['name']: r['token'] for r in runners},
+                         {'runner.example.com-a': 'TOKEN-a', 'runner.example.com-b': 'TOKEN-b'},
+                         msg="Registering a runner dropped the runners registered before it")
+
+    @patch('charm.GitlabRunnerCharm._on_update_status')
+    @patch('charm.GitlabRunnerCharm.drain')
+    @patch('gitlab_runner.install_package_cache')
+    @patch('gitlab_runner.install_docker_executor_services')
+    @patch('gitlab_runner.install_lxd_executor_services')
+    @patch('gitlab_runner.install_runner_service')
+    @patch('subprocess.run')
+    def test_41_upgrade_charm_reinstalls_the_services(self, mock_subprocess_run, mock_install_runner_service,
+                                                      mock_install_lxd_services, mock_install_docker_services,
+                                                      mock_install_package_cache, mock_drain, mock_update_status):
+        self.harness.charm._stored.executors = ['docker', 'lxd']
+        mock_install_runner_service.return_value = False
+        self.harness.charm.on.upgrade_charm.emit()
+        mock_install_lxd_services.assert_called_once_with(self.harness.charm)
+        mock_install_docker_services.assert_called_once_with(self.harness.charm)
+        mock_install_package_cache.assert_called_once_with(self.harness.charm)
+        mock_drain.assert_not_called()
+        mock_subprocess_run.assert_not_called()
+
+        # A changed gitlab-runner unit is picked up once the running jobs finished.
+        mock_install_runner_service.return_value = True
+        self.harness.charm.on.upgrade_charm.emit()
+        mock_drain.assert_called_once_with()
+        mock_subprocess_run.assert_called_once_with(['systemctl', 'restart', 'gitlab-runner.service'])
+        self.assertEqual(mock_install_package_cache.call_count, 2)
+
+    @patch('gitlab_runner.fqdn')
+    @patch('gitlab_runner.job_proxies')
+    def test_42_reconcile_config_drops_cleared_options(self, mock_job_proxies, mock_fqdn):
+        mock_job_proxies.return_value = (None, None)
+        mock_fqdn.return_value = 'runner.example.com'
+        test_charm = MockCharm()
+        test_charm.config['docker-pull-policy'] = 'never'
+        test_charm.config['build-tmpfs'] = '/builds:1g'
+        test_charm.config['docker-volume-driver'] = 'local'
+        # As registered with these options, plus what gitlab-runner adds on its own.
+        live = desired_config(test_charm)
+        live['runners'][0]['token'] = 'ABCDEFGHIJ'
+        self.assertEqual(live['runners'][0]['docker']['pull_policy'], ['never'])
+        with tempfile.TemporaryDirectory() as tmp:
+            config = pathlib.Path(tmp, 'config.toml')
+            config.write_text(toml.dumps(live))
+            with patch('gitlab_runner.RUNNER_CONFIG', config.as_posix()):
+                self.assertEqual(reconcile_config(test_charm), [])
+
+                test_charm.config['docker-pull-policy'] = ''
+                test_charm.config['build-tmpfs'] = ''
+                test_charm.config['docker-volume-driver'] = ''
+                changed = reconcile_config(test_charm)
+                self.assertIn('runners.docker.pull_policy', changed)
+                self.assertIn('runners.docker.tmpfs./builds', changed)
+                self.assertIn('runners.docker.volume_driver', changed)
+                runner = toml.loads(config.read_text())['runners'][0]
+                self.assertNotIn('pull_policy', runner['docker'], msg="Cleared pull policy kept")
+                self.assertNotIn('volume_driver', runner['docker'], msg="Cleared volume driver kept")
+                self.assertEqual(runner['docker']['tmpfs'], {'/scratch': 'rw,exec,size=1g'})
+                self.assertEqual(runner['token'], 'ABCDEFGHIJ', msg="Runner token lost")
+                self.assertEqual(reconcile_config(test_charm), [], msg="Unchanged config patched")
+
+    @patch('gitlab_runner.reconcile_config')
+    @patch('gitlab_runner.register_docker')
+    @patch('gitlab_runner.render_package_cache_config')
+    @patch('subprocess.run')
+    def test_43_malformed_build_tmpfs_blocks(self, mock_subprocess_run, mock_render_package_cache_config,
+                                             mock_register_docker, mock_reconcile_config):
+        self.harness.update_config({"gitlab-registration-token": "abc",
+                                    "gitlab-server": "https://gitlab.com",
+                                    "build-tmpfs": "relative:1g"})
+        self.assertEqual(self.harness.charm.unit.status, BlockedStatus("Build storage config incorrect"))
+        mock_register_docker.assert_not_called()
+        mock_reconcile_config.assert_not_called()
+
+        test_charm = MockCharm()
+        test_charm.config['build-tmpfs'] = 'relative:1g'
+        with self.assertLogs(level='ERROR'):
+            self.assertIsNone(render_lxd_executor_config(test_charm))
+            self.assertFalse(_render_docker_template(test_charm, runner_specs(test_charm)[0]))
+
+    @patch('gitlab_runner.reconcile_config')
+    @patch('gitlab_runner.register_docker')
+    @patch('gitlab_runner.render_package_cache_config')
+    @patch('subprocess.run')
+    def test_44_unknown_pull_policy_blocks(self, mock_subprocess_run, mock_render_package_cache_config,
+                                           mock_register_docker, mock_reconcile_config):
+        self.harness.update_config({"gitlab-registration-token": "abc",
+                                    "gitlab-server": "https://gitlab.com",
+                                    "docker-pull-policy": "sometimes"})
+        self.assertEqual(self.harness.charm.unit.status, BlockedStatus("Docker pull policy config incorrect"))
+        mock_register_docker.assert_not_called()
+        mock_reconcile_config.assert_not_called()
+
+    @patch('charm.GitlabRunnerCharm._on_register_action')
+    @patch('charm.GitlabRunnerCharm._install_services')
+    @patch('gitlab_runner.installed_version')
+    @patch('gitlab_runner.deb_version')
+    @patch('gitlab_runner.get_gitlab_runner_version')
+    @patch('gitlab_runner.install_runner_service')
+    @patch('gitlab_runner.install_docker_executor')
+    @patch('gitlab_runner.install_runner_deb')
+    @patch('gitlab_runner.download_runner_deb')
+    @patch('subprocess.run')
+    def test_45_install_fails_closed_without_a_verified_package(self, mock_subprocess_run, mock_download,
+                                                                mock_install_deb, mock_install_docker,
+                                                                mock_install_runner_service, mock_version,
+                                                                mock_deb_version, mock_installed_version,
+                                                                mock_install_services, mock_register_action):
+        mock_download.return_value = None
+        mock_install_deb.return_value = True
+        mock_deb_version.return_value = '14.3.0'
+        mock_installed_version.return_value = ''
+
+        self.harness.charm.on.install.emit()
+        self.assertEqual(self.harness.charm.unit.status, BlockedStatus(NOT_INSTALLED))
+        mock_install_deb.assert_not_called()
+        mock_install_runner_service.assert_not_called()
+        mock_install_services.assert_not_called()
+        mock_version.assert_not_called()
+        self.assertEqual(self.harness.charm.executors(), ['docker'])
+
+        # Later hooks keep the hint until the package is installed.
+        with patch('gitlab_runner.register_docker') as mock_register_docker:
+            self.harness.update_config({"gitlab-registration-token": "abc",
+                                        "gitlab-server": "https://gitlab.com"})
+        mock_register_docker.assert_not_called()
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.charm.unit.status, BlockedStatus(NOT_INSTALLED))
+
+        # The upgrade action installs the attached package, and the services the install hook left out.
+        self.harness.add_resource('gitlab-runner-deb', 'attached package')
+        with patch('charm.GitlabRunnerCharm.drain', return_value=0):
+            self.harness.charm._on_upgrade_action(MagicMock())
+        self.assertTrue(mock_install_deb.call_args[0][0].endswith('gitlab-runner.deb'))
+        mock_install_runner_service.assert_called_once_with()
+        mock_install_services.assert_called_once_with(['docker'])
+        mock_subprocess_run.assert_any_call(['systemctl', 'restart', 'gitlab-runner.service'])
+        self.assertFalse(self.harness.charm._stored.runner_missing)
+        mock_register_action.assert_called_once()
+
+    @patch('charm.GitlabRunnerCharm._on_update_status')
+    @patch('charm.GitlabRunnerCharm.outdated_runners')
+    @patch('charm.GitlabRunnerCharm.registered')
+    @patch('gitlab_runner.refill_lxd_pool')
+    @patch('gitlab_runner.unregister')
+    @patch('gitlab_runner.render_runner_templates')
+    @patch('gitlab_runner.configure_lxd')
+    @patch('gitlab_runner.render_package_cache_config')
+    def test_46_config_changed_follows_the_rendered_changes(self, mock_render_package_cache_config,
+                                                            mock_configure_lxd, mock_render_runner_templates,
+                                                            mock_unregister, mock_refill_lxd_pool, mock_registered,
+                                                            mock_outdated_runners, mock_update_status):
+        mock_registered.return_value = True
+        mock_outdated_runners.return_value = []
+        self.harness.charm._stored.executor = 'lxd'
+        self.harness.charm._stored.executors = ['lxd']
+        self.harness.disable_hooks()
+        self.harness.update_config({"gitlab-registration-token": "abc",
+                                    "gitlab-server": "https://gitlab.com",
+                                    "executor": "lxd"})
+        self.harness.enable_hooks()
+
+        mock_render_runner_templates.return_value = None
+        self.harness.charm.on.config_changed.emit()
+        self.assertEqual(self.harness.charm.unit.status, BlockedStatus("Failed to render runner config"))
+        mock_unregister.assert_not_called()
+
+        mock_render_runner_templates.return_value = False
+        self.harness.charm.on.config_changed.emit()
+        mock_refill_lxd_pool.assert_not_called()
+
+        mock_render_runner_templates.return_value = True
+        self.harness.charm.on.config_changed.emit()
+        mock_refill_lxd_pool.assert_called_once_with()
+        mock_unregister.assert_not_called()
+
+        # The config failing to render does not register the runners again.
+        test_charm = MockCharm()
+        test_charm.config['build-tmpfs'] = 'relative:1g'
+        with self.assertLogs(level='ERROR'):
+            self.assertIsNone(reconcile_config(test_charm))
+
+    @patch('gitlab_runner.render_runner_templates')
+    @patch('interface_peers.RunnerPeers.address')
+    @patch('subprocess.run')
+    def test_47_malformed_shared_cache_blocks(self, mock_subprocess_run, mock_address,
+                                              mock_render_runner_templates):
+        mock_address.return_value = '10.0.0.1'
+        relation_id = self.harness.add_relation('runners', 'gitlab-runner')
+        self.harness.set_leader(True)
+        self.harness.update_config({"gitlab-registration-token": "abc",
+                                    "gitlab-server": "https://gitlab.com",
+                                    "shared-cache": "ftp://bogus"})
+        self.assertEqual(self.harness.charm.unit.status, BlockedStatus("Shared cache config incorrect"))
+        mock_render_runner_templates.assert_not_called()
+
+        # Neither the runners nor the other units get the endpoint.
+        self.assertEqual(self.harness.charm.shared_cache(), {})
+        self.harness.charm.on.update_status.emit()
+        self.assertFalse(self.harness.get_relation_data(relation_id, 'gitlab-runner').get('shared-cache'))
+
+    @patch('gitlab_runner._render_template')
+    @patch('gitlab_runner.hook_timing.run')
+    @patch('shutil.copy2')
+    @patch('pathlib.Path.read_bytes')
+    @patch('pathlib.Path.exists')
+    def test_48_replaced_prepull_service_is_reloaded(self, mock_exists, mock_read_bytes, mock_copy2,
+                                                     mock_run, mock_render_template):
+        # Images and timer are unchanged, only the service differs from the charm.
+        mock_render_template.return_value = False
+        mock_exists.return_value = True
+        mock_read_bytes.side_effect = [b'old unit', b'new unit']
+        install_docker_executor_services(MockCharm())
+        mock_copy2.assert_called_once()
+        mock_run.assert_called_once_with(['systemctl', 'daemon-reload'])
+
+        mock_copy2.reset_mock()
+        mock_run.reset_mock()
+        mock_read_bytes.side_effect = [b'new unit', b'new unit']
+        install_docker_executor_services(MockCharm())
+        mock_copy2.assert_not_called()
+        mock_run.assert_not_called()
@@ -0,0 +1,324 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+import fcntl
+import http.client
+import http.server
+import io
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+sys.path.append(pathlib.Path(__file__).parent.parent.joinpath('src').as_posix())
+
+from lxd_executor import (AGENT_DEVICE, START_AGENT, AgentHandler, AgentServer, Executor,  # noqa: E402
+                          LXDClient, MetricsHandler, READY_CHECK, image_source)
+from tests.fake_lxd import FakeLXD  # noqa: E402
+from tests.loadtest_lxd_executor import LoadTest, RUN_STAGES, percentile  # noqa: E402
+
+SLOT = 'runner-1-project-2-concurrent-0'
+
+
+class TestLXDExecutor(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.state = tmp.name
+        self.fake = FakeLXD(os.path.join(self.state, 'unix.socket')).start()
+        self.addCleanup(self.fake.stop)
+        self.client = LXDClient(self.fake.socket_path)
+        self.addCleanup(self.client.close)
+        self.env = {'CUSTOM_ENV_CI_RUNNER_ID': '1',
+                    'CUSTOM_ENV_CI_PROJECT_ID': '2',
+                    'CUSTOM_ENV_CI_CONCURRENT_PROJECT_ID': '0',
+                    'SYSTEM_FAILURE_EXIT_CODE': '2',
+                    'BUILD_FAILURE_EXIT_CODE': '3'}
+        self.out = io.BytesIO()
+        self.err = io.BytesIO()
+
+    def executor(self, **config):
+        config.setdefault('LXD_EXECUTOR_STATE', self.state)
+        return Executor(self.client, config, self.env, self.out, self.err)
+
+    def test_01_prepare_launches_container(self):
+        self.assertEqual(self.executor().prepare(), 0, msg=self.out.getvalue())
+
+        instance = self.fake.instances[SLOT]
+        self.assertEqual(instance['status'], 'Running')
+        self.assertEqual(instance['profiles'], ['default', 'gitlab'])
+        self.assertEqual(instance['source']['alias'], '18.04')
+        self.assertFalse([r for r in self.fake.requests if '/profiles' in r[1] or '/networks' in r[1]],
+                         msg="Profile and network belong to the charm, not each job")
+        self.assertEqual(self.fake.connections - self.fake.websockets, 1,
+                         msg="API requests did not reuse one connection")
+
+    def test_02_prepare_fails_when_container_never_boots(self):
+        self.fake.exec_handler = lambda name, command, stdin: (b'', b'', 1)
+
+        self.assertEqual(self.executor(LXD_BOOT_TIMEOUT='1').prepare(), 2,
+                         msg="Expected a system failure")
+        self.assertIn(b'Waited for 1 seconds', self.out.getvalue())
+
+    def test_03_run_streams_script(self):
+        self.fake.add_instance(SLOT)
+        self.fake.exec_handler = lambda name, command, stdin: (stdin.upper(), b'warning', 0)
+        script = pathlib.Path(self.state, 'script')
+        script.write_bytes(b'echo hello\n')
+
+        self.assertEqual(self.executor().run(script.as_posix(), 'step_script'), 0)
+        self.assertEqual(self.fake.commands[-1], (SLOT, ['/bin/bash']))
+        self.assertEqual(self.out.getvalue(), b'ECHO HELLO\n')
+        self.assertEqual(self.err.getvalue(), b'warning')
+
+        self.fake.exec_handler = lambda name, command, stdin: (b'', b'', 1)
+        self.assertEqual(self.executor().run(script.as_posix(), 'step_script'), 3,
+                         msg="Expected a build failure")
+
+    def test_04_cleanup_marks_container_for_reaping(self):
+        self.fake.add_instance(SLOT)
+
+        self.assertEqual(self.executor().cleanup(), 0)
+        self.assertNotIn(SLOT, self.fake.instances, msg="Slot name still taken")
+        reaped = [name for name in self.fake.instances if name.startswith('reap-')]
+        self.assertEqual(len(reaped), 1)
+        self.assertEqual(self.fake.instances[reaped[0]]['status'], 'Stopped')
+
+    def test_05_prepare_claims_from_pool(self):
+        executor = self.executor(LXD_POOL_SIZE='1')
+        pool_dir = pathlib.Path(executor.pool_dir('ubuntu:18.04'))
+        pool_dir.mkdir(parents=True)
+        pool_dir.joinpath('pool-ubuntu-18-04-0a0b').write_text('pool-ubuntu-18-04-0a0b\n')
+        self.fake.add_instance('pool-ubuntu-18-04-0a0b')
+
+        self.assertEqual(executor.prepare(), 0)
+        self.assertNotIn(SLOT, self.fake.instances, msg="Launched instead of claiming")
+        self.assertEqual(executor.container, 'pool-ubuntu-18-04-0a0b')
+        self.assertEqual(list(pool_dir.iterdir()), [])
+
+        self.assertEqual(executor.cleanup(), 0)
+        self.assertNotIn('pool-ubuntu-18-04-0a0b', self.fake.instances)
+        self.assertEqual(executor.container, SLOT)
+        self.assertEqual(executor.reap(), 0)
+        self.assertEqual(self.fake.instances, {})
+
+    def test_06_pool_refills_and_drops_orphans(self):
+        self.fake.add_instance('pool-ubuntu-18-04-dead')
+        executor = self.executor(LXD_POOL_SIZE='2', LXD_POOL_IMAGES='ubuntu:18.04')
+
+        self.assertEqual(executor.pool(), 0)
+        pooled = sorted(os.listdir(executor.pool_dir('ubuntu:18.04')))
+        self.assertEqual(len(pooled), 2)
+        self.assertEqual(sorted(self.fake.instances), pooled)
+
+    def test_07_golden_image_built_once(self):
+        executor = self.executor(LXD_GOLDEN_IMAGES='true')
+
+        self.assertEqual(executor.prepare(), 0)
+        fingerprint = self.fake.aliases['golden-ubuntu-18-04']
+        self.assertEqual(self.fake.instances[SLOT]['source'],
+                         {'type': 'image', 'fingerprint': fingerprint})
+        self.assertEqual(executor.cleanup(), 0)
+
+        self.assertEqual(executor.prepare(), 0)
+        self.assertEqual(list(self.fake.images), [fingerprint], msg="Golden image rebuilt")
+
+    def test_08_image_source(self):
+        self.assertEqual(image_source('ubuntu:20.04')['server'],
+                         'https://cloud-images.ubuntu.com/releases')
+        self.assertEqual(image_source('images:debian/11')['alias'], 'debian/11')
+        self.assertEqual(image_source('local:golden-ubuntu'), {'type': 'image',
+                                                               'alias': 'golden-ubuntu'})
+        self.assertIn('fingerprint', image_source('0123456789abcdef'))
+
+    def test_09_boot_waits_on_systemd(self):
+        self.assertEqual(self.executor().prepare(), 0)
+
+        self.assertEqual(self.fake.commands[0], (SLOT, ['sh', '-c', READY_CHECK]))
+        self.assertRegex(self.out.getvalue().decode(), f'Container {SLOT} ready in [0-9.]+s')
+
+    def test_10_recycle_restores_clean_snapshot(self):
+        executor = self.executor(LXD_RECYCLE='true')
+        name = executor.recycle_name
+
+        self.assertEqual(executor.prepare(), 0)
+        self.assertEqual(executor.container, name)
+        self.assertIn('clean', self.fake.instances[name]['snapshots'])
+
+        self.assertEqual(executor.cleanup(), 0)
+        self.assertEqual(self.fake.instances[name]['status'], 'Stopped')
+        self.assertEqual(self.fake.instances[name]['restored'], 1)
+
+        self.assertEqual(executor.prepare(), 0)
+        self.assertEqual(self.fake.instances[name]['status'], 'Running')
+        self.assertEqual(self.fake.requests.count(('POST', '/1.0/instances')), 1,
+                         msg="Recycled container was launched again")
+
+    def test_11_reaper_deletes_marked_and_orphaned_containers(self):
+        self.fake.add_instance('reap-0a0b0c-' + SLOT, 'Stopped')
+        self.fake.add_instance('runner-1-project-3-concurrent-0',
+                               created_at='2021-01-01T00:00:00.000000000Z')
+        self.fake.add_instance(SLOT)
+        executor = self.executor(LXD_REAP_PARALLELISM='2')
+
+        self.assertEqual(executor.reap(), 0)
+        self.assertEqual(list(self.fake.instances), [SLOT], msg="Running job container reaped")
+        status = json.loads(pathlib.Path(self.state, 'reaper.json').read_text())
+        self.assertEqual(status['backlog'], 0)
+
+    def test_12_pinned_slots_launch_with_slot_profile(self):
+        self.env['CUSTOM_ENV_CI_CONCURRENT_ID'] = '5'
+        executor = self.executor(LXD_CPU_SLOTS='4')
+
+        self.assertEqual(executor.prepare(), 0)
+        self.assertEqual(self.fake.instances[SLOT]['profiles'],
+                         ['default', 'gitlab', 'gitlab-slot-1'])
+
+    def test_13_project_cache_and_git_mirror_are_mounted(self):
+        repo = pathlib.Path(self.state, 'repo')
+        for command in (['git', 'init', '-q', repo.as_posix()],
+                        ['git', '-C', repo.as_posix(), '-c', 'user.name=ci', '-c', 'user.email=ci@example.com',
+                         'commit', '-q', '--allow-empty', '-m', 'initial']):
+            subprocess.run(command, check=True)
+        self.env.update(CUSTOM_ENV_CI_REPOSITORY_URL=repo.as_posix(),
+                        CUSTOM_ENV_CI_PROJECT_DIR='/builds/group/project')
+
+        self.assertEqual(self.executor(LXD_PROJECT_CACHE='true').prepare(), 0,
+                         msg=self.out.getvalue())
+        devices = self.fake.instances[SLOT]['devices']
+        project_dir = pathlib.Path(self.state, 'projects', '2')
+        self.assertEqual(devices['project-cache']['source'], project_dir.joinpath('cache').as_posix())
+        self.assertEqual(devices['git-mirror']['readonly'], 'true')
+        heads = subprocess.run(['git', '-C', project_dir.joinpath('git').as_posix(), 'show-ref'],
+                               stdout=subprocess.PIPE, check=True).stdout
+        self.assertTrue(heads, msg="Reference mirror not fetched")
+        self.assertEqual(self.fake.commands[-1][1][-1], '/builds/group/project')
+
+    def test_14_project_caches_evicted_least_recently_used_first(self):
+        executor = self.executor(LXD_PROJECT_CACHE='true', LXD_CACHE_MAX_SIZE='1')
+        for project, used in (('2', 100), ('3', 200), ('4', 300)):
+            project_dir = pathlib.Path(executor.project_dir(project))
+            project_dir.mkdir(parents=True)
+            project_dir.joinpath('blob').write_bytes(os.urandom(512 * 1024))
+            os.utime(project_dir.as_posix(), (used, used))
+        # A job of project 2 is running, its cache stays.
+        self.fake.add_instance(SLOT)
+
+        executor.evict_project_caches()
+        self.assertEqual(sorted(os.listdir(executor.cache_root)), ['2', '4'])
+
+    def test_15_build_tmpfs_mounted_before_the_job(self):
+        executor = self.executor(LXD_BUILD_TMPFS='/builds:2048,/tmp:512')
+
+        self.assertEqual(executor.prepare(), 0)
+        mounts = [command[-2:] for _, command in self.fake.commands if 'tmpfs' in command[2]]
+        self.assertEqual(mounts, [['/builds', '2048'], ['/tmp', '512']])
+
+        self.fake.exec_handler = lambda name, command, stdin: (b'', b'', 32 if 'tmpfs' in command[2] else 0)
+        self.assertEqual(self.executor(LXD_BUILD_TMPFS='/builds:2048').prepare(), 2,
+                         msg="Job ran without its build tmpfs")
+
+    def test_16_stage_metrics(self):
+        script = pathlib.Path(self.state, 'script')
+        script.write_bytes(b'exit 1\n')
+        executor = self.executor()
+        self.assertEqual(executor.prepare(), 0)
+        self.fake.exec_handler = lambda name, command, stdin: (b'', b'', 1)
+        self.assertEqual(executor.run(script.as_posix(), 'step_script'), 3)
+        self.assertEqual(executor.cleanup(), 0)
+        self.assertEqual(executor.reap(), 0)
+        self.assertEqual(self.executor(LXD_BOOT_TIMEOUT='1').prepare(), 2)
+
+        stages = executor.metrics.load()
+        self.assertEqual(sorted(stages), ['boot', 'cleanup', 'delete', 'dependencies', 'launch', 'prepare', 'run'])
+        self.assertEqual(stages['prepare']['count'], 2)
+        self.assertEqual(stages['prepare']['failures'], 1)
+        self.assertEqual(stages['boot']['failures'], 1)
+        self.assertEqual(stages['run']['failures'], 0, msg="A failed job script counted as executor failure")
+
+        server = http.server.HTTPServer(('127.0.0.1', 0), MetricsHandler)
+        server.metrics = executor.metrics
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        connection = http.client.HTTPConnection(*server.server_address)
+        self.addCleanup(connection.close)
+        connection.request('GET', '/metrics')
+        text = connection.getresponse().read().decode()
+        self.assertIn('lxd_executor_stage_duration_seconds_bucket{stage="launch",le="+Inf"} 2', text)
+        self.assertIn('lxd_executor_stage_duration_seconds_count{stage="run"} 1', text)
+        self.assertIn('lxd_executor_stage_failures_total{stage="prepare"} 1', text)
+
+    def test_17_run_stages_through_exec_agent(self):
+        executor = self.executor(LXD_EXEC_AGENT='true')
+        servers = []
+
+        def exec_handler(name, command, stdin):
+            if command == ['sh', '-c', START_AGENT, 'sh', '/run/lxd-executor-agent.py',
+                           '/run/lxd-executor-agent.sock']:
+                # Stands in for the agent behind the proxy device.
+                server = AgentServer(executor.agent_socket(name), AgentHandler)
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+                servers.append(server)
+            return stdin, b'', 0
+        self.fake.exec_handler = exec_handler
+        self.assertEqual(executor.prepare(), 0, msg=self.out.getvalue())
+        for server in servers:
+            self.addCleanup(server.server_close)
+            self.addCleanup(server.shutdown)
+        instance = self.fake.instances[SLOT]
+        self.assertEqual(instance['devices'][AGENT_DEVICE]['connect'], 'unix:/run/lxd-executor-agent.sock')
+        self.assertTrue(self.fake.files[(SLOT, '/run/lxd-executor-agent.py')].startswith(b'#!/usr/bin/env python3'))
+
+        script = pathlib.Path(self.state, 'script')
+        script.write_bytes(b'read line; echo "$line"; echo warning >&2; exit 5\nfrom stdin\n')
+        commands = len(self.fake.commands)
+        self.assertEqual(executor.run(script.as_posix(), 'step_script'), 3)
+        self.assertEqual(self.out.getvalue().splitlines()[-1], b'from stdin')
+        self.assertEqual(self.err.getvalue(), b'warning\n')
+        self.assertEqual(len(self.fake.commands), commands, msg="The run stage went through lxc exec")
+
+        # Without the agent the stage falls back to lxc exec.
+        servers[0].shutdown()
+        servers[0].server_close()
+        script.write_bytes(b'true\n')
+        self.assertEqual(executor.run(script.as_posix(), 'step_script'), 0)
+        self.assertEqual(self.fake.commands[-1], (SLOT, ['/bin/bash']))
+
+        self.assertEqual(executor.cleanup(), 0)
+        self.assertFalse(os.path.exists(executor.agent_socket(SLOT)))
+
+    def test_18_load_test(self):
+        self.assertEqual(percentile([3, 1, 2, 4], 50), 2)
+        self.assertEqual(percentile([3, 1, 2, 4], 99), 4)
+
+        test = LoadTest(os.path.join(self.state, 'load'), jobs=4, concurrent=2, projects=1).run()
+        self.assertEqual(test.failures, [])
+        stages = test.stages()
+        self.assertEqual(stages['run'][0], 4 * len(RUN_STAGES))
+        self.assertEqual(stages['cleanup'][:2], (4, 0))
+        self.assertFalse([name for name in test.fake.instances if name.startswith('runner-')],
+                         msg="Job containers were left behind")
+
+    def test_19_slow_mirror_fetch_does_not_hold_up_the_job(self):
+        self.env.update(CUSTOM_ENV_CI_REPOSITORY_URL='ssh://gitlab.example.com/group/project.git')
+        executor = self.executor(LXD_PROJECT_CACHE='true', LXD_MIRROR_TIMEOUT='1')
+        lock = pathlib.Path(self.state, 'projects', '2', 'git.lock')
+        # The ssh transport of a slow server.
+        with patch.dict(os.environ, GIT_SSH_COMMAND='sleep 3; false'):
+            started = time.monotonic()
+            self.assertEqual(executor.prepare(), 0, msg=self.out.getvalue())
+        self.assertLess(time.monotonic() - started, 3, msg="Job waited for the mirror fetch")
+        self.assertIn(b'continuing in the background', self.out.getvalue())
+
+        with open(lock, 'w') as f:
+            with self.assertRaises(OSError, msg="Background fetch released the mirror lock"):
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # Released once the fetch gave up.
+            fcntl.flock(f, fcntl.LOCK_EX)